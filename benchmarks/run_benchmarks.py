@@ -0,0 +1,193 @@
+"""
+Benchmarks the package import and the generation, detection and
+reconstruction stages. Records the best wall time and the peak traced
+memory of each case and saves them as JSON, so that runs of different
+commits can be compared with ``--compare``.
+
+Example:
+    python benchmarks/run_benchmarks.py --output bench.json
+    python benchmarks/run_benchmarks.py --quick --compare bench.json
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+import numpy
+from simulator import (PoissonSource, Detector, Reconstructor)
+
+THETA_MAX = 10
+COV = [[1, 0.5], [0.5, 2]]
+EVENTS = [10**3, 10**4, 10**5, 10**6]
+PLATES = [2, 5, 10, 50]
+QUICK_EVENTS = [10**3, 10**4]
+QUICK_PLATES = [2, 10]
+# Number of events of the per-event (list of dicts) cases
+PER_EVENT_EVENTS = 10**3
+
+
+def make_detector(Nplates):
+    """
+    Returns a detector of ``Nplates`` plates spaced by 1 from z=30. The
+    plates are wide enough for every event within ``THETA_MAX`` to hit them.
+    """
+    plates = []
+    for i in range(Nplates):
+        z = 30 + i
+        half = max(10, 1.1 * z * numpy.tan(numpy.deg2rad(THETA_MAX)))
+        plates.append({'bounds': {'x': (-half, half), 'y': (-half, half)},
+                       'Npixs': 2000, 'z': z, 'phi': 7 * i})
+    return Detector(plates)
+
+
+def make_events(N, cov=None, seed=2021):
+    """Returns approximately ``N`` events observed within unit time."""
+    source = PoissonSource(THETA_MAX, rate=N, cov=cov, seed=seed,
+                           timing='continuous')
+    return source.observe(1, as_batch=True)
+
+
+def measure(func, repeats):
+    """
+    Returns the best wall time of ``repeats`` calls of ``func`` and the
+    peak memory traced during one additional call.
+    """
+    times = []
+    for __ in range(repeats):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    tracemalloc.start()
+    func()
+    __, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'time': min(times), 'peak_memory': peak}
+
+
+def import_package():
+    """
+    Imports the package in a fresh interpreter. Raises if the import loads
+    scipy, which must only be loaded when a distribution needs it.
+    """
+    subprocess.check_call([
+        sys.executable, '-c',
+        "import sys, simulator; assert 'scipy' not in sys.modules"])
+
+
+def cases(events, plates, max_elements):
+    """
+    Yields the name, parameters and the function of each benchmark case.
+    Cases with more than ``max_elements`` (event, plate) pairs are skipped
+    and yielded with a ``None`` function.
+    """
+    yield 'import', {}, import_package
+    for N in events:
+        for cov in (None, COV):
+            source = PoissonSource(THETA_MAX, rate=N, cov=cov,
+                                   timing='continuous')
+            params = {'Nevents': N,
+                      'flux': 'isotropic' if cov is None else 'anisotropic'}
+            yield 'observe', params, (lambda s=source: s.observe(
+                1, as_batch=True))
+
+    reconstructor = Reconstructor()
+    for N in events:
+        batch = make_events(N)
+        for Nplates in plates:
+            params = {'Nevents': N, 'Nplates': Nplates}
+            if len(batch) * Nplates > max_elements:
+                for name in ('evaluate_events', 'reconstruct', 'find_tracks'):
+                    yield name, params, None
+                continue
+            detector = make_detector(Nplates)
+            hits = detector.evaluate_batch(batch)
+            if N == PER_EVENT_EVENTS:
+                dicts = batch.to_dicts()
+                data = detector.evaluate_events(dicts)
+                yield 'evaluate_per_event', params, (
+                    lambda d=detector, e=dicts: d.evaluate_events(e))
+                yield 'reconstruct_per_event', params, (
+                    lambda x=data: reconstructor.reconstruct(x))
+            yield 'evaluate_events', params, (
+                lambda d=detector, b=batch: d.evaluate_events(b))
+            yield 'reconstruct', params, (
+                lambda h=hits: reconstructor.reconstruct_batch(h))
+            stream = detector.evaluate_stream(batch)
+            yield 'find_tracks', params, (
+                lambda s=stream, P=Nplates: reconstructor.find_tracks(
+                    s, Nplates=P))
+
+
+def git_commit():
+    """Returns the current git commit or ``None``."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def key(result):
+    """Returns a hashable identifier of a benchmark case."""
+    return (result['name'], tuple(sorted(result['params'].items())))
+
+
+def compare(results, fname):
+    """Prints the time and memory ratios with respect to a saved run."""
+    with open(fname, 'r') as f:
+        baseline = {key(res): res for res in json.load(f)['results']}
+    print('\nComparison with {} (new / old):'.format(fname))
+    for res in results:
+        old = baseline.get(key(res))
+        if old is None or res.get('skipped') or old.get('skipped'):
+            continue
+        print('{:>21} {}: time {:.2f}x, memory {:.2f}x'.format(
+            res['name'], res['params'], res['time'] / old['time'],
+            res['peak_memory'] / max(old['peak_memory'], 1)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the benchmarks.')
+    parser.add_argument('--quick', action='store_true',
+                        help='Run only the small cases.')
+    parser.add_argument('--repeats', default=3, type=int)
+    parser.add_argument('--max-elements', default=2 * 10**7, type=int,
+                        help='Skip cases with more (event, plate) pairs.')
+    parser.add_argument('--output', default=None, type=str,
+                        help='JSON file to save the results to.')
+    parser.add_argument('--compare', default=None, type=str,
+                        help='JSON file of a previous run to compare to.')
+    args = parser.parse_args(argv)
+
+    events = QUICK_EVENTS if args.quick else EVENTS
+    plates = QUICK_PLATES if args.quick else PLATES
+    results = []
+    for name, params, func in cases(events, plates, args.max_elements):
+        if func is None:
+            print('{:>21} {}: skipped, above --max-elements'.format(
+                name, params))
+            results.append({'name': name, 'params': params, 'skipped': True})
+            continue
+        res = dict(name=name, params=params,
+                   **measure(func, args.repeats))
+        print('{:>21} {}: {:.4f} s, {:.1f} MB'.format(
+            name, params, res['time'], res['peak_memory'] / 1024**2))
+        results.append(res)
+
+    if args.output is not None:
+        metadata = {'commit': git_commit(), 'numpy': numpy.__version__,
+                    'python': platform.python_version(),
+                    'machine': platform.machine(), 'repeats': args.repeats}
+        with open(args.output, 'w') as f:
+            json.dump({'metadata': metadata, 'results': results}, f,
+                      indent=1)
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,21 @@ boundaries = {'x': (-10, 10), 'y': (-10, 10)}
 z0 = 30
 # Detector spacing
 dz = 5
+# Number of detectors
+Nplates = 5
+# Detector rotation angle (degrees)
+phi = 0
 # Number of pixels
 Npixs = 2000
 # Max opening polar angle
 theta_max = 10
+# Source emission rate
+rate = 1000
+# Random seed
+seed = 2021
 
+# Detector plates' parameters
+plates = [{'bounds': boundaries, 'Npixs': Npixs, 'z': z0 + i * dz,
+           'phi': phi} for i in range(Nplates)]
 
-simulation_fname = './data/events.npy'
+simulation_fname = './data/events'
@@ -1,46 +1,120 @@
 """Runs the simulations and outputs data."""
 
-import numpy
 import argparse
+import json
+import os
+from time import perf_counter
 
-from simulator import Detector, Generator
+import numpy
+from simulator import (PoissonSource, Detector, Reconstructor, EventBatch)
+from simulator.checkpoint import (Checkpointer, load_checkpoint,
+                                  restore_run, run_state)
+from simulator.parallel import ParallelRunner
+from simulator.precision import (POLICIES, set_precision)
+from simulator.store import StoreWriter
+from simulator.summary import TrackSummary
 
 import setup
 
 
-# Parse terminal inputs
-parser = argparse.ArgumentParser(description='Runs the particle simulation.')
-parser.add_argument('--Nevents', default=1000, type=int)
-
-args = parser.parse_args()
-
-# Initialise the generator and the detector
-generator = Generator(setup.theta_max)
-detectors = [Detector(setup.boundaries, setup.Npixs, setup.z0 + i * setup.dz)
-             for i in range(5)]
-
-# Get some number of events
-events = generator.generate(args.Nevents)
-
-data_names = ['xpixel', 'ypixel', 't', 'z']
-ID_names = ['detectorID', 'eventID']
-names = data_names + ID_names
-formats = ['float64'] * 4 + ['int64'] * 2
-out = numpy.zeros(args.Nevents * len(detectors),
-                  dtype={'names': names, 'formats': formats})
-
-# Processes each event at each detector and saves as numpy array
-i = 0
-for event in events:
-    eventID = hash(frozenset(event.values()))
-    for detector in detectors:
-        collision = detector.evaluate_collision(event)
-        detectorID = hash(frozenset(collision.values()))
-        for name in data_names:
-            out[name][i] = collision[name]
-        out['detectorID'][i] = detectorID
-        out['eventID'][i] = eventID
-        i += 1
-
-numpy.save(setup.simulation_fname, out)
-print('Finished simulating the events.')
+def parse_args(argv=None):
+    """Parses the terminal inputs."""
+    parser = argparse.ArgumentParser(
+        description='Runs the particle simulation.')
+    parser.add_argument('--observe-time', default=10., type=float,
+                        help='Observation time of the source.')
+    parser.add_argument('--chunk-size', default=10000, type=int,
+                        help='Expected number of events per chunk.')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of worker processes.')
+    parser.add_argument('--output', default=setup.simulation_fname,
+                        type=str, help='Output store directory.')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='Whether to overwrite an existing output.')
+    parser.add_argument('--precision', default='float64',
+                        choices=list(POLICIES),
+                        help='Floating point precision of the positions.')
+    parser.add_argument('--checkpoint', default=None, type=str,
+                        help='Checkpoint file, by default inside the output.')
+    parser.add_argument('--checkpoint-interval', default=60., type=float,
+                        help='Minimum time in seconds between checkpoints.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Whether to resume from the checkpoint.')
+    return parser.parse_args(argv)
+
+
+def print_throughput(Nevents, timings, wall):
+    """Prints the events/s of each stage and of the whole run."""
+    print('Simulated {} events in {:.2f} s.'.format(Nevents, wall))
+    for stage, time in timings.items():
+        rate = Nevents / time if time > 0 else float('inf')
+        print('{:>16}: {:12.1f} events/s ({:.2f} s)'.format(stage, rate,
+                                                            time))
+    print('{:>16}: {:12.1f} events/s'.format('total', Nevents / wall))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    set_precision(args.precision)
+    # Initialise the source, the detector and the reconstructor
+    source = PoissonSource(setup.theta_max, rate=setup.rate, seed=setup.seed)
+    detector = Detector(setup.plates)
+    runner = ParallelRunner(source, detector, Reconstructor(),
+                            period=args.chunk_size / setup.rate,
+                            workers=args.workers)
+    # The shards depend on these, so a resumed run must keep them
+    run_args = {'observe_time': args.observe_time,
+                'chunk_size': args.chunk_size, 'precision': args.precision}
+    fname = args.checkpoint
+    if fname is None:
+        fname = os.path.join(args.output, 'checkpoint.json')
+    checkpointer = Checkpointer(fname, interval=args.checkpoint_interval)
+
+    summary = TrackSummary()
+    next_shard = 0
+    if args.resume:
+        state = load_checkpoint(fname)
+        if state['args'] != run_args:
+            raise ValueError("The checkpoint is of a run with arguments {}."
+                             .format(state['args']))
+        nrows, next_shard = restore_run(state, source, detector)
+        writer = StoreWriter.resume(args.output, nrows)
+        summary = TrackSummary.from_dict(state['summary'])
+    else:
+        writer = StoreWriter(args.output, overwrite=args.overwrite)
+        # Detector IDs are the plates' indices along the hits' second axis
+        with open(os.path.join(args.output, 'detector.json'), 'w') as f:
+            json.dump([dict(plate, detectorID=i)
+                       for i, plate in enumerate(setup.plates)], f)
+
+    def get_state():
+        return run_state(source, detector, writer, next_shard,
+                         args=run_args, summary=summary.to_dict())
+
+    start = perf_counter()
+    write_time = 0.
+    eventID = first_row = writer.nrows
+    for index, (events, hits, tracks) in runner.iter_run(args.observe_time,
+                                                         start=next_shard):
+        t0 = perf_counter()
+        # Event IDs are counted across chunks and match the store's rows
+        N = len(events)
+        columns = {p: events[p] for p in events.columns}
+        columns['eventID'] = numpy.arange(eventID, eventID + N)
+        eventID += N
+        writer.append(events=EventBatch(columns), hits=hits, tracks=tracks)
+        summary.update(tracks)
+        next_shard = index + 1
+        checkpointer.update(get_state)
+        write_time += perf_counter() - t0
+    wall = perf_counter() - start
+    checkpointer.save(get_state())
+    summary.save(os.path.join(args.output, 'summary.json'))
+
+    timings = dict(runner.timings, writing=write_time)
+    print_throughput(writer.nrows - first_row, timings, wall)
+    print('Finished simulating the events.')
+
+
+if __name__ == '__main__':
+    main()
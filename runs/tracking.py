@@ -0,0 +1,44 @@
+"""Finds tracks in unlabelled hit streams of increasing source rates."""
+
+import argparse
+from time import perf_counter
+
+from simulator import (PoissonSource, Detector, Reconstructor)
+
+import setup
+
+
+def parse_args(argv=None):
+    """Parses the terminal inputs."""
+    parser = argparse.ArgumentParser(
+        description='Reports the track finding quality against the rate.')
+    parser.add_argument('--rates', default=[1e2, 1e3, 1e4, 1e5], type=float,
+                        nargs='+', help='Source emission rates.')
+    parser.add_argument('--observe-time', default=1., type=float,
+                        help='Observation time of the source.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    detector = Detector(setup.plates)
+    reconstructor = Reconstructor()
+    print('{:>12}{:>10}{:>10}{:>12}{:>12}{:>12}{:>12}'.format(
+        'rate', 'hits', 'tracks', 'efficiency', 'fake rate', 'merged rate',
+        'hits/s'))
+    for rate in args.rates:
+        source = PoissonSource(setup.theta_max, rate=rate, seed=setup.seed,
+                               timing='continuous')
+        stream = detector.evaluate_stream(
+            source.observe(args.observe_time, as_batch=True))
+        start = perf_counter()
+        tracks = reconstructor.find_tracks(stream, Nplates=setup.Nplates)
+        wall = perf_counter() - start
+        report = reconstructor.track_report(stream, tracks)
+        print('{:>12g}{:>10}{:>10}{:>12.4f}{:>12.4f}{:>12.4f}{:>12.0f}'.format(
+            rate, len(stream), report['tracks'], report['efficiency'],
+            report['fake_rate'], report['merged_rate'], len(stream) / wall))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,9 @@
 __version__ = "0.1.0"
 __author__ = "Richard Stiskalek"
 
-from .generation import (PoissonSource, TruncatedGaussian)
+from .batch import (ColumnBatch, EventBatch, HitBatch, TrackBatch,
+                    HitStream)
+from .generation import (PoissonSource, TruncatedGaussian,
+                         TabulatedDistribution)
 from .detector import Detector
 from .reconstruction import Reconstructor
@@ -0,0 +1,215 @@
+"""Precomputed geometric acceptance and resolution maps of a detector."""
+import json
+import os
+import warnings
+
+import numpy
+
+from .batch import (EventBatch, TrackBatch)
+from .cache import cache_fname
+from .reconstruction import Reconstructor
+
+# Reconstructed quantities whose smearing is tabulated
+SMEARED = ('theta', 'phi', 'v')
+
+
+class AcceptanceMap:
+    r"""
+    Acceptance and pixel smearing of a detector tabulated on a grid of
+    track directions ``(theta, phi)``, for tracks emitted from the origin.
+    Per cell stores the probability that each plate is hit and the bias and
+    scatter of the reconstructed ``theta``, ``phi`` and relative speed
+    ``v_rec / v - 1``. The pixel smearing of the direction and of the
+    relative speed does not depend on the speed, as the positions are
+    snapped while the times are exact.
+
+    Build it with :py:meth:`build` and use it through
+    :py:meth:`simulator.Detector.fast_simulate`.
+
+    Parameters
+    ----------
+    theta_edges : numpy.ndarray
+        Polar angle bin edges in radians.
+    phi_edges : numpy.ndarray
+        Azimuthal angle bin edges in radians, spanning ``[-pi, pi]``.
+    acceptance : numpy.ndarray
+        Hit probabilities of shape ``(Ntheta, Nphi, Nplates)``.
+    bias : numpy.ndarray
+        Mean reconstruction errors of shape ``(Ntheta, Nphi, 3)``, ordered
+        as ``theta``, ``phi``, ``v``.
+    scatter : numpy.ndarray
+        Standard deviations of the reconstruction errors, same shape as
+        ``bias``.
+    plates : list of dicts
+        Parameters of the detector's plates.
+    """
+
+    def __init__(self, theta_edges, phi_edges, acceptance, bias, scatter,
+                 plates):
+        self.theta_edges = numpy.asarray(theta_edges, dtype=float)
+        self.phi_edges = numpy.asarray(phi_edges, dtype=float)
+        shape = (self.theta_edges.size - 1, self.phi_edges.size - 1)
+        self.acceptance = numpy.asarray(acceptance, dtype=float)
+        self.bias = numpy.asarray(bias, dtype=float)
+        self.scatter = numpy.asarray(scatter, dtype=float)
+        if self.acceptance.shape[:2] != shape:
+            raise ValueError("``acceptance`` must have shape {} + (Nplates,)."
+                             .format(shape))
+        for arr in (self.bias, self.scatter):
+            if arr.shape != shape + (len(SMEARED), ):
+                raise ValueError("``bias`` and ``scatter`` must have shape {}."
+                                 .format(shape + (len(SMEARED), )))
+        self.plates = plates
+
+    @classmethod
+    def build(cls, detector, theta_max, Ntheta=32, Nphi=64, samples=256,
+              deg=True, seed=2021, cache_dir=None):
+        """
+        Tabulates the acceptance of ``detector`` up to ``theta_max`` by
+        sampling ``samples`` directions uniformly within each cell and
+        evaluating the full geometry. The map is cached on disk by a hash
+        of the plates and the grid parameters.
+
+        Parameters
+        ----------
+        detector : :py:class:`simulator.Detector`
+            The detector.
+        theta_max : float
+            Maximum polar angle of the map.
+        Ntheta, Nphi : int (optional)
+            Number of polar and azimuthal angle bins.
+        samples : int (optional)
+            Number of sampled directions per cell.
+        deg : bool (optional)
+            Whether ``theta_max`` is in degrees.
+        seed : int (optional)
+            Random seed of the sampled directions.
+        cache_dir : str or bool (optional)
+            Cache directory. By default
+            :py:func:`simulator.cache.default_cache_dir`, ``False``
+            disables caching.
+        """
+        params = {'plates': detector.config, 'theta_max': theta_max,
+                  'Ntheta': Ntheta, 'Nphi': Nphi, 'samples': samples,
+                  'deg': deg, 'seed': seed}
+        fname = None
+        if cache_dir is not False:
+            fname = cache_fname(cache_dir, 'acceptance', params)
+            if os.path.exists(fname):
+                return cls.load(fname)
+
+        if deg:
+            theta_max = numpy.deg2rad(theta_max)
+        theta_edges = numpy.linspace(0, theta_max, Ntheta + 1)
+        phi_edges = numpy.linspace(-numpy.pi, numpy.pi, Nphi + 1)
+        gen = numpy.random.default_rng(seed)
+        reconstructor = Reconstructor()
+        shape = (Ntheta, Nphi)
+        acceptance = numpy.empty(shape + (len(detector.plates), ))
+        bias = numpy.empty(shape + (len(SMEARED), ))
+        scatter = numpy.empty_like(bias)
+        # One polar angle row at a time to bound the memory
+        N = Nphi * samples
+        for i in range(Ntheta):
+            # Uniform in solid angle within the cells
+            cos = gen.uniform(numpy.cos(theta_edges[i + 1]),
+                              numpy.cos(theta_edges[i]), N)
+            theta = numpy.arccos(cos)
+            phi = (numpy.repeat(phi_edges[:-1], samples)
+                   + gen.uniform(0, 1, N) * numpy.diff(phi_edges)[0])
+            sin = numpy.sin(theta)
+            events = EventBatch({'vx': sin * numpy.cos(phi),
+                                 'vy': sin * numpy.sin(phi), 'vz': cos,
+                                 't': numpy.zeros(N), 'x0': numpy.zeros(N),
+                                 'y0': numpy.zeros(N), 'z0': numpy.zeros(N)})
+            hits = detector.evaluate_batch(events)
+            tracks = reconstructor.reconstruct_batch(hits)
+            acceptance[i] = hits['hit'].reshape(Nphi, samples, -1).mean(1)
+
+            errors = numpy.stack(
+                [tracks['theta'] - theta,
+                 # Wrap the azimuthal error to [-pi, pi)
+                 (tracks['phi'] - phi + numpy.pi) % (2 * numpy.pi)
+                 - numpy.pi,
+                 tracks['v'] - 1], axis=-1).reshape(Nphi, samples, -1)
+            with warnings.catch_warnings():
+                # Cells without reconstructable tracks give NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                bias[i] = numpy.nanmean(errors, axis=1)
+                scatter[i] = numpy.nanstd(errors, axis=1)
+        # Such cells carry no smearing
+        numpy.nan_to_num(bias, copy=False)
+        numpy.nan_to_num(scatter, copy=False)
+
+        out = cls(theta_edges, phi_edges, acceptance, bias, scatter,
+                  detector.config)
+        if fname is not None:
+            out.save(fname)
+        return out
+
+    def save(self, fname):
+        """Saves the map to a ``.npz`` file."""
+        with open(fname + '.tmp', 'wb') as f:
+            numpy.savez(f, theta_edges=self.theta_edges,
+                        phi_edges=self.phi_edges, acceptance=self.acceptance,
+                        bias=self.bias, scatter=self.scatter,
+                        plates=json.dumps(self.plates))
+        os.replace(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a map saved by :py:meth:`save`."""
+        with numpy.load(fname) as f:
+            return cls(f['theta_edges'], f['phi_edges'], f['acceptance'],
+                       f['bias'], f['scatter'], json.loads(str(f['plates'])))
+
+    def lookup(self, theta, phi):
+        """
+        Returns the polar and azimuthal cell indices of the directions and a
+        mask of the directions within the map.
+        """
+        i = numpy.searchsorted(self.theta_edges, theta, side='right') - 1
+        j = numpy.searchsorted(self.phi_edges, phi, side='right') - 1
+        Ntheta, Nphi = self.acceptance.shape[:2]
+        inside = (0 <= i) & (i < Ntheta)
+        # phi = pi belongs to the last cell
+        j = numpy.clip(j, 0, Nphi - 1)
+        return numpy.where(inside, i, 0), j, inside
+
+    def simulate(self, events, seed=None):
+        """
+        Simulates the reconstructed tracks of ``events``, a
+        :py:class:`simulator.batch.EventBatch` emitted from the origin.
+        Plate hits are drawn with the tabulated probabilities using one
+        uniform number per event, so that a track hitting a plate with a
+        small acceptance also hits those with a larger one. The
+        reconstructed angles and speed are smeared by Gaussians with the
+        tabulated bias and scatter. Directions outside the map are missed.
+
+        Returns a :py:class:`simulator.batch.TrackBatch` with an extra
+        ``hit`` column of shape ``(Nevents, Nplates)``.
+        """
+        gen = numpy.random.default_rng(seed)
+        v = numpy.sqrt(events['vx']**2 + events['vy']**2 + events['vz']**2)
+        true = Reconstructor.ang_dist({'vx': events['vx'], 'vy': events['vy'],
+                                       'vz': events['vz'], 'v': v})
+        i, j, inside = self.lookup(true['theta'], true['phi'])
+        hit = (gen.uniform(size=(len(events), 1)) < self.acceptance[i, j])
+        hit &= inside[:, None]
+        nhits = hit.sum(axis=1)
+
+        smear = self.bias[i, j] + self.scatter[i, j] * gen.standard_normal(
+            (len(events), len(SMEARED)))
+        theta = true['theta'] + smear[:, 0]
+        phi = true['phi'] + smear[:, 1]
+        speed = v * (1 + smear[:, 2])
+        speed[nhits < 2] = numpy.nan
+        out = {'v': speed, 'phi': phi, 'theta': theta, 'nhits': nhits,
+               'hit': hit}
+        sin = numpy.sin(theta)
+        out.update({'vx': speed * sin * numpy.cos(phi),
+                    'vy': speed * sin * numpy.sin(phi),
+                    'vz': speed * numpy.cos(theta)})
+        for p in ('phi', 'theta'):
+            out[p][nhits < 2] = numpy.nan
+        return TrackBatch(out)
@@ -0,0 +1,166 @@
+"""Columnar (struct-of-arrays) containers for simulated data."""
+import numpy
+
+
+class ColumnBatch:
+    r"""
+    A struct-of-arrays container. Every column is a NumPy array whose first
+    axis runs over the events in the batch, so that column access, slicing
+    and concatenation never go through per-event Python objects.
+
+    Parameters
+    ----------
+    columns : dict
+        Column names and their arrays. All arrays must have the same length
+        along the first axis.
+    """
+    _required = ()
+
+    def __init__(self, columns):
+        self._columns = {}
+        size = None
+        for name, column in columns.items():
+            column = numpy.asarray(column)
+            if column.ndim == 0:
+                raise ValueError("Column ``{}`` must be an array."
+                                 .format(name))
+            if size is None:
+                size = column.shape[0]
+            elif column.shape[0] != size:
+                raise ValueError("Column ``{}`` has length {}, expected {}."
+                                 .format(name, column.shape[0], size))
+            self._columns[name] = column
+        missing = [p for p in self._required if p not in self._columns]
+        if missing:
+            raise ValueError("Missing columns: {}".format(missing))
+        self._size = 0 if size is None else size
+
+    @property
+    def columns(self):
+        """Returns the column names."""
+        return tuple(self._columns.keys())
+
+    @property
+    def nbytes(self):
+        """Returns the total number of bytes held by the columns."""
+        return sum(column.nbytes for column in self._columns.values())
+
+    def keys(self):
+        """Returns the column names."""
+        return self._columns.keys()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def __getitem__(self, key):
+        """
+        Returns a column if ``key`` is a string (no copy is made), a dict
+        with a single event if ``key`` is an integer and a new batch of the
+        same type otherwise. Slices return views of the columns.
+        """
+        if isinstance(key, str):
+            return self._columns[key]
+        if isinstance(key, (int, numpy.integer)):
+            return {p: column[key] for p, column in self._columns.items()}
+        return type(self)({p: column[key]
+                           for p, column in self._columns.items()})
+
+    def __iter__(self):
+        """Iterates over the events as dicts. Slow, kept for convenience."""
+        for i in range(self._size):
+            yield self[i]
+
+    def __repr__(self):
+        return "<{} with {} events and columns {}>".format(
+            type(self).__name__, self._size, list(self.columns))
+
+    def to_dicts(self):
+        """Returns the batch as a list of per-event dicts."""
+        return list(iter(self))
+
+    @classmethod
+    def concatenate(cls, batches):
+        """
+        Concatenates a sequence of batches along the event axis. All batches
+        must share the same columns.
+        """
+        batches = list(batches)
+        if not batches:
+            raise ValueError("Cannot concatenate an empty sequence.")
+        names = batches[0].columns
+        for batch in batches[1:]:
+            if set(batch.columns) != set(names):
+                raise ValueError("Batches must share the same columns.")
+        return cls({p: numpy.concatenate([batch[p] for batch in batches])
+                    for p in names})
+
+
+class EventBatch(ColumnBatch):
+    r"""
+    A batch of generated events. Stores the velocity components ``vx``,
+    ``vy`` and ``vz``, the emission time ``t`` and the emission point ``x0``,
+    ``y0`` and ``z0``, each as a 1-dimensional array.
+
+    Parameters
+    ----------
+    columns : dict
+        Column names and their arrays.
+    """
+    _required = ('vx', 'vy', 'vz', 't', 'x0', 'y0', 'z0')
+
+
+class HitBatch(ColumnBatch):
+    r"""
+    A batch of detector hits. Stores the snapped pixel centre ``x``, ``y``
+    and ``z``, the hit time ``t``, the pixel indices ``xpixel`` and
+    ``ypixel``, the flat pixel ID ``pixel = ypixel * Npixs + xpixel`` and
+    the boolean mask ``hit`` of the plates that were hit, each as an array
+    of shape ``(Nevents, Nplates)``. Misses have ``NaN`` positions and
+    times and pixel indices of -1.
+
+    Parameters
+    ----------
+    columns : dict
+        Column names and their arrays.
+    """
+    _required = ('x', 'y', 'z', 't', 'xpixel', 'ypixel', 'pixel', 'hit')
+
+    @property
+    def Nplates(self):
+        """Returns the number of detector plates."""
+        return self['t'].shape[1]
+
+
+class TrackBatch(ColumnBatch):
+    r"""
+    A batch of reconstructed tracks. Stores the speed ``v``, the velocity
+    components ``vx``, ``vy`` and ``vz``, the angles ``phi`` and ``theta``
+    and the number of hit plates ``nhits``, each as a 1-dimensional array.
+    Tracks with fewer than two hits have ``NaN`` velocities.
+
+    Parameters
+    ----------
+    columns : dict
+        Column names and their arrays.
+    """
+    _required = ('v', 'vx', 'vy', 'vz', 'phi', 'theta', 'nhits')
+
+
+class HitStream(ColumnBatch):
+    r"""
+    A flat, time-ordered stream of detector hits without event grouping.
+    Stores the index of the hit ``plate``, the snapped pixel centre ``x``,
+    ``y`` and ``z``, the hit time ``t`` and the pixel indices ``xpixel``,
+    ``ypixel`` and ``pixel``, each as a 1-dimensional array. Simulated
+    streams may also carry the true ``event`` of each hit, which is only
+    used to evaluate track finding.
+
+    Parameters
+    ----------
+    columns : dict
+        Column names and their arrays.
+    """
+    _required = ('plate', 'x', 'y', 'z', 't', 'xpixel', 'ypixel', 'pixel')
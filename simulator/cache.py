@@ -0,0 +1,39 @@
+"""On-disk caching of precomputed tables keyed by their parameters."""
+import hashlib
+import json
+import os
+
+# Environment variable that overrides the default cache directory
+CACHE_ENV = 'SIMULATOR_CACHE_DIR'
+
+
+def default_cache_dir():
+    """
+    Returns the default cache directory, ``$SIMULATOR_CACHE_DIR`` if set
+    and ``~/.cache/simulator`` otherwise.
+    """
+    return os.environ.get(CACHE_ENV, os.path.join(
+        os.path.expanduser('~'), '.cache', 'simulator'))
+
+
+def hash_parameters(params):
+    """
+    Returns a hex digest of ``params``, which must be JSON serializable.
+    Keys of dicts are sorted so that the digest does not depend on their
+    order.
+    """
+    dump = json.dumps(params, sort_keys=True, default=repr)
+    return hashlib.sha1(dump.encode('utf-8')).hexdigest()
+
+
+def cache_fname(cache_dir, prefix, params, ext='.npz'):
+    """
+    Returns the cache file name of a table described by ``params``. If
+    ``cache_dir`` is ``None`` uses :py:func:`default_cache_dir` and creates
+    it if needed.
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, '{}_{}{}'.format(
+        prefix, hash_parameters(params), ext))
@@ -0,0 +1,93 @@
+"""Checkpointing and resuming of long simulation runs."""
+import json
+import os
+from time import perf_counter
+
+
+def save_checkpoint(fname, state):
+    """
+    Writes ``state``, a JSON serializable dict, to ``fname`` atomically and
+    durably, so that a crash leaves either the old or the new checkpoint.
+    """
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(fname + '.tmp', fname)
+
+
+def load_checkpoint(fname):
+    """Reads a checkpoint written by :py:func:`save_checkpoint`."""
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+
+def run_state(source, detector, writer, next_shard, **extra):
+    """
+    Returns the state of a run: the source's parameters, clock and random
+    generator state, the detector's configuration, the number of rows of
+    the output store and the index of the next shard to simulate. Other
+    JSON serializable entries are passed as ``extra``.
+
+    Sharded runs, e.g. of a :py:class:`simulator.parallel.ParallelRunner`,
+    only observe copies of the source returned by ``source.shard``, so its
+    clock and random generator state stay at their initial values. Such
+    runs resume by the index of the next shard, and the source's state only
+    checks that its parameters, including the momentum distribution, are
+    unchanged.
+    """
+    state = {'source': source.get_state(), 'detector': detector.config,
+             'nrows': writer.nrows, 'next_shard': next_shard}
+    state.update(extra)
+    return state
+
+
+def restore_run(state, source, detector):
+    """
+    Restores the source of a run from its ``state`` and checks that the
+    detector has the checkpointed configuration. Returns the number of rows
+    of the output store and the index of the next shard.
+    """
+    if state['detector'] != detector.config:
+        raise ValueError("The checkpoint is of a different detector.")
+    source.set_state(state['source'])
+    return state['nrows'], state['next_shard']
+
+
+class Checkpointer:
+    r"""
+    Saves checkpoints at most every ``interval`` seconds. The state is only
+    built when a checkpoint is due, so calling :py:meth:`update` after
+    every chunk costs a clock read.
+
+    Parameters
+    ----------
+    fname : str
+        Checkpoint file.
+    interval : float (optional)
+        Minimum time in seconds between checkpoints.
+    """
+
+    def __init__(self, fname, interval=60.):
+        if not interval >= 0:
+            raise ValueError("``interval`` must be non-negative.")
+        self.fname = fname
+        self.interval = interval
+        self.nsaved = 0
+        self._last = perf_counter()
+
+    def save(self, state):
+        """Saves a checkpoint of ``state``."""
+        save_checkpoint(self.fname, state)
+        self.nsaved += 1
+        self._last = perf_counter()
+
+    def update(self, get_state):
+        """
+        Saves a checkpoint of ``get_state()`` if the interval has passed
+        since the last one. Returns whether a checkpoint was saved.
+        """
+        if perf_counter() - self._last < self.interval:
+            return False
+        self.save(get_state())
+        return True
@@ -1,6 +1,11 @@
 """Classes for handling the detectors and pixels in the simulation"""
 import numpy
 
+from .batch import (EventBatch, HitBatch, HitStream)
+from .precision import get_precision
+from .profiling import instrument
+from .readout import OccupancyFrames
+
 
 class DetectorPlate:
     r"""A detector plate to be installed in the detector.
@@ -37,6 +42,23 @@ class DetectorPlate:
         self._rotmat = numpy.array([[cphi, -sphi],
                                     [sphi, cphi]])
 
+    def _build_geometry(self):
+        """
+        Caches the pixel geometry so that it is not recomputed per call.
+        Called whenever ``bnds`` or ``Npixs`` is set, once both are.
+        """
+        if self._bnds is None or self._Npixs is None:
+            return
+        self._origin = numpy.array([self.bnds[p][0] for p in ('x', 'y')],
+                                   dtype=float)
+        self._upper = numpy.array([self.bnds[p][1] for p in ('x', 'y')],
+                                  dtype=float)
+        self._pitch = (self._upper - self._origin) / self.Npixs
+        self._inv_pitch = 1 / self._pitch
+        self._centres = {p: self._origin[k] + self._pitch[k]
+                         * (numpy.arange(self.Npixs) + 0.5)
+                         for k, p in enumerate(('x', 'y'))}
+
     @property
     def Npixs(self):
         """Returns the number of pixels in this detector."""
@@ -48,6 +70,7 @@ class DetectorPlate:
         if not isinstance(Npixs, int):
             raise ValueError("``Npixs`` must be an integer.")
         self._Npixs = Npixs
+        self._build_geometry()
 
     @property
     def bnds(self):
@@ -72,6 +95,7 @@ class DetectorPlate:
             if len(bnd) != 2:
                 raise ValueError("Specific boundaries must have length 2.")
             self._bnds[par] = sorted(bnd)
+        self._build_geometry()
 
     @property
     def z(self):
@@ -97,6 +121,17 @@ class DetectorPlate:
             raise ValueError("``phi`` must be a float.")
         self._phi = phi
 
+    @property
+    def config(self):
+        """Returns the plate's parameters as passed to the constructor."""
+        return {'bounds': {p: list(bnd) for p, bnd in self.bnds.items()},
+                'Npixs': self.Npixs, 'z': self.z, 'phi': self.phi}
+
+    @property
+    def pitch(self):
+        """Returns the pixel widths along the ``x`` and ``y`` axes."""
+        return self._pitch
+
     def pixelID2coordinates(self, IDs):
         """
         Returns the Cartesian coordinates ``i``-th horizontal and ``j``-th
@@ -106,10 +141,8 @@ class DetectorPlate:
         if not (0 <= i < self.Npixs and 0 <= j < self.Npixs):
             raise ValueError("Invalid pixel ID.")
         # Remember that i, j run from 0, 1, ..., Npixs - 1.
-        xbnd = self.bnds['x']
-        ybnd = self.bnds['y']
-        return {'x': (xbnd[1] - xbnd[0]) / self.Npixs * (i + 0.5) + xbnd[0],
-                'y': (ybnd[1] - ybnd[0]) / self.Npixs * (j + 0.5) + ybnd[0],
+        return {'x': self._pitch[0] * (i + 0.5) + self._origin[0],
+                'y': self._pitch[1] * (j + 0.5) + self._origin[1],
                 'z': self.z}
 
     def coordinates2pixelID(self, coords):
@@ -118,16 +151,45 @@ class DetectorPlate:
         coordinates. Checks that both are within the detector area.
         """
         IDs = {}
-        for par, bnd in self.bnds.items():
-            if not bnd[0] < coords[par] < bnd[1]:
+        for k, par in enumerate(('x', 'y')):
+            if not self._origin[k] < coords[par] < self._upper[k]:
                 raise ValueError("Invalid position.")
-            # Later move these somewhere so they don't get regenerated
-            # every time
-            width = bnd[1] - bnd[0]
-            bins = numpy.arange(bnd[0], bnd[1], width / self.Npixs)
-            IDs['{}pixel'.format(par)] = numpy.digitize(coords[par], bins) - 1
+            ID = numpy.floor((coords[par] - self._origin[k])
+                             * self._inv_pitch[k]).astype(int)
+            IDs['{}pixel'.format(par)] = numpy.minimum(ID, self.Npixs - 1)
         return IDs
 
+    def coordinates2pixel(self, x, y):
+        """
+        Returns the flat pixel IDs ``ypixel * Npixs + xpixel`` of arrays of
+        ``x`` and ``y`` coordinates in the plate's (unrotated) frame. Checks
+        that all points are within the detector area.
+        """
+        x = numpy.asarray(x)
+        y = numpy.asarray(y)
+        if not (numpy.all((self._origin[0] < x) & (x < self._upper[0]))
+                and numpy.all((self._origin[1] < y) & (y < self._upper[1]))):
+            raise ValueError("Invalid position.")
+        # Positions are inside, so truncation is equivalent to flooring
+        i = ((x - self._origin[0]) * self._inv_pitch[0]).astype(numpy.intp)
+        j = ((y - self._origin[1]) * self._inv_pitch[1]).astype(numpy.intp)
+        # Guard against round-off right at the upper edge
+        numpy.minimum(i, self.Npixs - 1, out=i)
+        numpy.minimum(j, self.Npixs - 1, out=j)
+        return j * self.Npixs + i
+
+    def pixel2coordinates(self, pixel):
+        """
+        Returns the ``x`` and ``y`` pixel centres (in the plate's unrotated
+        frame) of an array of flat pixel IDs.
+        """
+        pixel = numpy.asarray(pixel)
+        if not numpy.all((0 <= pixel) & (pixel < self.Npixs**2)):
+            raise ValueError("Invalid pixel ID.")
+        j, i = numpy.divmod(pixel, self.Npixs)
+        return self._centres['x'][i], self._centres['y'][j]
+
+    @instrument('detection.evaluate_collision')
     def evaluate_collision(self, event):
         """
         Evaluates the collision with a simulated event. Returns the ID of
@@ -154,6 +216,188 @@ class DetectorPlate:
         return out
 
 
+class PlateGeometry:
+    r"""
+    Compiled geometry of a set of detector plates. Stores the plates'
+    parameters as contiguous arrays sorted by ``z``, so that collisions with
+    all plates are evaluated with a few broadcasted operations.
+
+    Plates are evaluated in blocks of increasing ``z``. After each block,
+    tracks that can no longer hit any of the remaining plates, because
+    they move away from them or outside of their footprints, are dropped.
+
+    Parameters
+    ----------
+    plates : list of :py:class:`DetectorPlate`
+        The detector plates.
+    block_size : int (optional)
+        Number of plates evaluated at once.
+    """
+
+    def __init__(self, plates, block_size=16):
+        if not isinstance(block_size, int) or block_size < 1:
+            raise ValueError("``block_size`` must be a positive integer.")
+        self.block_size = block_size
+        # Indices of the plates sorted by z
+        self.order = numpy.argsort([plate.z for plate in plates],
+                                   kind='stable')
+        plates = [plates[i] for i in self.order]
+        self.z = numpy.array([plate.z for plate in plates], dtype=float)
+        self.rotmat = numpy.array([plate._rotmat for plate in plates])
+        self.lower = numpy.array([plate._origin for plate in plates])
+        self.upper = numpy.array([plate._upper for plate in plates])
+        self.pitch = numpy.array([plate.pitch for plate in plates])
+        self.inv_pitch = numpy.array([plate._inv_pitch for plate in plates])
+        self.Npixs = numpy.array([plate.Npixs for plate in plates])
+        # Furthest distance of a plate's footprint from the z-axis. The
+        # footprint's corners are rotated about the axis so the distance is
+        # that of the furthest unrotated corner
+        corners = numpy.maximum(numpy.abs(self.lower), numpy.abs(self.upper))
+        radius = numpy.sqrt(numpy.sum(corners**2, axis=1))
+        # Largest footprint among the plates at and beyond each plate
+        self.outer_radius = numpy.maximum.accumulate(radius[::-1])[::-1]
+        # Geometry arrays cast to each floating point type in use
+        self._cast = {}
+
+    @property
+    def Nplates(self):
+        """Returns the number of plates."""
+        return self.z.size
+
+    def _geometry(self, dtype):
+        """
+        Returns the rotation matrices, footprints and pitches cast to
+        ``dtype``, so that arithmetic with arrays of that type is not
+        promoted.
+        """
+        dtype = numpy.dtype(dtype)
+        if dtype not in self._cast:
+            self._cast[dtype] = {
+                p: getattr(self, p).astype(dtype)
+                for p in ('rotmat', 'lower', 'upper', 'pitch', 'inv_pitch')}
+        return self._cast[dtype]
+
+    def _evaluate_block(self, tracks, block):
+        """
+        Evaluates the collisions of ``tracks`` (a dict of arrays) with the
+        sorted plates in the slice ``block``. Returns a dict of arrays of
+        shape ``(N, b)`` with misses filled by sentinels. Positions are
+        computed in the type of the tracks' positions and times in double
+        precision.
+        """
+        dtype = tracks['x0'].dtype
+        geometry = self._geometry(dtype)
+        z = self.z[block]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            dt = (z - tracks['z0'][:, None]) / tracks['vz'][:, None]
+            # Plates must be ahead of the particle
+            hit = dt > 0
+            # Intersections between the particle paths and detector planes
+            flight = dt.astype(dtype, copy=False)
+            x = tracks['x0'][:, None] + tracks['vx'][:, None] * flight
+            y = tracks['y0'][:, None] + tracks['vy'][:, None] * flight
+        # Rotate the intersections so that detector edges || axes. This is
+        # the inverse rotation, see DetectorPlate.evaluate_collision
+        rotmat = geometry['rotmat'][block]
+        coords = (rotmat[:, 0, 0] * x + rotmat[:, 1, 0] * y,
+                  rotmat[:, 0, 1] * x + rotmat[:, 1, 1] * y)
+        lower = geometry['lower'][block]
+        upper = geometry['upper'][block]
+        with numpy.errstate(invalid='ignore'):
+            for k in range(2):
+                hit &= (lower[:, k] < coords[k]) & (coords[k] < upper[:, k])
+        miss = ~hit
+        Npixs = self.Npixs[block]
+        pixels = []
+        centres = []
+        for k in range(2):
+            # Misses are mapped to the first pixel and masked below
+            coord = numpy.where(hit, coords[k], lower[:, k])
+            pixel = ((coord - lower[:, k])
+                     * geometry['inv_pitch'][block, k]).astype(numpy.intp)
+            # Guard against round-off right at the upper edge
+            numpy.minimum(pixel, Npixs - 1, out=pixel)
+            centres.append(geometry['pitch'][block, k]
+                           * (pixel.astype(dtype) + 0.5) + lower[:, k])
+            pixel[miss] = -1
+            pixels.append(pixel)
+        # Rotate the pixel centres back
+        xc, yc = centres
+        out = {'x': rotmat[:, 0, 0] * xc + rotmat[:, 0, 1] * yc,
+               'y': rotmat[:, 1, 0] * xc + rotmat[:, 1, 1] * yc,
+               'z': numpy.where(hit, z, numpy.nan),
+               't': tracks['t'][:, None] + dt,
+               'xpixel': pixels[0], 'ypixel': pixels[1],
+               'pixel': numpy.where(hit, pixels[1] * Npixs + pixels[0], -1),
+               'hit': hit}
+        for p in ('x', 'y', 't'):
+            out[p][miss] = numpy.nan
+        return out
+
+    def evaluate(self, events, strict=False):
+        """
+        Evaluates the collisions of a :py:class:`simulator.batch.EventBatch`
+        with the plates. Returns a dict of arrays of shape
+        ``(Nevents, Nplates)`` in the plates' original order, see
+        :py:meth:`Detector.evaluate_batch`. Positions are of the
+        package-wide :py:class:`simulator.precision.Precision` and times
+        are double precision.
+        """
+        N, P = len(events), self.Nplates
+        policy = get_precision()
+        out = {p: numpy.full((N, P), numpy.nan, dtype=policy.float)
+               for p in ('x', 'y', 'z')}
+        out['t'] = numpy.full((N, P), numpy.nan, dtype=policy.time)
+        for p in ('xpixel', 'ypixel', 'pixel'):
+            out[p] = numpy.full((N, P), -1, dtype=policy.index)
+        out['hit'] = numpy.zeros((N, P), dtype=bool)
+
+        # Indices of the tracks that may still hit a plate, None if all
+        active = None
+        tracks = {p: events[p].astype(policy.float, copy=False)
+                  for p in ('x0', 'y0', 'z0', 'vx', 'vy', 'vz')}
+        tracks['t'] = events['t'].astype(policy.time, copy=False)
+        for start in range(0, P, self.block_size):
+            stop = min(start + self.block_size, P)
+            block = slice(start, stop)
+            res = self._evaluate_block(tracks, block)
+            if strict and not numpy.all(res['hit']):
+                raise ValueError("Invalid position.")
+            rows = slice(None) if active is None else active
+            for p, value in res.items():
+                out[p][rows, block] = value
+            if stop == P:
+                break
+
+            # Drop tracks that cannot hit any of the remaining plates: those
+            # that move away from them or that are outside of every
+            # remaining footprint and moving outwards
+            vz = tracks['vz']
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                dt = (self.z[stop - 1] - tracks['z0']) / vz
+                x = tracks['x0'] + tracks['vx'] * dt
+                y = tracks['y0'] + tracks['vy'] * dt
+            gone = (vz <= 0) & (tracks['z0'] <= self.z[stop])
+            gone |= ((vz > 0) & (x * tracks['vx'] + y * tracks['vy'] >= 0)
+                     & (x**2 + y**2 > self.outer_radius[stop]**2))
+            if numpy.any(gone):
+                # Dropped tracks miss every remaining plate
+                if strict:
+                    raise ValueError("Invalid position.")
+                keep = ~gone
+                active = (numpy.nonzero(keep)[0] if active is None
+                          else active[keep])
+                tracks = {p: x[keep] for p, x in tracks.items()}
+                if active.size == 0:
+                    break
+
+        # Back to the plates' original order
+        if numpy.any(self.order != numpy.arange(P)):
+            inverse = numpy.argsort(self.order)
+            out = {p: x[:, inverse] for p, x in out.items()}
+        return out
+
+
 class Detector:
     r"""
     A simple particle detector consisting of several plates.
@@ -163,18 +407,137 @@ class Detector:
     plates : list of dicts
         A list containing the individual detector planes' parameters.
         For more information see :py:class:`DetectorPlate`
-
+    block_size : int (optional)
+        Number of plates evaluated at once by the batched engine, see
+        :py:class:`PlateGeometry`.
     """
-    def __init__(self, plates):
+    def __init__(self, plates, block_size=16):
         self._plates = None
+        self._geometry = None
+        self._compiled_config = None
+        self._block_size = block_size
         self.plates = [DetectorPlate(**plate) for plate in plates]
 
+    @property
+    def plates(self):
+        """Returns the detector plates."""
+        return self._plates
+
+    @plates.setter
+    def plates(self, plates):
+        """Sets the plates, a list of :py:class:`DetectorPlate`."""
+        if not all(isinstance(plate, DetectorPlate) for plate in plates):
+            raise ValueError("``plates`` must be a list of ``DetectorPlate``.")
+        self._plates = list(plates)
+        self._compile()
+
+    def _compile(self):
+        """Compiles the plates' :py:class:`PlateGeometry`."""
+        self._geometry = PlateGeometry(self._plates,
+                                       block_size=self._block_size)
+        self._compiled_config = self.config
+
+    @property
+    def geometry(self):
+        """
+        Returns the plates' compiled :py:class:`PlateGeometry`, recompiled
+        if a plate has been changed since.
+        """
+        if self.config != self._compiled_config:
+            self._compile()
+        return self._geometry
+
+    @property
+    def config(self):
+        """Returns the plates' parameters."""
+        return [plate.config for plate in self.plates]
+
+    def fast_simulate(self, events, acceptance, seed=None):
+        """
+        Simulates the reconstructed tracks of ``events`` from a precomputed
+        :py:class:`simulator.acceptance.AcceptanceMap` of this detector
+        instead of the full geometry. See
+        :py:meth:`simulator.acceptance.AcceptanceMap.simulate`.
+        """
+        if acceptance.plates != self.config:
+            raise ValueError("The acceptance map is of a different detector.")
+        return acceptance.simulate(events, seed=seed)
+
+    @instrument('detection.evaluate_batch')
+    def evaluate_batch(self, events, strict=False):
+        """
+        Evaluates a :py:class:`simulator.batch.EventBatch` on all plates at
+        once. Returns a :py:class:`simulator.batch.HitBatch` whose columns
+        have shape ``(Nevents, Nplates)``.
+
+        The boolean ``hit`` column marks the (event, plate) pairs where the
+        particle crosses the plate. Misses, i.e. tracks that pass beside a
+        plate or never reach it, have ``NaN`` positions and times and pixel
+        indices of -1. If ``strict`` raises a ``ValueError`` on any miss
+        instead.
+        """
+        if not isinstance(events, EventBatch):
+            raise ValueError("``events`` must be an ``EventBatch``.")
+        return HitBatch(self.geometry.evaluate(events, strict=strict))
+
+    @instrument('detection.evaluate_stream')
+    def evaluate_stream(self, events):
+        """
+        Evaluates a :py:class:`simulator.batch.EventBatch` and returns its
+        hits as a time-ordered :py:class:`simulator.batch.HitStream`
+        without event grouping. The true ``event`` of each hit is the
+        event's ``eventID`` column if present and its row otherwise.
+        """
+        hits = self.evaluate_batch(events)
+        rows, plates = numpy.nonzero(hits['hit'])
+        order = numpy.argsort(hits['t'][rows, plates], kind='stable')
+        rows, plates = rows[order], plates[order]
+        out = {p: hits[p][rows, plates] for p in ('x', 'y', 'z', 't',
+                                                   'xpixel', 'ypixel',
+                                                   'pixel')}
+        out['plate'] = plates
+        out['event'] = (events['eventID'][rows] if 'eventID' in events
+                        else rows)
+        return HitStream(out)
+
+    @instrument('detection.readout')
+    def readout(self, events, window, t0=0., frames=None):
+        """
+        Evaluates a :py:class:`simulator.batch.EventBatch` and packs its hits
+        into sparse per-plate pixel occupancy frames of time windows of
+        length ``window`` starting at ``t0``. Hits before ``t0`` are
+        dropped. If ``frames``, a
+        :py:class:`simulator.readout.OccupancyFrames` of the same window,
+        is given the hits are accumulated into it. Returns the frames.
+        """
+        if frames is None:
+            frames = OccupancyFrames(
+                window, [plate.Npixs for plate in self.plates], t0=t0)
+        elif frames.window != window or frames.t0 != t0:
+            raise ValueError("``frames`` are of a different window.")
+        hits = self.evaluate_batch(events)
+        rows, plates = numpy.nonzero(hits['hit'])
+        return frames.add(hits['t'][rows, plates], plates,
+                          hits['pixel'][rows, plates])
+
+    def iter_evaluate(self, batches):
+        """
+        Evaluates an iterable of :py:class:`simulator.batch.EventBatch`
+        chunk by chunk. Yields the corresponding
+        :py:class:`simulator.batch.HitBatch`.
+        """
+        for events in batches:
+            yield self.evaluate_batch(events)
+
     def evaluate_events(self, events):
         """
         Evaluates the events. Returns a list of list: ``out[i, j]``
         where the ``i`` refers to the event and ``j`` refers to the detector
-        plate.
+        plate. If ``events`` is a :py:class:`simulator.batch.EventBatch`
+        returns the output of :py:meth:`evaluate_batch` instead.
         """
+        if isinstance(events, EventBatch):
+            return self.evaluate_batch(events)
         out = [None] * len(events)
         for i, event in enumerate(events):
             data = [None] * len(self.plates)
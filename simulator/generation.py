@@ -1,7 +1,25 @@
 """Particle generation script."""
+import os
+from copy import copy
+from math import (erfc, sqrt)
+
 import numpy
 
-from scipy.stats import (truncnorm, multivariate_normal)
+from .batch import EventBatch
+from .cache import (cache_fname, hash_parameters)
+from .precision import get_precision
+from .profiling import instrument
+
+
+def _check_random_state(random_state):
+    """
+    Returns a :py:class:`numpy.random.Generator` seeded by
+    ``random_state`` if it is ``None`` or an integer, otherwise
+    ``random_state``, a ``Generator`` or a ``RandomState``.
+    """
+    if random_state is None or isinstance(random_state, (int, numpy.integer)):
+        return numpy.random.default_rng(random_state)
+    return random_state
 
 
 class PoissonSource:
@@ -23,26 +41,38 @@ class PoissonSource:
     deg : bool (optional)
         Whether the input ``theta_max`` is in degrees.
     seed : int (optional)
-        Random seed for reproducibility.
+        Random seed for reproducibility. Seeds the source's own
+        :py:class:`numpy.random.Generator`, the global NumPy state is left
+        untouched.
+    timing : str (optional)
+        How emission times are sampled. ``'discrete'`` checks for an
+        emission in every timestep of length ``1e-5``, ``'continuous'``
+        samples exact continuous times whose cost scales with the number
+        of emitted events.
     """
+    _timings = ('discrete', 'continuous')
 
     def __init__(self, theta_max, momentum_distribution=None, rate=1,
-                 cov=None, deg=True, seed=2021):
+                 cov=None, deg=True, seed=2021, timing='discrete'):
         self._theta_max = None
         self._rate = None
         self._cov = None
+        self._chol = None
+        self._timing = None
         self._deg = deg
 
         self.theta_max = theta_max
         self.rate = rate
         self.cov = cov
+        self.timing = timing
 
         if momentum_distribution is None:
             self.momentum_distribution = TruncatedGaussian(mu=1, std=0.5)
         else:
             self.momentum_distribution = momentum_distribution
-        # Set the random seed
-        numpy.random.seed(seed)
+        # Per-instance random generator
+        self._seedseq = numpy.random.SeedSequence(seed)
+        self._rng = numpy.random.default_rng(self._seedseq)
         # Timestep over which emission is determined
         self._dt = 1e-5
         # Internal source time
@@ -98,53 +128,97 @@ class PoissonSource:
             cov = numpy.array(cov)
         if cov.shape != (2, 2):
             raise ValueError("Covariance shape must be (2, 2).")
+        # Factor the covariance once, it is reused by every observation
+        try:
+            self._chol = numpy.linalg.cholesky(cov)
+        except numpy.linalg.LinAlgError:
+            raise ValueError("Covariance must be positive definite.")
         self._cov = cov
 
+    @property
+    def timing(self):
+        """Returns how emission times are sampled."""
+        return self._timing
+
+    @timing.setter
+    def timing(self, timing):
+        """Sets ``timing``."""
+        if timing not in self._timings:
+            raise ValueError("``timing`` must be one of {}."
+                             .format(self._timings))
+        self._timing = timing
+
+    @instrument('generation.event_times')
     def _event_times(self, T):
         """
         Returns times when the source emits a particle. Assumes Poisson
         distributed mean rate of ``self.rate``.
 
-        Ignores the probability of emitting more than 1 particle during a
-        single timestep. This is exact in the limit of small timesteps.
+        In the discrete mode ignores the probability of emitting more than
+        1 particle during a single timestep. This is exact in the limit of
+        small timesteps.
         """
-        x = numpy.random.uniform(size=int(T/self._dt))
+        if self.timing == 'continuous':
+            return self._continuous_event_times(T)
+        x = self._rng.uniform(size=int(T/self._dt))
         # Probability of no emission within timestep self._dt
         prob0 = numpy.exp(-self.rate * self._dt)
         # Times when an event was emitted
         return self._clock + numpy.where(x > prob0)[0] * self._dt
 
-    def _sample_anisotropic_flux(self, N, magnitude):
+    def _continuous_event_times(self, T):
+        """
+        Returns exact emission times within ``[clock, clock + T)``. Draws the
+        Poisson number of events within ``T`` and places them uniformly,
+        which is equivalent to exponential inter-arrival times.
+        """
+        N = self._rng.poisson(self.rate * T)
+        t = self._rng.uniform(0, T, N)
+        t.sort()
+        return self._clock + t
+
+    @instrument('generation.directions')
+    def _sample_anisotropic_flux(self, N, magnitude, out=None):
         """
         Returns points sampled from a multivariate Gaussian distribution
-        in z=10 plane whose covariance is specified by ``self.cov``.
+        in z=10 plane whose covariance is specified by ``self.cov``. The
+        points are rescaled to have length ``magnitude``. If ``out``, an
+        array of shape ``(N, 3)``, is given the samples are written into it.
         """
-        points = multivariate_normal(mean=[0, 0], cov=self.cov).rvs(size=N)
-        # Append the z coordinate
-        z = numpy.ones((N, 1)) * self._z
-        samples = numpy.hstack([points, z])
+        if out is None:
+            out = numpy.empty((N, 3))
+        elif out.shape != (N, 3):
+            raise ValueError("``out`` must have shape ({}, 3).".format(N))
+        # Correlate standard normals with the cached Cholesky factor
+        numpy.matmul(self._rng.standard_normal((N, 2)), self._chol.T,
+                     out=out[:, :2])
+        out[:, 2] = self._z
         # Normalise the samples
-        norm = numpy.linalg.norm(samples, axis=1)
-        # Could be vectorised but.. yolo
-        for i in range(N):
-            samples[i] *= magnitude[i] / norm[i]
-        return samples
+        scale = magnitude / numpy.sqrt(numpy.einsum('ij,ij->i', out, out))
+        out *= scale[:, None]
+        return out
 
-    def _sample_sphere(self, N, magnitude):
+    @instrument('generation.directions')
+    def _sample_sphere(self, N, magnitude, out=None):
         """
         Returns uniformly distributed points on a 2-sphere within radius
-        ``self.theta_max`` of the north pole.
+        ``self.theta_max`` of the north pole. If ``out``, an array of shape
+        ``(N, 3)``, is given the samples are written into it.
         """
         # Cumulative distribution function
-        cdf = numpy.random.uniform(0, 1, N)
+        cdf = self._rng.uniform(0, 1, N)
         # This comes around from inverting theta's CDF
         theta = numpy.arccos(1 - cdf * (1 - numpy.cos(self._theta_max)))
         # These are uniformly distributed
-        phi = numpy.random.uniform(0, 2*numpy.pi, N)
+        phi = self._rng.uniform(0, 2*numpy.pi, N)
         # Convert to Cartesians
         x, y, z = self._spherical2cartesian(magnitude, theta, phi)
-        samples = numpy.vstack([x, y, z]).T
-        return samples
+        if out is None:
+            return numpy.vstack([x, y, z]).T
+        if out.shape != (N, 3):
+            raise ValueError("``out`` must have shape ({}, 3).".format(N))
+        out[:, 0], out[:, 1], out[:, 2] = x, y, z
+        return out
 
     @staticmethod
     def _spherical2cartesian(r, theta, phi):
@@ -155,27 +229,178 @@ class PoissonSource:
         z = r * numpy.cos(theta)
         return x, y, z
 
-    def observe(self, T):
-        """Observe the source for period ``T``."""
+    @instrument('generation.momenta')
+    def _sample_momenta(self, N):
+        """
+        Returns ``N`` momenta magnitudes. Uses the distribution's own
+        ``rvs`` if it has one and that of its frozen ``dist`` otherwise.
+        """
+        dist = self.momentum_distribution
+        rvs = getattr(dist, 'rvs', None)
+        if rvs is None:
+            rvs = dist.dist.rvs
+        return rvs(N, random_state=self._rng)
+
+    @instrument('generation.observe')
+    def observe(self, T, as_batch=False, out=None):
+        """
+        Observe the source for period ``T``. If ``as_batch`` returns a
+        :py:class:`simulator.batch.EventBatch`, otherwise a list of
+        per-event dicts.
+
+        The batch's times are double precision and its other columns are
+        of the package-wide :py:class:`simulator.precision.Precision`. They
+        are sampled in double precision and cast, so the random stream is
+        the same under any precision.
+
+        ``out``, a double precision array of shape ``(M, 3)``, is a reusable
+        buffer into whose first rows the velocities are sampled, so that
+        streaming runs do not allocate them per call. A new array is
+        allocated if the period emits more than ``M`` events. The batch's
+        velocities may be views of ``out``, so it must not be reused while
+        the batch is in use.
+        """
+        if out is not None and (out.ndim != 2 or out.shape[1] != 3
+                                or out.dtype != numpy.float64):
+            raise ValueError("``out`` must be a float64 array of shape "
+                             "(M, 3).")
         t = self._event_times(T)
         N = t.size
-        magnitude = self.momentum_distribution.dist.rvs(N)
+        magnitude = self._sample_momenta(N)
+        if out is not None:
+            out = out[:N] if out.shape[0] >= N else None
         # Sample the unit vectors
         if self.cov is None:
-            samples = self._sample_sphere(N, magnitude)
+            samples = self._sample_sphere(N, magnitude, out=out)
         else:
-            samples = self._sample_anisotropic_flux(N, magnitude)
+            samples = self._sample_anisotropic_flux(N, magnitude, out=out)
         # Bump up the internal clock
         self._clock += T
         # Calling these velocities assume m=1 and no SR but fine for now
+        if as_batch:
+            policy = get_precision()
+            samples = samples.astype(policy.float, copy=False)
+            return EventBatch({'vx': samples[:, 0], 'vy': samples[:, 1],
+                               'vz': samples[:, 2],
+                               't': t.astype(policy.time, copy=False),
+                               'x0': numpy.zeros(N, dtype=policy.float),
+                               'y0': numpy.zeros(N, dtype=policy.float),
+                               'z0': numpy.zeros(N, dtype=policy.float)})
         return [{'vx': samples[i, 0], 'vy': samples[i, 1],
                  'vz': samples[i, 2], 't': t[i],
                  'x0': 0.0, 'y0': 0.0, 'z0': 0.0} for i in range(N)]
 
+    def shard(self, index, period):
+        """
+        Returns a copy of the source that observes the ``index``-th window
+        of length ``period``, i.e. its clock starts at ``index * period``.
+        Its random generator is derived from the source's seed and
+        ``index`` only, so shards are independent and reproducible
+        regardless of the order in which they are observed.
+        """
+        if not isinstance(index, (int, numpy.integer)) or index < 0:
+            raise ValueError("``index`` must be a non-negative integer.")
+        shard = copy(self)
+        shard._clock = index * period
+        shard._seedseq = numpy.random.SeedSequence(
+            self._seedseq.entropy, spawn_key=(int(index),))
+        shard._rng = numpy.random.default_rng(shard._seedseq)
+        return shard
+
+    @property
+    def params(self):
+        """
+        Returns the source's parameters as a JSON serializable dict. The
+        momentum distribution is included by its ``params`` if it has
+        them and otherwise by a hash of its quantiles.
+        """
+        return {'theta_max': self.theta_max, 'rate': self.rate,
+                'cov': None if self.cov is None else self.cov.tolist(),
+                'deg': self.isdeg, 'timing': self.timing,
+                'seed': self._seedseq.entropy,
+                'momentum': self._momentum_params()}
+
+    def _momentum_params(self):
+        """Returns a JSON serializable fingerprint of the momenta."""
+        dist = self.momentum_distribution
+        params = getattr(dist, 'params', None)
+        if params is not None:
+            return params
+        ppf = getattr(dist, 'ppf', None)
+        if ppf is None:
+            ppf = dist.dist.ppf
+        q = numpy.linspace(0.01, 0.99, 99)
+        return {'name': type(dist).__name__,
+                'quantiles': hash_parameters(ppf(q).tolist())}
+
+    def get_state(self):
+        """
+        Returns the source's parameters, clock and random generator state as
+        a JSON serializable dict, from which :py:meth:`set_state` continues
+        the source's random stream exactly.
+        """
+        return {'params': self.params, 'clock': self._clock,
+                'spawn_key': list(self._seedseq.spawn_key),
+                'rng': self._rng.bit_generator.state}
+
+    def set_state(self, state):
+        """
+        Restores the clock and random generator state saved by
+        :py:meth:`get_state`. The source must have the same parameters.
+        """
+        params = state['params']
+        if params != self.params:
+            raise ValueError("The state is of a source with parameters {}."
+                             .format(params))
+        self._clock = state['clock']
+        self._seedseq = numpy.random.SeedSequence(
+            params['seed'], spawn_key=tuple(state['spawn_key']))
+        self._rng = numpy.random.default_rng(self._seedseq)
+        self._rng.bit_generator.state = state['rng']
+
+    def iter_observe(self, T, chunk_size, out=None):
+        """
+        Observe the source for period ``T`` in chunks. Yields
+        :py:class:`simulator.batch.EventBatch` of ``chunk_size`` events
+        (except for the last one). The source is observed in windows that
+        on average emit ``chunk_size`` events, so memory is bounded by the
+        chunk size rather than by ``T``.
+
+        ``out`` is a reusable buffer passed to :py:meth:`observe` for every
+        window. Each yielded batch is then only valid until the next one is
+        requested.
+        """
+        if not isinstance(chunk_size, int) or chunk_size < 1:
+            raise ValueError("``chunk_size`` must be a positive integer.")
+        window = chunk_size / self.rate
+        end = self._clock + T
+        pending = None
+        while self._clock < end:
+            if out is not None and pending is not None:
+                # The leftover events may be views of ``out``, which the
+                # next window overwrites
+                pending = EventBatch.concatenate([pending])
+            batch = self.observe(min(window, end - self._clock),
+                                 as_batch=True, out=out)
+            if pending is None:
+                pending = batch
+            else:
+                pending = EventBatch.concatenate([pending, batch])
+            while len(pending) >= chunk_size:
+                yield pending[:chunk_size]
+                pending = pending[chunk_size:]
+        if pending is not None and len(pending) > 0:
+            yield pending
+
 
 class TruncatedGaussian:
     r"""A truncated positive Gaussian distribution.
 
+    Samples by rejecting the negative draws of a Gaussian in NumPy. As
+    ``mu`` is positive at least half of the draws are accepted. The frozen
+    :py:mod:`scipy.stats` distribution ``dist``, and with it scipy, is
+    only loaded when first accessed.
+
     Parameters
     ----------
     mu : float (optional)
@@ -189,7 +414,228 @@ class TruncatedGaussian:
             raise ValueError("``mu`` must be positive.")
         if std <= 0:
             raise ValueError("``std`` must be positive.")
+        self.mu = mu
+        self.std = std
+        # Lower truncation in units of std and the fraction of draws above
+        self._a = -mu / std
+        self._acceptance = 0.5 * erfc(self._a / sqrt(2))
+        self._dist = None
+
+    @property
+    def params(self):
+        """Returns the distribution's parameters."""
+        return {'name': 'TruncatedGaussian', 'mu': float(self.mu),
+                'std': float(self.std)}
+
+    @property
+    def dist(self):
+        """Returns the frozen :py:mod:`scipy.stats` distribution."""
+        if self._dist is None:
+            from scipy.stats import truncnorm
+            self._dist = truncnorm(a=self._a, b=numpy.inf, loc=self.mu,
+                                   scale=self.std)
+        return self._dist
+
+    def rvs(self, size, random_state=None):
+        """
+        Returns ``size`` samples. ``random_state`` may be ``None``, a seed,
+        a :py:class:`numpy.random.Generator` or a
+        :py:class:`numpy.random.RandomState`.
+        """
+        random_state = _check_random_state(random_state)
+        out = numpy.empty(size)
+        filled = 0
+        while filled < size:
+            # Oversample by the expected acceptance
+            N = size - filled
+            x = random_state.standard_normal(int(N / self._acceptance) + 16)
+            x = x[x > self._a][:N]
+            out[filled:filled + x.size] = x
+            filled += x.size
+        return self.mu + self.std * out
+
+
+class QuantileTable:
+    r"""
+    A quantile function (inverse CDF) tabulated at equally spaced
+    probabilities ``numpy.linspace(0, 1, quantiles.size)`` and linearly
+    interpolated in between. Mimics the sampling interface of a frozen
+    :py:mod:`scipy.stats` distribution.
+
+    Parameters
+    ----------
+    quantiles : numpy.ndarray
+        The non-decreasing tabulated quantiles.
+    """
+
+    def __init__(self, quantiles):
+        quantiles = numpy.asarray(quantiles, dtype=float)
+        if quantiles.ndim != 1 or quantiles.size < 2:
+            raise ValueError("``quantiles`` must be a 1D array of at least "
+                             "2 values.")
+        if not numpy.all(numpy.isfinite(quantiles)):
+            raise ValueError("``quantiles`` must be finite.")
+        if numpy.any(numpy.diff(quantiles) < 0):
+            raise ValueError("``quantiles`` must be non-decreasing.")
+        self.quantiles = quantiles
+        self._slopes = numpy.diff(quantiles)
+
+    def ppf(self, q):
+        """Returns the interpolated quantile function at ``q``."""
+        x = numpy.asarray(q, dtype=float) * (self.quantiles.size - 1)
+        # Bin lookup is direct index arithmetic on the uniform grid
+        i = numpy.minimum(x.astype(numpy.intp), self.quantiles.size - 2)
+        return self.quantiles[i] + (x - i) * self._slopes[i]
+
+    def rvs(self, size=None, random_state=None):
+        """
+        Returns samples. ``random_state`` may be ``None``, a seed, a
+        :py:class:`numpy.random.Generator` or a
+        :py:class:`numpy.random.RandomState`.
+        """
+        random_state = _check_random_state(random_state)
+        return self.ppf(random_state.uniform(size=size))
+
+    def mean(self):
+        """Returns the mean of the tabulated distribution."""
+        q = self.quantiles
+        return 0.5 * numpy.mean(q[1:] + q[:-1])
+
+    def stats(self, moments='m'):
+        """Returns the mean. Only ``moments='m'`` is supported."""
+        if moments != 'm':
+            raise ValueError("Only the mean is supported.")
+        return self.mean()
+
+
+class TabulatedDistribution:
+    r"""
+    A momentum distribution that samples from a precomputed quantile table
+    by vectorized interpolation. Build it from a distribution with
+    :py:meth:`from_distribution` or from a measured spectrum with
+    :py:meth:`from_histogram`. The tables are cached on disk by a hash of
+    their parameters.
+
+    The tabulated CDF deviates from the exact one by at most ``tol``
+    (the Kolmogorov distance), as the quantile function is exact at the
+    table's nodes and the nodes are ``tol`` apart in probability.
+
+    Parameters
+    ----------
+    quantiles : numpy.ndarray
+        The quantile function tabulated at equally spaced probabilities
+        between 0 and 1.
+    """
+
+    def __init__(self, quantiles):
+        self.dist = QuantileTable(quantiles)
+
+    @property
+    def params(self):
+        """Returns a hash of the distribution's quantile table."""
+        return {'name': 'TabulatedDistribution',
+                'quantiles': hash_parameters(self.dist.quantiles.tolist())}
+
+    @staticmethod
+    def _nodes(tol):
+        """Returns the probabilities at which the table is evaluated."""
+        if not 0 < tol < 1:
+            raise ValueError("``tol`` must be between 0 and 1.")
+        return numpy.linspace(0, 1, int(numpy.ceil(1 / tol)) + 1)
+
+    @classmethod
+    def _cached(cls, params, build, cache_dir):
+        """
+        Loads the table described by ``params`` from the cache or builds
+        it with ``build`` and saves it. ``cache_dir=False`` disables the
+        cache.
+        """
+        if cache_dir is False:
+            return cls(build())
+        fname = cache_fname(cache_dir, 'quantiles', params, ext='.npy')
+        if os.path.exists(fname):
+            return cls(numpy.load(fname))
+        quantiles = build()
+        with open(fname + '.tmp', 'wb') as f:
+            numpy.save(f, quantiles)
+        os.replace(fname + '.tmp', fname)
+        return cls(quantiles)
+
+    @classmethod
+    def from_distribution(cls, dist, tol=1e-4, cache_dir=None):
+        """
+        Tabulates a distribution with a ``ppf`` method, such as a frozen
+        :py:mod:`scipy.stats` distribution or a
+        :py:class:`TruncatedGaussian`. The tails are cut off at
+        probability ``tol / 100``, so that a distant or infinite support
+        edge does not stretch the outermost interpolation bins.
+
+        Parameters
+        ----------
+        dist : object
+            The distribution, or an object whose ``dist`` attribute is one.
+        tol : float (optional)
+            Maximum deviation of the tabulated CDF from the exact one.
+        cache_dir : str or bool (optional)
+            Cache directory. By default
+            :py:func:`simulator.cache.default_cache_dir`, ``False``
+            disables caching. Only frozen :py:mod:`scipy.stats`
+            distributions are cached.
+        """
+        if not hasattr(dist, 'ppf'):
+            dist = dist.dist
+        q = cls._nodes(tol)
+
+        def build():
+            return dist.ppf(numpy.clip(q, tol / 100, 1 - tol / 100))
+
+        try:
+            params = {'name': dist.dist.name, 'args': list(dist.args),
+                      'kwds': dist.kwds, 'tol': tol}
+        except AttributeError:
+            cache_dir = False
+            params = None
+        return cls._cached(params, build, cache_dir)
+
+    @classmethod
+    def from_histogram(cls, edges, counts, tol=1e-4, cache_dir=None):
+        """
+        Tabulates a histogram of a measured spectrum. Values are assumed
+        uniformly distributed within each bin.
+
+        Parameters
+        ----------
+        edges : numpy.ndarray
+            Increasing bin edges of length ``counts.size + 1``.
+        counts : numpy.ndarray
+            Non-negative bin counts (or weights).
+        tol : float (optional)
+            Maximum deviation of the tabulated CDF from the exact one.
+        cache_dir : str or bool (optional)
+            Cache directory, see :py:meth:`from_distribution`.
+        """
+        edges = numpy.asarray(edges, dtype=float)
+        counts = numpy.asarray(counts, dtype=float)
+        if edges.ndim != 1 or edges.size != counts.size + 1:
+            raise ValueError("``edges`` must have length ``counts.size + 1``.")
+        if numpy.any(numpy.diff(edges) <= 0):
+            raise ValueError("``edges`` must be increasing.")
+        if numpy.any(counts < 0) or not counts.sum() > 0:
+            raise ValueError("``counts`` must be non-negative and not all 0.")
+        q = cls._nodes(tol)
+
+        def build():
+            # Only non-empty bins contribute, so the inverse CDF jumps over
+            # the empty ones
+            full = counts > 0
+            lower, upper = edges[:-1][full], edges[1:][full]
+            cdf = numpy.concatenate([[0], numpy.cumsum(counts[full])])
+            cdf /= cdf[-1]
+            k = numpy.searchsorted(cdf, q, side='right') - 1
+            k = numpy.clip(k, 0, lower.size - 1)
+            frac = (q - cdf[k]) / (cdf[k + 1] - cdf[k])
+            return lower[k] + frac * (upper[k] - lower[k])
 
-        a = -mu/std
-        b = numpy.infty
-        self.dist = truncnorm(a=a, b=b, loc=mu, scale=std)
+        params = {'edges': hash_parameters(edges.tolist()),
+                  'counts': hash_parameters(counts.tolist()), 'tol': tol}
+        return cls._cached(params, build, cache_dir)
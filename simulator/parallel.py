@@ -0,0 +1,187 @@
+"""Parallel simulation of an observation window over a process pool."""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from .batch import (EventBatch, HitBatch, TrackBatch)
+
+
+def count_shards(T, period):
+    """Returns the number of shards of length ``period`` that cover ``T``."""
+    N = int(T // period)
+    return N + 1 if N * period < T else N
+
+
+def observe_shard(source, period, T, index):
+    """
+    Observes the ``index``-th shard of length ``period`` of an observation
+    window of length ``T``. See :py:meth:`simulator.PoissonSource.shard`.
+    Returns a :py:class:`simulator.batch.EventBatch`.
+    """
+    shard = source.shard(index, period)
+    return shard.observe(min(period, T - index * period), as_batch=True)
+
+
+def simulate_shard(source, detector, reconstructor, index, period, T):
+    """
+    Generates, detects and (optionally) reconstructs the ``index``-th shard
+    of length ``period`` of an observation window of length ``T``. See
+    :py:meth:`simulator.PoissonSource.shard`. Returns a tuple of the
+    events, hits, tracks and a dict of the time (in seconds) spent in each
+    stage. The tracks are ``None`` if ``reconstructor`` is ``None``.
+    """
+    timings = {}
+    start = perf_counter()
+    events = observe_shard(source, period, T, index)
+    timings['generation'] = perf_counter() - start
+
+    start = perf_counter()
+    hits = detector.evaluate_batch(events)
+    timings['detection'] = perf_counter() - start
+
+    tracks = None
+    if reconstructor is not None:
+        start = perf_counter()
+        tracks = reconstructor.reconstruct_batch(hits)
+        timings['reconstruction'] = perf_counter() - start
+    return events, hits, tracks, timings
+
+
+def summarise_shard(source, detector, reconstructor, index, period, T,
+                    summary):
+    """
+    Simulates the ``index``-th shard like :py:func:`simulate_shard` but
+    returns only an empty copy of ``summary`` updated with the shard's
+    tracks and the dict of stage timings.
+    """
+    summary = summary.empty()
+    __, hits, __, timings = simulate_shard(source, detector, None, index,
+                                           period, T)
+    start = perf_counter()
+    reconstructor.reconstruct_batch(hits, summary=summary)
+    timings['reconstruction'] = perf_counter() - start
+    return summary, timings
+
+
+class ParallelRunner:
+    r"""
+    Shards an observation window into fixed-length periods and simulates
+    them over a process pool. Each shard draws from its own random stream
+    (see :py:meth:`simulator.PoissonSource.shard`), so the output is
+    identical for any number of workers, including a serial run with
+    ``workers=1``.
+
+    Parameters
+    ----------
+    source : :py:class:`simulator.PoissonSource`
+        The particle source.
+    detector : :py:class:`simulator.Detector`
+        The detector.
+    reconstructor : :py:class:`simulator.Reconstructor` (optional)
+        The reconstructor. If ``None`` the tracks are not reconstructed.
+    period : float (optional)
+        Length of the observation period of a single shard.
+    workers : int (optional)
+        Number of worker processes. If 1 the shards are simulated serially
+        in this process.
+    """
+
+    def __init__(self, source, detector, reconstructor=None, period=1.,
+                 workers=1):
+        if not period > 0:
+            raise ValueError("``period`` must be positive.")
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("``workers`` must be a positive integer.")
+        self.source = source
+        self.detector = detector
+        self.reconstructor = reconstructor
+        self.period = period
+        self.workers = workers
+        self.timings = {}
+
+    def Nshards(self, T):
+        """Returns the number of shards that cover period ``T``."""
+        return count_shards(T, self.period)
+
+    def iter_run(self, T, start=0):
+        """
+        Simulates the observation window ``[start * period, T)`` and yields
+        the shard index and the ``(events, hits, tracks)`` tuple of each
+        shard in order. At most twice the number of workers shards are
+        held in flight. The time spent in each stage, summed over the
+        workers, is accumulated in ``self.timings``.
+        """
+        args = (self.source, self.detector, self.reconstructor)
+        indices = range(start, self.Nshards(T))
+        if self.workers == 1:
+            for index in indices:
+                yield index, self._collect(
+                    simulate_shard(*args, index, self.period, T))
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            for index in indices:
+                pending.append((index, executor.submit(
+                    simulate_shard, *args, index, self.period, T)))
+                if len(pending) >= 2 * self.workers:
+                    index, future = pending.popleft()
+                    yield index, self._collect(future.result())
+            while pending:
+                index, future = pending.popleft()
+                yield index, self._collect(future.result())
+
+    def _collect(self, result):
+        """
+        Accumulates the stage timings of a shard and returns its events,
+        hits and tracks.
+        """
+        for stage, time in result[-1].items():
+            self.timings[stage] = self.timings.get(stage, 0.) + time
+        return result[:-1]
+
+    def summarise(self, T, summary, start=0):
+        """
+        Simulates the observation window ``[start * period, T)`` and adds
+        its tracks to ``summary``, a
+        :py:class:`simulator.summary.TrackSummary`. Each shard is
+        summarised by its worker and only the summaries are sent back and
+        merged, so the events, hits and tracks are never kept. Returns
+        ``summary``.
+        """
+        if self.reconstructor is None:
+            raise ValueError("Summarising requires a reconstructor.")
+        args = (self.source, self.detector, self.reconstructor)
+        indices = range(start, self.Nshards(T))
+        if self.workers == 1:
+            results = (summarise_shard(*args, index, self.period, T, summary)
+                       for index in indices)
+            for result in results:
+                summary.merge(self._collect(result)[0])
+            return summary
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(summarise_shard, *args, index,
+                                       self.period, T, summary)
+                       for index in indices]
+            for future in futures:
+                summary.merge(self._collect(future.result())[0])
+        return summary
+
+    def run(self, T):
+        """
+        Simulates the observation window ``[0, T)``. Returns the merged
+        :py:class:`simulator.batch.EventBatch`,
+        :py:class:`simulator.batch.HitBatch` and
+        :py:class:`simulator.batch.TrackBatch` (or ``None``).
+        """
+        events, hits, tracks = [], [], []
+        for __, (_events, _hits, _tracks) in self.iter_run(T):
+            events.append(_events)
+            hits.append(_hits)
+            tracks.append(_tracks)
+        if not events:
+            raise ValueError("``T`` must be positive.")
+        tracks = None if tracks[0] is None else TrackBatch.concatenate(tracks)
+        return (EventBatch.concatenate(events), HitBatch.concatenate(hits),
+                tracks)
@@ -0,0 +1,292 @@
+"""Chunked streaming of events through the simulation chain."""
+from collections import deque
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor)
+from functools import partial
+from queue import (Empty, Full, Queue)
+from threading import (Event, Thread)
+from time import perf_counter
+
+from .parallel import (count_shards, observe_shard)
+
+
+def stream(source, detector, reconstructor, T, chunk_size):
+    """
+    Streams the observation of ``source`` for period ``T`` through the
+    ``detector`` and the ``reconstructor`` in chunks of ``chunk_size``
+    events. Yields a tuple of the events, hits and reconstructed events of
+    each chunk, so that peak memory does not grow with ``T``.
+
+    Parameters
+    ----------
+    source : :py:class:`simulator.PoissonSource`
+        The particle source.
+    detector : :py:class:`simulator.Detector`
+        The detector.
+    reconstructor : :py:class:`simulator.Reconstructor`
+        The reconstructor.
+    T : float
+        The observation period.
+    chunk_size : int
+        Number of events per chunk.
+    """
+    for events in source.iter_observe(T, chunk_size):
+        hits = detector.evaluate_batch(events)
+        tracks = reconstructor.reconstruct_batch(hits)
+        yield events, hits, tracks
+
+
+# Marks the end of the stream in the queues
+_END = object()
+# Seconds between checks for a failed stage while blocked on a queue
+_POLL = 0.1
+
+
+def _timed_call(func, item):
+    """Returns ``func(item)`` and the time it took."""
+    start = perf_counter()
+    out = func(item)
+    return out, perf_counter() - start
+
+
+class Stage:
+    r"""
+    A stage of a :py:class:`PipelinedRunner`.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    func : callable
+        Maps an item to the item passed to the next stage.
+    workers : int (optional)
+        Number of concurrent calls of ``func``. If larger than 1, or if
+        ``executor='process'``, calls run in an executor pool.
+    executor : str (optional)
+        ``'thread'`` for a thread pool, useful where NumPy releases the GIL,
+        or ``'process'`` for a process pool, in which case ``func`` and the
+        items must be picklable.
+    """
+    _executors = ('thread', 'process')
+
+    def __init__(self, name, func, workers=1, executor='thread'):
+        if not callable(func):
+            raise ValueError("``func`` must be callable.")
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("``workers`` must be a positive integer.")
+        if executor not in self._executors:
+            raise ValueError("``executor`` must be one of {}."
+                             .format(self._executors))
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.executor = executor
+
+    def make_executor(self):
+        """Returns the stage's executor pool or ``None`` if not needed."""
+        if self.executor == 'process':
+            return ProcessPoolExecutor(max_workers=self.workers)
+        if self.workers > 1:
+            return ThreadPoolExecutor(max_workers=self.workers)
+        return None
+
+
+class PipelinedRunner:
+    r"""
+    Runs stages concurrently, each in its own thread, connected by bounded
+    queues. A full queue blocks the stage that feeds it (backpressure), so
+    at most ``maxsize`` items wait between any two stages. Items leave
+    every stage in the order they entered it.
+
+    After :py:meth:`run` the ``wall`` attribute holds the run's wall time
+    and the ``stats`` attribute holds, per stage, the
+    number of items, the time spent working (``busy``), waiting for input
+    (``starved``) and waiting for space downstream (``blocked``), the
+    utilisation ``busy / (wall * workers)`` and the mean and maximum depth
+    of the stage's input queue. The bottleneck is the stage with the
+    highest utilisation, whose upstream is blocked and downstream starved.
+
+    Parameters
+    ----------
+    stages : list of :py:class:`Stage`
+        The stages in order.
+    maxsize : int (optional)
+        Capacity of the queues between stages.
+    """
+
+    def __init__(self, stages, maxsize=4):
+        if not stages:
+            raise ValueError("``stages`` must not be empty.")
+        if not isinstance(maxsize, int) or maxsize < 1:
+            raise ValueError("``maxsize`` must be a positive integer.")
+        self.stages = stages
+        self.maxsize = maxsize
+        self.stats = {}
+        self.wall = None
+
+    def _put(self, q, item, stop):
+        """Puts ``item`` on ``q``, giving up if ``stop`` is set."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=_POLL)
+                return
+            except Full:
+                continue
+
+    def _get(self, q, stop):
+        """Gets an item from ``q``, returning the end marker on ``stop``."""
+        while not stop.is_set():
+            try:
+                return q.get(timeout=_POLL)
+            except Empty:
+                continue
+        return _END
+
+    def _worker(self, stage, inq, outq, stats, stop, errors):
+        """Runs ``stage`` on the items of ``inq`` until the end marker."""
+        executor = None
+        pending = deque()
+        depths = []
+
+        def emit(out, busy):
+            stats['busy'] += busy
+            stats['items'] += 1
+            start = perf_counter()
+            self._put(outq, out, stop)
+            stats['blocked'] += perf_counter() - start
+
+        try:
+            executor = stage.make_executor()
+            while True:
+                depths.append(inq.qsize())
+                start = perf_counter()
+                item = self._get(inq, stop)
+                stats['starved'] += perf_counter() - start
+                if item is _END:
+                    break
+                if executor is None:
+                    emit(*_timed_call(stage.func, item))
+                    continue
+                pending.append(executor.submit(_timed_call, stage.func, item))
+                if len(pending) >= stage.workers:
+                    emit(*pending.popleft().result())
+            while pending and not stop.is_set():
+                emit(*pending.popleft().result())
+        except BaseException as err:
+            errors.append(err)
+            stop.set()
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if depths:
+                stats['mean_depth'] = sum(depths) / len(depths)
+                stats['max_depth'] = max(depths)
+            self._put(outq, _END, stop)
+
+    def run(self, items):
+        """
+        Feeds ``items`` through the stages. Returns the outputs of the last
+        stage, skipping ``None``.
+        """
+        queues = [Queue(maxsize=self.maxsize)
+                  for __ in range(len(self.stages) + 1)]
+        stop = Event()
+        errors = []
+        self.stats = {stage.name: {'items': 0, 'busy': 0., 'starved': 0.,
+                                   'blocked': 0., 'mean_depth': 0.,
+                                   'max_depth': 0}
+                      for stage in self.stages}
+        threads = [Thread(target=self._worker, daemon=True,
+                          args=(stage, queues[i], queues[i + 1],
+                                self.stats[stage.name], stop, errors))
+                   for i, stage in enumerate(self.stages)]
+
+        def feed():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    self._put(queues[0], item, stop)
+            except BaseException as err:
+                errors.append(err)
+                stop.set()
+            finally:
+                self._put(queues[0], _END, stop)
+
+        start = perf_counter()
+        threads.append(Thread(target=feed, daemon=True))
+        for thread in threads:
+            thread.start()
+        out = []
+        while True:
+            item = self._get(queues[-1], stop)
+            if item is _END:
+                break
+            if item is not None:
+                out.append(item)
+        for thread in threads:
+            thread.join()
+        self.wall = perf_counter() - start
+        if errors:
+            raise errors[0]
+
+        for stage in self.stages:
+            stats = self.stats[stage.name]
+            stats['utilisation'] = stats['busy'] / (self.wall * stage.workers)
+        return out
+
+    def report(self):
+        """Returns the stage statistics of the last run as a table."""
+        lines = ['{:<16}{:>8}{:>10}{:>10}{:>10}{:>8}{:>12}'.format(
+            'stage', 'items', 'busy [s]', 'starved', 'blocked', 'util',
+            'queue mean')]
+        for stage in self.stages:
+            stats = self.stats[stage.name]
+            lines.append(
+                '{:<16}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>8.2f}{:>12.2f}'
+                .format(stage.name, stats['items'], stats['busy'],
+                        stats['starved'], stats['blocked'],
+                        stats.get('utilisation', 0.), stats['mean_depth']))
+        return '\n'.join(lines)
+
+
+def pipelined_simulation(source, detector, reconstructor, T, period,
+                         writer=None, maxsize=4, generation_workers=1,
+                         generation_executor='thread', detection_workers=1,
+                         reconstruction_workers=1):
+    """
+    Simulates the observation window ``[0, T)`` in shards of length
+    ``period`` (see :py:class:`simulator.parallel.ParallelRunner`) through
+    a :py:class:`PipelinedRunner` with generation, detection,
+    reconstruction and, if ``writer`` is given, writing stages. The output
+    is identical to that of the serial runner.
+
+    ``writer`` is a :py:class:`simulator.store.StoreWriter`, whose chunks
+    are appended in order. Generation holds the GIL for much of its time,
+    so ``generation_executor='process'`` may be used to run it in a
+    process pool.
+
+    Returns the runner, whose ``stats`` describe the run, and the list of
+    ``(events, hits, tracks)`` tuples if ``writer`` is ``None``.
+    """
+    def detect(events):
+        return events, detector.evaluate_batch(events)
+
+    def reconstruct(item):
+        events, hits = item
+        return events, hits, reconstructor.reconstruct_batch(hits)
+
+    stages = [Stage('generation', partial(observe_shard, source, period, T),
+                    workers=generation_workers,
+                    executor=generation_executor),
+              Stage('detection', detect, workers=detection_workers),
+              Stage('reconstruction', reconstruct,
+                    workers=reconstruction_workers)]
+    if writer is not None:
+        def write(item):
+            events, hits, tracks = item
+            writer.append(events=events, hits=hits, tracks=tracks)
+        stages.append(Stage('writing', write))
+
+    runner = PipelinedRunner(stages, maxsize=maxsize)
+    out = runner.run(range(count_shards(T, period)))
+    return runner, (out if writer is None else None)
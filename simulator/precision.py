@@ -0,0 +1,121 @@
+"""Package-wide floating point precision policy."""
+from contextlib import contextmanager
+from copy import deepcopy
+
+import numpy
+
+# Floating point type of positions, velocities and angles and integer type
+# of pixel indices per policy. Times are always double precision, as hit
+# times resolve the particles' flight between plates on top of an absolute
+# clock
+POLICIES = {'float64': (numpy.float64, numpy.intp),
+            'float32': (numpy.float32, numpy.int32)}
+TIME_DTYPE = numpy.dtype(numpy.float64)
+
+
+class Precision:
+    r"""
+    The floating point types of the arrays produced by the simulator. The
+    source samples in double precision and casts its output, so that the
+    random stream does not depend on the policy, and the detector and the
+    reconstructor cast their outputs likewise. Compact policies also store
+    pixel indices in 32 bits, which holds plates of up to 46340 pixels per
+    side.
+
+    Parameters
+    ----------
+    name : str
+        One of the keys of :py:data:`POLICIES`.
+    """
+
+    def __init__(self, name):
+        if name not in POLICIES:
+            raise ValueError("``name`` must be one of {}.".format(
+                tuple(POLICIES)))
+        self.name = name
+        self.float = numpy.dtype(POLICIES[name][0])
+        self.index = numpy.dtype(POLICIES[name][1])
+        self.time = TIME_DTYPE
+
+    def __repr__(self):
+        return "Precision('{}')".format(self.name)
+
+
+# The package-wide policy
+_PRECISION = Precision('float64')
+
+
+def get_precision():
+    """Returns the package-wide :py:class:`Precision`."""
+    return _PRECISION
+
+
+def set_precision(name):
+    """
+    Sets the package-wide :py:class:`Precision` by its name. Worker
+    processes inherit it only if they are forked, otherwise it must be set
+    in each of them.
+    """
+    global _PRECISION
+    _PRECISION = Precision(name)
+
+
+@contextmanager
+def precision(name):
+    """
+    Sets the package-wide precision within the context and yields it.
+
+    Example:
+        >>> from simulator.precision import precision
+        >>> with precision('float32') as policy:
+        ...     policy.float
+        dtype('float32')
+    """
+    previous = _PRECISION.name
+    set_precision(name)
+    try:
+        yield _PRECISION
+    finally:
+        set_precision(previous)
+
+
+def _wrap(angle):
+    """Wraps angles to ``[-pi, pi)``."""
+    return (angle + numpy.pi) % (2 * numpy.pi) - numpy.pi
+
+
+def compare_precision(source, detector, reconstructor, T, name='float32'):
+    """
+    Simulates the same observation of ``source`` in double precision and
+    under the policy ``name`` and compares the reconstructed tracks. The
+    source is copied, so its state is left untouched.
+
+    Returns a dict of the per-quantity differences: the maximum and the
+    99th percentile of the absolute difference of ``theta`` and ``phi`` (in
+    radians) and of the relative difference of ``v``, the fraction of
+    tracks whose hit pattern changed, and the ratio of the bytes of the
+    events, hits and tracks.
+    """
+    out = {}
+    for policy in ('float64', name):
+        with precision(policy):
+            events = deepcopy(source).observe(T, as_batch=True)
+            hits = detector.evaluate_batch(events)
+            tracks = reconstructor.reconstruct_batch(hits)
+        out[policy] = (events, hits, tracks)
+    (events, hits, tracks), (__, _hits, _tracks) = out['float64'], out[name]
+
+    diffs = {'v': numpy.abs(_tracks['v'] / tracks['v'] - 1),
+             'theta': numpy.abs(_tracks['theta'] - tracks['theta']),
+             'phi': numpy.abs(_wrap(_tracks['phi'] - tracks['phi']))}
+    report = {}
+    for p, diff in diffs.items():
+        diff = diff[numpy.isfinite(diff)]
+        report[p] = {'max': float(numpy.max(diff)) if diff.size else 0.,
+                     'q99': (float(numpy.percentile(diff, 99)) if diff.size
+                             else 0.)}
+    changed = numpy.any(hits['hit'] != _hits['hit'], axis=1)
+    report['changed_hits'] = float(numpy.mean(changed)) if changed.size else 0.
+    nbytes = [sum(x.nbytes for x in batches) for batches in out.values()]
+    report['nbytes_ratio'] = nbytes[1] / nbytes[0] if nbytes[0] else 1.
+    return report
@@ -0,0 +1,152 @@
+"""Optional per-stage instrumentation of the simulator."""
+import json
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+import numpy
+
+
+def _count(out):
+    """Returns the number of items in a stage's output."""
+    if isinstance(out, numpy.ndarray):
+        return out.shape[0] if out.ndim > 0 else 1
+    if isinstance(out, dict):
+        return 1
+    try:
+        return len(out)
+    except TypeError:
+        return 0
+
+
+def _nbytes(out):
+    """Returns the number of bytes of the arrays in a stage's output."""
+    nbytes = getattr(out, 'nbytes', None)
+    if nbytes is not None:
+        return nbytes
+    if isinstance(out, tuple):
+        return sum(_nbytes(x) for x in out)
+    return 0
+
+
+class Profiler:
+    r"""
+    A registry of per-stage statistics: wall time, number of calls,
+    number of output items and bytes of output arrays. Disabled by default,
+    in which case the instrumented functions only check a flag. Stages may
+    be nested, so a stage's time includes that of its sub-stages.
+
+    Statistics are per process; worker processes keep their own registry.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._stats = {}
+        self._callbacks = []
+        self._lock = Lock()
+
+    @property
+    def stats(self):
+        """Returns a copy of the per-stage statistics."""
+        with self._lock:
+            return {stage: dict(stats) for stage, stats in self._stats.items()}
+
+    def reset(self):
+        """Removes all recorded statistics."""
+        with self._lock:
+            self._stats = {}
+
+    def add_callback(self, callback):
+        """
+        Adds a callback that is called as ``callback(stage, record)`` after
+        every recorded call, where ``record`` is a dict with the ``time``,
+        ``items`` and ``nbytes`` of the call.
+        """
+        if not callable(callback):
+            raise ValueError("``callback`` must be callable.")
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        """Removes a callback."""
+        self._callbacks.remove(callback)
+
+    def record(self, stage, time, items=0, nbytes=0):
+        """Records a single call of ``stage``."""
+        with self._lock:
+            stats = self._stats.setdefault(
+                stage, {'calls': 0, 'time': 0., 'items': 0, 'nbytes': 0})
+            stats['calls'] += 1
+            stats['time'] += time
+            stats['items'] += items
+            stats['nbytes'] += nbytes
+        for callback in self._callbacks:
+            callback(stage, {'time': time, 'items': items, 'nbytes': nbytes})
+
+    def summary(self):
+        """Returns the statistics formatted as a table."""
+        lines = ['{:<32}{:>8}{:>12}{:>14}{:>14}{:>12}'.format(
+            'stage', 'calls', 'time [s]', 'items', 'items/s', 'MB')]
+        for stage, stats in sorted(self.stats.items()):
+            rate = stats['items'] / stats['time'] if stats['time'] > 0 else 0
+            lines.append('{:<32}{:>8}{:>12.4f}{:>14}{:>14.1f}{:>12.2f}'.format(
+                stage, stats['calls'], stats['time'], stats['items'], rate,
+                stats['nbytes'] / 1024**2))
+        return '\n'.join(lines)
+
+    def to_json(self, fname=None):
+        """
+        Returns the statistics as a JSON string. If ``fname`` is given also
+        writes them to that file.
+        """
+        out = json.dumps(self.stats, indent=1)
+        if fname is not None:
+            with open(fname, 'w') as f:
+                f.write(out)
+        return out
+
+
+# The package-wide registry
+PROFILER = Profiler()
+
+
+def instrument(stage):
+    """
+    Decorates a function so that its calls are recorded as ``stage`` in
+    :py:data:`PROFILER` when it is enabled.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return func(*args, **kwargs)
+            start = perf_counter()
+            out = func(*args, **kwargs)
+            PROFILER.record(stage, perf_counter() - start, _count(out),
+                            _nbytes(out))
+            return out
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def profile(reset=True):
+    """
+    Enables :py:data:`PROFILER` within the context and yields it. If
+    ``reset`` removes previously recorded statistics first.
+
+    Example:
+        >>> from simulator.profiling import profile
+        >>> with profile() as profiler:
+        ...     pass
+        >>> profiler.stats
+        {}
+    """
+    if reset:
+        PROFILER.reset()
+    enabled = PROFILER.enabled
+    PROFILER.enabled = True
+    try:
+        yield PROFILER
+    finally:
+        PROFILER.enabled = enabled
@@ -0,0 +1,223 @@
+"""Sparse time-binned pixel occupancy frames of a detector readout."""
+import os
+
+import numpy
+
+
+class OccupancyFrames:
+    r"""
+    Pixel hit counts per plate and readout time window, stored sparsely in
+    compressed sparse row (CSR) form. Each row is a non-empty
+    ``(frame, plate)`` pair, where frame ``k`` covers the times
+    ``[t0 + k * window, t0 + (k + 1) * window)``, and holds the sorted flat
+    IDs (``ypixel * Npixs + xpixel``) of its fired pixels and their hit
+    counts. Rows are sorted by frame and plate.
+
+    Hits are accumulated with :py:meth:`add` into a buffer of coordinate
+    (COO) chunks that is compacted into the CSR arrays only when these are
+    accessed, so that accumulating many readout chunks costs a single sort.
+    Frames of the same readout configuration are combined with
+    :py:meth:`merge`.
+
+    Parameters
+    ----------
+    window : float
+        Length of a readout time window.
+    Npixs : list of int
+        Number of pixels along each side of every plate.
+    t0 : float (optional)
+        Start time of the first window.
+    """
+
+    def __init__(self, window, Npixs, t0=0.):
+        if not window > 0:
+            raise ValueError("``window`` must be positive.")
+        self.window = float(window)
+        self.t0 = float(t0)
+        self.Npixs = numpy.asarray(Npixs, dtype=numpy.int64)
+        if self.Npixs.ndim != 1 or self.Npixs.size < 1:
+            raise ValueError("``Npixs`` must be a list of at least one plate.")
+        # Flat pixel IDs of every plate fit below this stride
+        self._stride = int(numpy.max(self.Npixs))**2
+        self._frame = numpy.zeros(0, dtype=numpy.int64)
+        self._plate = numpy.zeros(0, dtype=numpy.int32)
+        self._indptr = numpy.zeros(1, dtype=numpy.int64)
+        self._pixels = numpy.zeros(0, dtype=numpy.int32)
+        self._counts = numpy.zeros(0, dtype=numpy.int32)
+        self._pending = []
+
+    @property
+    def Nplates(self):
+        """Returns the number of plates."""
+        return self.Npixs.size
+
+    def _check(self, other):
+        """Checks that ``other`` has the same readout configuration."""
+        if not isinstance(other, OccupancyFrames):
+            raise ValueError("``other`` must be ``OccupancyFrames``.")
+        if (other.window != self.window or other.t0 != self.t0
+                or not numpy.array_equal(other.Npixs, self.Npixs)):
+            raise ValueError("Cannot merge frames of different windows, "
+                             "start times or plates.")
+
+    def _keys(self, frame, plate, pixel):
+        """Returns the sort keys of ``(frame, plate, pixel)`` triplets."""
+        return ((frame.astype(numpy.int64) * self.Nplates + plate)
+                * self._stride + pixel)
+
+    def add(self, t, plate, pixel):
+        """
+        Adds hits at times ``t`` on plates ``plate`` in flat pixels
+        ``pixel``. Hits before ``t0`` are ignored. Returns the frames.
+        """
+        t = numpy.asarray(t, dtype=float)
+        plate = numpy.asarray(plate, dtype=numpy.int64)
+        pixel = numpy.asarray(pixel, dtype=numpy.int64)
+        frame = numpy.floor((t - self.t0) / self.window).astype(numpy.int64)
+        keep = frame >= 0
+        keys = self._keys(frame[keep], plate[keep], pixel[keep])
+        self._pending.append((keys, numpy.ones(keys.size, dtype=numpy.int64)))
+        return self
+
+    def merge(self, other):
+        """
+        Adds the counts of ``other``, frames of the same window, start time
+        and plates. Returns the frames.
+        """
+        self._check(other)
+        frame, plate, pixel, counts = other.to_coo()
+        self._pending.append((self._keys(frame, plate, pixel),
+                              counts.astype(numpy.int64)))
+        return self
+
+    def _compact(self):
+        """Merges the pending COO chunks into the CSR arrays."""
+        if not self._pending:
+            return
+        frame, plate, pixel, counts = self._coo()
+        keys = [self._keys(frame, plate, pixel)]
+        weights = [counts.astype(numpy.int64)]
+        for _keys, _weights in self._pending:
+            keys.append(_keys)
+            weights.append(_weights)
+        self._pending = []
+        keys, inverse = numpy.unique(numpy.concatenate(keys),
+                                     return_inverse=True)
+        counts = numpy.bincount(inverse.ravel(),
+                                weights=numpy.concatenate(weights),
+                                minlength=keys.size)
+        pixel = keys % self._stride
+        row = keys // self._stride
+        rows, start = numpy.unique(row, return_index=True)
+        self._frame = rows // self.Nplates
+        self._plate = (rows % self.Nplates).astype(numpy.int32)
+        self._indptr = numpy.append(start, keys.size).astype(numpy.int64)
+        self._pixels = pixel.astype(numpy.int32)
+        self._counts = counts.astype(numpy.int32)
+
+    def _coo(self):
+        """Returns the compacted rows in COO form, ignoring pending chunks."""
+        repeats = numpy.diff(self._indptr)
+        return (numpy.repeat(self._frame, repeats),
+                numpy.repeat(self._plate, repeats), self._pixels,
+                self._counts)
+
+    def to_coo(self):
+        """
+        Returns the ``frame``, ``plate``, flat ``pixel`` and ``count`` of
+        every fired pixel as arrays, sorted by frame, plate and pixel.
+        """
+        self._compact()
+        return self._coo()
+
+    @property
+    def rows(self):
+        """Returns the frame and plate indices of the non-empty rows."""
+        self._compact()
+        return self._frame, self._plate
+
+    @property
+    def Nhits(self):
+        """Returns the total number of hits."""
+        self._compact()
+        return int(numpy.sum(self._counts, dtype=numpy.int64))
+
+    @property
+    def nbytes(self):
+        """Returns the number of bytes of the compacted arrays."""
+        self._compact()
+        return sum(x.nbytes for x in (self._frame, self._plate, self._indptr,
+                                      self._pixels, self._counts))
+
+    def frame(self, index, plate):
+        """
+        Returns the fired flat pixel IDs of ``plate`` in frame ``index`` and
+        their hit counts.
+        """
+        self._compact()
+        rows = numpy.nonzero((self._frame == index)
+                             & (self._plate == plate))[0]
+        if rows.size == 0:
+            return (numpy.zeros(0, dtype=numpy.int32),
+                    numpy.zeros(0, dtype=numpy.int32))
+        start, stop = self._indptr[rows[0]], self._indptr[rows[0] + 1]
+        return self._pixels[start:stop], self._counts[start:stop]
+
+    def dense(self, index, plate):
+        """
+        Returns the hit counts of ``plate`` in frame ``index`` as a dense
+        ``(Npixs, Npixs)`` image indexed by ``(ypixel, xpixel)``.
+        """
+        Npixs = int(self.Npixs[plate])
+        out = numpy.zeros(Npixs * Npixs, dtype=numpy.int32)
+        pixels, counts = self.frame(index, plate)
+        out[pixels] = counts
+        return out.reshape(Npixs, Npixs)
+
+    def occupancy(self):
+        """
+        Returns the frame and plate indices of the non-empty rows, the
+        fraction of their plate's pixels that fired and the fraction of
+        their hits that share a pixel with another hit (pile-up).
+        """
+        self._compact()
+        fired = numpy.diff(self._indptr)
+        rows = numpy.repeat(numpy.arange(fired.size), fired)
+        hits = numpy.bincount(rows, weights=self._counts,
+                              minlength=fired.size)
+        piled = numpy.bincount(rows, weights=numpy.where(
+            self._counts > 1, self._counts, 0), minlength=fired.size)
+        fraction = fired / self.Npixs[self._plate].astype(float)**2
+        with numpy.errstate(invalid='ignore'):
+            return self._frame, self._plate, fraction, piled / hits
+
+    def select(self, start, stop):
+        """Returns a copy of the frames ``start`` to ``stop``."""
+        frame, plate, pixel, counts = self.to_coo()
+        keep = (start <= frame) & (frame < stop)
+        out = type(self)(self.window, self.Npixs, t0=self.t0)
+        out._pending.append((out._keys(frame[keep], plate[keep], pixel[keep]),
+                             counts[keep].astype(numpy.int64)))
+        return out
+
+    def save(self, fname):
+        """Saves the frames to a ``.npz`` file."""
+        self._compact()
+        with open(fname + '.tmp', 'wb') as f:
+            numpy.savez(f, window=self.window, t0=self.t0, Npixs=self.Npixs,
+                        frame=self._frame, plate=self._plate,
+                        indptr=self._indptr, pixels=self._pixels,
+                        counts=self._counts)
+        os.replace(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads frames saved by :py:meth:`save`."""
+        with numpy.load(fname) as f:
+            out = cls(float(f['window']), f['Npixs'], t0=float(f['t0']))
+            out._frame = f['frame']
+            out._plate = f['plate']
+            out._indptr = f['indptr']
+            out._pixels = f['pixels']
+            out._counts = f['counts']
+        return out
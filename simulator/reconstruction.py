@@ -1,7 +1,103 @@
 """Vector reconstructtion script."""
 import numpy
 from itertools import combinations
-from scipy.special import comb
+
+from .batch import (HitBatch, TrackBatch)
+from .precision import get_precision
+from .profiling import instrument
+
+
+class _PlateIndex:
+    """
+    Index of a plate's hits by spatial cell and time. ``t``, ``x`` and
+    ``y`` are the hits in time order. Hits are sorted by the key
+    ``cell * Nhits + time rank``, so that the hits of a cell within a time
+    window form a contiguous range found by binary search.
+    """
+
+    def __init__(self, t, x, y, cell):
+        self.t, self.x, self.y = t, x, y
+        self.cell = cell
+        self.free = numpy.ones(t.size, dtype=bool)
+        cells, rank = numpy.unique(self.cell_id(x, y), return_inverse=True)
+        self._cells = cells
+        key = rank.ravel() * t.size + numpy.arange(t.size)
+        self._order = numpy.argsort(key)
+        self._keys = key[self._order]
+
+    def cell_id(self, x, y):
+        """Returns the IDs of the cells containing the positions."""
+        cx = numpy.floor(x / self.cell).astype(numpy.int64)
+        cy = numpy.floor(y / self.cell).astype(numpy.int64)
+        return (cx << 32) + cy
+
+    def window(self, cid, rlo, rhi):
+        """
+        Returns the ranges of the sorted hits within cells ``cid`` and
+        time ranks ``[rlo, rhi)``.
+        """
+        pos = numpy.searchsorted(self._cells, cid)
+        pos = numpy.minimum(pos, self._cells.size - 1)
+        present = self._cells[pos] == cid
+        m = self.t.size
+        lo = numpy.searchsorted(self._keys, pos * m + rlo)
+        hi = numpy.searchsorted(self._keys, pos * m + rhi)
+        hi[~present] = lo[~present]
+        return lo, hi
+
+    def match(self, tmin, tmax, xpred, ypred, pos_tol, tpred=None,
+              time_tol=None, max_candidates=64):
+        """
+        Matches each of ``n`` track candidates to at most one free hit.
+        Candidate hits of each track are those within its time window
+        ``[tmin, tmax]`` and the cells around its predicted position, and
+        are scored by their squared distance to the predicted position in
+        units of ``pos_tol``, plus that to the predicted time in units of
+        ``time_tol`` if ``tpred`` is given. Scores above 1 are rejected. A
+        hit claimed by several tracks goes to the one with the lowest score.
+
+        Returns the indices of the matched hits, -1 for unmatched tracks.
+        """
+        n = tmin.size
+        out = numpy.full(n, -1, dtype=numpy.intp)
+        if n == 0 or self.t.size == 0:
+            return out
+        rlo = numpy.searchsorted(self.t, tmin, side='left')
+        rhi = numpy.searchsorted(self.t, tmax, side='right')
+        # The cells are at least twice the tolerance, so that the
+        # acceptance region overlaps at most 2 x 2 of them
+        x0, y0 = xpred - pos_tol, ypred - pos_tol
+        blocks = []
+        for dx in (0, self.cell):
+            for dy in (0, self.cell):
+                lo, hi = self.window(self.cell_id(x0 + dx, y0 + dy), rlo, rhi)
+                K = min(int(numpy.max(hi - lo)), max_candidates)
+                idx = lo[:, None] + numpy.arange(K)
+                valid = idx < hi[:, None]
+                blocks.append(numpy.where(
+                    valid, self._order[numpy.where(valid, idx, 0)], -1))
+        # Candidate matrix of shape (n, K), -1 padded
+        idx = numpy.concatenate(blocks, axis=1)
+        if idx.shape[1] == 0:
+            return out
+        valid = idx >= 0
+        idx[~valid] = 0
+        valid &= self.free[idx]
+        cost = ((self.x[idx] - xpred[:, None])**2
+                + (self.y[idx] - ypred[:, None])**2) / pos_tol**2
+        if tpred is not None:
+            cost += ((self.t[idx] - tpred[:, None]) / time_tol)**2
+        cost[~valid] = numpy.inf
+        rows = numpy.arange(n)
+        best = numpy.argmin(cost, axis=1)
+        score = cost[rows, best]
+        matched = numpy.nonzero(score <= 1)[0]
+        # Resolve conflicts in favour of the lowest score
+        matched = matched[numpy.argsort(score[matched], kind='stable')]
+        choice = idx[matched, best[matched]]
+        __, first = numpy.unique(choice, return_index=True)
+        out[matched[first]] = choice[first]
+        return out
 
 
 class Reconstructor(object):
@@ -28,15 +124,19 @@ class Reconstructor(object):
         velocity = ds / dt
         return velocity
 
-    def reconstruct(self, data):
+    @instrument('reconstruction.reconstruct')
+    def reconstruct(self, data, summary=None):
         """
-        Reconstructs the averaged velocity and speed of events.
+        Reconstructs the averaged velocity and speed of events. If given,
+        the reconstructed tracks are added to ``summary``, a
+        :py:class:`simulator.summary.TrackSummary`.
         """
         out = [None] * len(data)
         # Get the speed and velocities
         for i, event in enumerate(data):
             stats = {}
-            v = numpy.empty(shape=(comb(len(event), 2, exact=True), 3))
+            # Number of pairs of plates
+            v = numpy.empty(shape=(len(event) * (len(event) - 1) // 2, 3))
             for j, pair in enumerate(combinations(event, 2)):
                 v[j, :] = self.pair_velocity(pair)
             # Append the speed
@@ -48,4 +148,214 @@ class Reconstructor(object):
         # Get the angular distribution
         for event in out:
             event.update(self.ang_dist(event))
+        if summary is not None:
+            summary.update(out)
         return out
+
+    @instrument('reconstruction.reconstruct_batch')
+    def reconstruct_batch(self, hits, summary=None):
+        """
+        Reconstructs the velocity and speed of all events in a
+        :py:class:`simulator.batch.HitBatch` at once. Fits a straight line
+        to the position as a function of time over all plates by least
+        squares. Returns a :py:class:`simulator.batch.TrackBatch`.
+
+        Only the plates marked in the ``hit`` column enter the fit. Events
+        with fewer than two hits are returned with ``NaN`` velocities.
+
+        The fit is done in double precision and the tracks are cast to the
+        package-wide :py:class:`simulator.precision.Precision`.
+
+        If given, the tracks are added to ``summary``, a
+        :py:class:`simulator.summary.TrackSummary`, so that their
+        distributions can be accumulated without keeping the tracks.
+        """
+        if hits.Nplates < 2:
+            raise ValueError("At least two plates are needed.")
+        hit = hits['hit']
+        nhits = numpy.sum(hit, axis=1)
+        t = numpy.where(hit, hits['t'], 0.)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # Centre the times so that the slope decouples from the intercept
+            dt = t - (numpy.sum(t, axis=1) / nhits)[:, None]
+            dt[~hit] = 0.
+            norm = numpy.sum(dt**2, axis=1)
+            norm[nhits < 2] = numpy.nan
+            out = {'v' + p: numpy.sum(dt * numpy.where(hit, hits[p], 0.),
+                                      axis=1) / norm
+                   for p in ('x', 'y', 'z')}
+            out['v'] = numpy.sqrt(out['vx']**2 + out['vy']**2
+                                  + out['vz']**2)
+            out.update(self.ang_dist(out))
+        dtype = get_precision().float
+        out = {p: x.astype(dtype, copy=False) for p, x in out.items()}
+        out['nhits'] = nhits
+        tracks = TrackBatch(out)
+        if summary is not None:
+            summary.update(tracks)
+        return tracks
+
+    @instrument('reconstruction.find_tracks')
+    def find_tracks(self, stream, Nplates=None, vz_min=0.05, pos_tol=0.05,
+                    time_tol=1e-6, min_hits=2, max_candidates=64):
+        """
+        Associates the hits of an unlabelled, time-ordered
+        :py:class:`simulator.batch.HitStream` into tracks of particles
+        emitted from the origin towards plates at positive ``z``.
+
+        Each plate's hits are indexed by spatial cell and time. Free hits
+        of a plate seed tracks with the hits of a later plate whose times
+        lie within the flight time at ``vz_min`` and whose positions lie
+        within ``pos_tol`` of the straight line from the origin. The seeds'
+        vertical speed then predicts the times on the remaining plates,
+        which are matched within ``time_tol`` and ``pos_tol``. Tracks with
+        fewer than ``min_hits`` hits are dropped and their hits freed.
+        Every match is a windowed binary search over the sorted hits, so
+        association costs ``O(N log N)`` in the number of hits.
+
+        Parameters
+        ----------
+        stream : :py:class:`simulator.batch.HitStream`
+            The hits.
+        Nplates : int (optional)
+            Number of plates. By default one more than the largest plate
+            index in the stream.
+        vz_min : float (optional)
+            Smallest vertical speed of a track.
+        pos_tol : float (optional)
+            Position tolerance. Should cover a few pixel pitches.
+        time_tol : float (optional)
+            Time tolerance of the predicted hits.
+        min_hits : int (optional)
+            Smallest number of hits of a track.
+        max_candidates : int (optional)
+            Maximum number of candidate hits per track and plate.
+
+        Returns
+        -------
+        tracks : :py:class:`simulator.batch.HitBatch`
+            Hits of shape ``(Ntracks, Nplates)`` ordered by the time of the
+            tracks' first hit, with an extra ``index`` column of the hits'
+            positions in ``stream``, -1 where a plate was missed.
+        """
+        plate = stream['plate']
+        if Nplates is None:
+            Nplates = int(numpy.max(plate)) + 1 if len(stream) else 0
+        if Nplates < 2:
+            raise ValueError("At least two plates are needed.")
+        if min_hits < 2:
+            raise ValueError("``min_hits`` must be at least 2.")
+        t, x, y, z = (stream[p] for p in ('t', 'x', 'y', 'z'))
+        # Per plate stream indices in time order, as the stream is sorted
+        order = numpy.argsort(plate, kind='stable')
+        bounds = numpy.searchsorted(plate[order], numpy.arange(Nplates + 1))
+        hits = [order[bounds[p]:bounds[p + 1]] for p in range(Nplates)]
+        index = [_PlateIndex(t[h], x[h], y[h], 2 * pos_tol) for h in hits]
+        zplate = numpy.array([z[h[0]] if h.size else numpy.nan for h in hits])
+        zorder = [p for p in numpy.argsort(zplate) if hits[p].size]
+
+        found = []
+        for i, a in enumerate(zorder):
+            for j, b in enumerate(zorder[i + 1:], start=i + 1):
+                seeds = numpy.nonzero(index[a].free)[0]
+                if seeds.size == 0:
+                    break
+                ia = hits[a][seeds]
+                scale = zplate[b] / zplate[a]
+                match = index[b].match(
+                    t[ia], t[ia] + (zplate[b] - zplate[a]) / vz_min,
+                    x[ia] * scale, y[ia] * scale, pos_tol,
+                    max_candidates=max_candidates)
+                ok = match >= 0
+                track = numpy.full((numpy.sum(ok), Nplates), -1,
+                                   dtype=numpy.intp)
+                track[:, a] = ia[ok]
+                track[:, b] = hits[b][match[ok]]
+                last = track[:, b]
+                vz = (zplate[b] - zplate[a]) / (t[last] - t[ia[ok]])
+                rows = numpy.arange(track.shape[0])
+                index[a].free[seeds[ok]] = False
+                index[b].free[match[ok]] = False
+                for c in zorder[j + 1:]:
+                    tpred = t[last] + (zplate[c] - z[last]) / vz
+                    scale = zplate[c] / z[last]
+                    match = index[c].match(
+                        tpred - time_tol, tpred + time_tol, x[last] * scale,
+                        y[last] * scale, pos_tol, tpred, time_tol,
+                        max_candidates)
+                    ok = match >= 0
+                    track[rows[ok], c] = hits[c][match[ok]]
+                    last = last.copy()
+                    last[ok] = hits[c][match[ok]]
+                    index[c].free[match[ok]] = False
+                # Free the hits of short tracks for later seeds
+                short = numpy.sum(track >= 0, axis=1) < min_hits
+                for p in range(Nplates):
+                    k = track[short, p]
+                    k = k[k >= 0]
+                    # The plate's stream indices are increasing
+                    index[p].free[numpy.searchsorted(hits[p], k)] = True
+                found.append(track[~short])
+
+        index = (numpy.concatenate(found) if found
+                 else numpy.zeros((0, Nplates), dtype=numpy.intp))
+        hit = index >= 0
+        safe = numpy.where(hit, index, 0)
+        if index.size:
+            first = numpy.min(numpy.where(hit, t[safe], numpy.inf), axis=1)
+            order = numpy.argsort(first, kind='stable')
+            index, hit, safe = index[order], hit[order], safe[order]
+        out = {'index': index, 'hit': hit}
+        for p in ('x', 'y', 'z', 't'):
+            out[p] = numpy.where(hit, stream[p][safe], numpy.nan)
+        for p in ('xpixel', 'ypixel', 'pixel'):
+            out[p] = numpy.where(hit, stream[p][safe], -1)
+        return HitBatch(out)
+
+    @staticmethod
+    def track_report(stream, tracks):
+        """
+        Compares tracks found by :py:meth:`find_tracks` against the true
+        ``event`` column of the stream. A track is pure if all its hits
+        belong to one particle, merged if more than half of them do and
+        fake otherwise. A particle with at least two hits is found if it
+        holds the majority of a pure or merged track.
+
+        Returns a dict of the number of ``particles`` and ``tracks``, the
+        ``efficiency`` and the ``fake_rate`` and ``merged_rate`` per track.
+        """
+        event = stream['event']
+        index = tracks['index']
+        hit = index >= 0
+        labels = numpy.where(hit, event[numpy.where(hit, index, 0)], -1)
+        # Number of hits of each hit's particle within its track
+        same = ((labels[:, :, None] == labels[:, None, :])
+                & hit[:, :, None] & hit[:, None, :])
+        counts = numpy.sum(same, axis=2)
+        best = numpy.argmax(counts, axis=1)
+        rows = numpy.arange(len(tracks))
+        majority = counts[rows, best]
+        nhits = numpy.sum(hit, axis=1)
+        fake = 2 * majority <= nhits
+        merged = ~fake & (majority < nhits)
+
+        particles, n = numpy.unique(event, return_counts=True)
+        particles = particles[n >= 2]
+        found = numpy.isin(particles, labels[rows, best][~fake])
+        with numpy.errstate(invalid='ignore'):
+            return {'particles': particles.size, 'tracks': len(tracks),
+                    'efficiency': numpy.mean(found) if found.size
+                    else numpy.nan,
+                    'fake_rate': numpy.mean(fake) if fake.size else numpy.nan,
+                    'merged_rate': numpy.mean(merged) if merged.size
+                    else numpy.nan}
+
+    def iter_reconstruct(self, batches, summary=None):
+        """
+        Reconstructs an iterable of :py:class:`simulator.batch.HitBatch`
+        chunk by chunk. Yields the corresponding
+        :py:class:`simulator.batch.TrackBatch`, which are also added to
+        ``summary`` if given.
+        """
+        for hits in batches:
+            yield self.reconstruct_batch(hits, summary=summary)
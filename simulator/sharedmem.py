@@ -0,0 +1,227 @@
+"""
+Shared-memory batch buffers and a multi-process detector evaluator.
+Requires Python 3.8 or later.
+"""
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+
+from .batch import (EventBatch, HitBatch)
+from .precision import get_precision
+
+
+class SharedBatchBuffer:
+    r"""
+    Columns of a batch stored in shared memory segments of a fixed
+    capacity (number of events). Processes attach to the same segments
+    through :py:meth:`describe` and :py:meth:`attach`, so columns are
+    shared without pickling.
+
+    Parameters
+    ----------
+    spec : dict
+        Column names mapped to ``(dtype, shape)`` tuples, where ``shape``
+        is the column's shape without the event axis.
+    capacity : int
+        Maximum number of events.
+    names : dict (optional)
+        Column names mapped to names of existing segments to attach to. If
+        ``None`` new segments are created.
+    """
+
+    def __init__(self, spec, capacity, names=None):
+        if not isinstance(capacity, int) or capacity < 1:
+            raise ValueError("``capacity`` must be a positive integer.")
+        self._spec = {p: (numpy.dtype(dtype).str, tuple(shape))
+                      for p, (dtype, shape) in spec.items()}
+        self._capacity = capacity
+        self._owner = names is None
+        self._segments = {}
+        self._columns = {}
+        for p, (dtype, shape) in self._spec.items():
+            shape = (capacity, ) + shape
+            nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+            if self._owner:
+                segment = SharedMemory(create=True, size=max(nbytes, 1))
+            else:
+                segment = SharedMemory(name=names[p])
+            self._segments[p] = segment
+            self._columns[p] = numpy.ndarray(shape, dtype=dtype,
+                                             buffer=segment.buf)
+
+    @property
+    def capacity(self):
+        """Returns the maximum number of events."""
+        return self._capacity
+
+    @property
+    def columns(self):
+        """Returns the column names."""
+        return tuple(self._spec.keys())
+
+    def describe(self):
+        """
+        Returns a picklable description from which other processes can
+        attach to the segments with :py:meth:`attach`.
+        """
+        return {'spec': self._spec, 'capacity': self._capacity,
+                'names': {p: seg.name for p, seg in self._segments.items()}}
+
+    @classmethod
+    def attach(cls, description):
+        """Attaches to the segments of a :py:meth:`describe` output."""
+        return cls(description['spec'], description['capacity'],
+                   names=description['names'])
+
+    def __getitem__(self, name):
+        """Returns the full-capacity array of a column."""
+        return self._columns[name]
+
+    def write(self, batch, start=0):
+        """
+        Copies the buffer's columns of ``batch`` into rows ``start`` to
+        ``start + len(batch)``.
+        """
+        stop = start + len(batch)
+        if stop > self.capacity:
+            raise ValueError("The batch does not fit into the buffer.")
+        for p in self.columns:
+            self._columns[p][start:stop] = batch[p]
+
+    def view(self, cls, start, stop):
+        """
+        Returns rows ``start`` to ``stop`` as a batch of type ``cls`` whose
+        columns are views of the shared memory.
+        """
+        return cls({p: x[start:stop] for p, x in self._columns.items()})
+
+    def close(self):
+        """
+        Releases this process' views of the segments and unlinks them if
+        this buffer created them.
+        """
+        self._columns = {}
+        for segment in self._segments.values():
+            segment.close()
+            if self._owner:
+                segment.unlink()
+        self._segments = {}
+
+
+# Per worker process state, set by ``_init_worker``
+_WORKER = {}
+
+
+def _init_worker(detector, events, hits):
+    """Attaches a worker process to the shared event and hit buffers."""
+    _WORKER['detector'] = detector
+    _WORKER['events'] = SharedBatchBuffer.attach(events)
+    _WORKER['hits'] = SharedBatchBuffer.attach(hits)
+
+
+def _evaluate_range(bounds):
+    """
+    Evaluates the events in rows ``start`` to ``stop`` of the shared event
+    buffer and writes the hits into the same rows of the hit buffer.
+    """
+    start, stop = bounds
+    events = _WORKER['events'].view(EventBatch, start, stop)
+    hits = _WORKER['detector'].evaluate_batch(events)
+    _WORKER['hits'].write(hits, start)
+
+
+class SharedEvaluator:
+    r"""
+    Evaluates events on a :py:class:`simulator.Detector` over a persistent
+    process pool. Events and hits live in shared memory buffers, so workers
+    receive only row ranges and read events and write hits in place. The
+    pool and the buffers are created once and reused for every call; close
+    them with :py:meth:`close` or use the evaluator as a context manager.
+    The buffers' types follow the package-wide
+    :py:class:`simulator.precision.Precision` at construction.
+
+    Parameters
+    ----------
+    detector : :py:class:`simulator.Detector`
+        The detector.
+    capacity : int
+        Number of events the buffers hold. Larger batches are evaluated in
+        pieces of this size.
+    workers : int (optional)
+        Number of worker processes.
+    """
+
+    def __init__(self, detector, capacity, workers=2):
+        if not isinstance(workers, int) or workers < 1:
+            raise ValueError("``workers`` must be a positive integer.")
+        self._workers = workers
+        policy = get_precision()
+        spec = {p: (policy.time if p == 't' else policy.float, ())
+                for p in EventBatch._required}
+        self._events = SharedBatchBuffer(spec, capacity)
+        # The hits' columns are those of an empty evaluation
+        empty = EventBatch({p: numpy.zeros(0, dtype=dtype)
+                            for p, (dtype, __) in spec.items()})
+        hits = detector.evaluate_batch(empty)
+        spec = {p: (hits[p].dtype, hits[p].shape[1:]) for p in hits.columns}
+        self._hits = SharedBatchBuffer(spec, capacity)
+        self._pool = Pool(workers, initializer=_init_worker,
+                          initargs=(detector, self._events.describe(),
+                                    self._hits.describe()))
+
+    @property
+    def capacity(self):
+        """Returns the number of events the buffers hold."""
+        return self._events.capacity
+
+    @property
+    def event_buffer(self):
+        """
+        Returns the shared event buffer, which can be filled in place
+        before calling :py:meth:`evaluate_buffer`.
+        """
+        return self._events
+
+    def evaluate_buffer(self, N):
+        """
+        Evaluates the first ``N`` events of the shared event buffer.
+        Returns a :py:class:`simulator.batch.HitBatch` of views of the
+        shared hit buffer, valid until the next evaluation.
+        """
+        if not 0 <= N <= self.capacity:
+            raise ValueError("``N`` must be between 0 and the capacity.")
+        step = -(-N // self._workers) if N > 0 else 1
+        bounds = [(start, min(start + step, N)) for start in range(0, N, step)]
+        self._pool.map(_evaluate_range, bounds)
+        return self._hits.view(HitBatch, 0, N)
+
+    def evaluate(self, events):
+        """
+        Evaluates a :py:class:`simulator.batch.EventBatch` of any length.
+        Returns a :py:class:`simulator.batch.HitBatch` that owns its data.
+        """
+        out = []
+        for start in range(0, len(events), self.capacity):
+            piece = events[start:start + self.capacity]
+            self._events.write(piece)
+            hits = self.evaluate_buffer(len(piece))
+            out.append(HitBatch({p: hits[p].copy() for p in hits.columns}))
+        if not out:
+            return self.evaluate_buffer(0)[0:0]
+        return HitBatch.concatenate(out)
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._events.close()
+        self._hits.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
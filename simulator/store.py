@@ -0,0 +1,283 @@
+"""Chunked, appendable and memory-mapped on-disk store of batches."""
+import json
+import os
+
+import numpy
+
+from . import batch as _batch
+
+INDEX_FNAME = 'index.json'
+CHUNKS_FNAME = 'chunks.bin'
+# Record of a chunk in the chunks file. Times are NaN if the chunk has no
+# time column
+CHUNK_DTYPE = numpy.dtype([('start', '<i8'), ('stop', '<i8'),
+                           ('tmin', '<f8'), ('tmax', '<f8')])
+
+
+def _column_fname(path, table, column):
+    """Returns the file name of a column of a table."""
+    return os.path.join(path, '{}.{}.bin'.format(table, column))
+
+
+def _write_index(path, index):
+    """
+    Writes the index atomically, so that a crash leaves either the old or
+    the new index on disk.
+    """
+    fname = os.path.join(path, INDEX_FNAME)
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(fname + '.tmp', fname)
+
+
+def _read_index(path):
+    """Reads the index of the store at ``path``."""
+    with open(os.path.join(path, INDEX_FNAME), 'r') as f:
+        return json.load(f)
+
+
+def _read_chunks(path, nchunks):
+    """
+    Reads the first ``nchunks`` records of the chunks file. Records written
+    after the last index update are ignored.
+    """
+    fname = os.path.join(path, CHUNKS_FNAME)
+    if nchunks == 0:
+        return numpy.zeros(0, dtype=CHUNK_DTYPE)
+    return numpy.fromfile(fname, dtype=CHUNK_DTYPE, count=nchunks)
+
+
+def _store_files(path, index):
+    """Returns the data files of the store described by ``index``."""
+    fnames = [os.path.join(path, CHUNKS_FNAME)]
+    for table, info in (index['tables'] or {}).items():
+        fnames += [_column_fname(path, table, p) for p in info['columns']]
+    return fnames
+
+
+class StoreWriter:
+    r"""
+    Appends chunks of batches to an on-disk store. Each column is stored in
+    its own raw binary file. The chunks' event ID (row) ranges and time
+    ranges are appended as fixed-size records to a chunks file, and a small
+    index records the number of rows and chunks and the tables. The index
+    is only updated once a chunk's data and record have been written, so a
+    crashed run keeps every chunk written before the crash, and appending
+    costs the same regardless of the number of chunks.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store.
+    time_column : str (optional)
+        Column, in the form ``'table.column'``, whose range is recorded per
+        chunk for time queries. Its values must be ordered across chunks.
+        Ignored if not present.
+    overwrite : bool (optional)
+        Whether to overwrite an existing store at ``path``. Only the files
+        of that store are removed.
+    """
+
+    def __init__(self, path, time_column='events.t', overwrite=False):
+        if os.path.exists(os.path.join(path, INDEX_FNAME)):
+            if not overwrite:
+                raise ValueError("Store `{}` already exists.".format(path))
+            for fname in _store_files(path, _read_index(path)):
+                if os.path.exists(fname):
+                    os.remove(fname)
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._index = {'nrows': 0, 'nchunks': 0, 'tables': None,
+                       'time_column': time_column}
+        # Start from an empty chunks file
+        open(os.path.join(path, CHUNKS_FNAME), 'wb').close()
+        _write_index(path, self._index)
+
+    @classmethod
+    def resume(cls, path, nrows):
+        """
+        Reopens the store at ``path`` for appending after its first
+        ``nrows`` rows, which must end a chunk. Chunks written after them,
+        e.g. by a run that crashed after its last checkpoint, are removed
+        and the data files truncated.
+        """
+        index = _read_index(path)
+        chunks = _read_chunks(path, index['nchunks'])
+        ends = numpy.append(0, chunks['stop'])
+        if nrows not in ends:
+            raise ValueError("``nrows`` must be at the end of a chunk.")
+        index['nchunks'] = int(numpy.sum(chunks['stop'] <= nrows))
+        index['nrows'] = nrows
+        os.truncate(os.path.join(path, CHUNKS_FNAME),
+                    index['nchunks'] * CHUNK_DTYPE.itemsize)
+        for table, info in (index['tables'] or {}).items():
+            for p, column in info['columns'].items():
+                fname = _column_fname(path, table, p)
+                rowbytes = (numpy.dtype(column['dtype']).itemsize
+                            * int(numpy.prod(column['shape'])))
+                if os.path.exists(fname):
+                    os.truncate(fname, nrows * rowbytes)
+        _write_index(path, index)
+        out = cls.__new__(cls)
+        out._path = path
+        out._index = index
+        return out
+
+    @property
+    def path(self):
+        """Returns the directory of the store."""
+        return self._path
+
+    @property
+    def nrows(self):
+        """Returns the number of rows (events) written so far."""
+        return self._index['nrows']
+
+    def _check_tables(self, batches):
+        """
+        Checks that ``batches`` match the tables of the store. Sets the
+        tables on the first call.
+        """
+        tables = {}
+        for table, batch in batches.items():
+            tables[table] = {
+                'type': type(batch).__name__,
+                'columns': {p: {'dtype': batch[p].dtype.str,
+                                'shape': list(batch[p].shape[1:])}
+                            for p in batch.columns}}
+        if self._index['tables'] is None:
+            self._index['tables'] = tables
+        elif tables != self._index['tables']:
+            raise ValueError("Batches do not match the store's tables.")
+
+    def append(self, **batches):
+        """
+        Appends a chunk. Each keyword is a table name and its value a
+        :py:class:`simulator.batch.ColumnBatch`; all batches must have the
+        same length. Event IDs are assigned by row, so the chunk's events
+        get IDs ``nrows, nrows + 1, ...``. Returns the chunk's event IDs
+        as a ``(start, stop)`` tuple.
+        """
+        sizes = set(len(batch) for batch in batches.values())
+        if len(sizes) != 1:
+            raise ValueError("Batches must have the same length.")
+        self._check_tables(batches)
+        size = sizes.pop()
+        for table, batch in batches.items():
+            for p in batch.columns:
+                with open(_column_fname(self.path, table, p), 'ab') as f:
+                    numpy.ascontiguousarray(batch[p]).tofile(f)
+
+        start = self.nrows
+        chunk = numpy.array([(start, start + size, numpy.nan, numpy.nan)],
+                            dtype=CHUNK_DTYPE)
+        table, __, column = self._index['time_column'].partition('.')
+        if size > 0 and table in batches and column in batches[table]:
+            t = batches[table][column]
+            chunk['tmin'], chunk['tmax'] = t.min(), t.max()
+        # Records past the index's count, left by a crash, are overwritten
+        with open(os.path.join(self.path, CHUNKS_FNAME), 'r+b') as f:
+            f.seek(self._index['nchunks'] * CHUNK_DTYPE.itemsize)
+            chunk.tofile(f)
+            f.truncate()
+        self._index['nchunks'] += 1
+        self._index['nrows'] += size
+        _write_index(self.path, self._index)
+        return start, start + size
+
+
+class StoreReader:
+    r"""
+    Reads a store written by :py:class:`StoreWriter`. Columns are
+    memory-mapped read-only, so slicing does not load the files.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._index = _read_index(path)
+        self._chunks = _read_chunks(path, self._index['nchunks'])
+        self._columns = {}
+
+    @property
+    def nrows(self):
+        """Returns the number of rows (events) in the store."""
+        return self._index['nrows']
+
+    @property
+    def tables(self):
+        """Returns the table names."""
+        tables = self._index['tables']
+        return tuple() if tables is None else tuple(tables.keys())
+
+    @property
+    def chunks(self):
+        """
+        Returns the chunk records as dicts of their ``start`` and ``stop``
+        rows and, if recorded, their ``tmin`` and ``tmax`` times.
+        """
+        out = []
+        for chunk in self._chunks.tolist():
+            record = {'start': chunk[0], 'stop': chunk[1]}
+            if not numpy.isnan(chunk[2]):
+                record.update({'tmin': chunk[2], 'tmax': chunk[3]})
+            out.append(record)
+        return out
+
+    def __len__(self):
+        return self.nrows
+
+    def column(self, table, column):
+        """Returns a read-only memory map of a column of a table."""
+        key = (table, column)
+        if key not in self._columns:
+            info = self._index['tables'][table]['columns'][column]
+            shape = (self.nrows, ) + tuple(info['shape'])
+            dtype = numpy.dtype(info['dtype'])
+            if self.nrows == 0:
+                self._columns[key] = numpy.empty(shape, dtype=dtype)
+            else:
+                self._columns[key] = numpy.memmap(
+                    _column_fname(self._path, table, column), dtype=dtype,
+                    mode='r', shape=shape)
+        return self._columns[key]
+
+    def read(self, start=0, stop=None, tables=None):
+        """
+        Returns the rows (event IDs) ``start`` to ``stop`` as a dict of
+        batches, one per table. The columns are views of the memory maps.
+        """
+        if tables is None:
+            tables = self.tables
+        out = {}
+        for table in tables:
+            info = self._index['tables'][table]
+            cls = getattr(_batch, info['type'], _batch.ColumnBatch)
+            out[table] = cls({p: self.column(table, p)[start:stop]
+                              for p in info['columns']})
+        return out
+
+    def read_time(self, tmin, tmax, tables=None):
+        """
+        Returns the rows whose time column is within ``[tmin, tmax)`` as a
+        dict of batches. Only chunks whose time range overlaps the
+        interval are searched.
+        """
+        chunks = self._chunks[~numpy.isnan(self._chunks['tmin'])]
+        if chunks.size == 0:
+            return self.read(0, 0, tables)
+        first = numpy.searchsorted(chunks['tmax'], tmin, side='left')
+        last = numpy.searchsorted(chunks['tmin'], tmax, side='left')
+        if first >= last:
+            return self.read(0, 0, tables)
+        start = int(chunks[first]['start'])
+        stop = int(chunks[last - 1]['stop'])
+        table, __, column = self._index['time_column'].partition('.')
+        t = self.column(table, column)[start:stop]
+        stop = start + numpy.searchsorted(t, tmax, side='left')
+        start = start + numpy.searchsorted(t, tmin, side='left')
+        return self.read(start, stop, tables)
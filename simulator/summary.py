@@ -0,0 +1,356 @@
+"""Mergeable fixed-memory accumulators of reconstructed track statistics."""
+import json
+import os
+
+import numpy
+
+# Reconstructed quantities that are summarised
+SUMMARISED = ('v', 'theta', 'phi')
+
+
+def _finite(values):
+    """Returns the flattened finite values and the number of the others."""
+    values = numpy.asarray(values, dtype=float).ravel()
+    mask = numpy.isfinite(values)
+    return values[mask], values.size - numpy.sum(mask)
+
+
+class Histogram:
+    r"""
+    A fixed-binning histogram that is filled incrementally. Values below
+    the first or above the last edge are counted as ``underflow`` and
+    ``overflow``, non-finite values as ``invalid``. The last bin includes
+    its upper edge.
+
+    Parameters
+    ----------
+    edges : numpy.ndarray
+        Monotonically increasing bin edges.
+    """
+
+    def __init__(self, edges):
+        self.edges = numpy.asarray(edges, dtype=float)
+        if self.edges.ndim != 1 or self.edges.size < 2:
+            raise ValueError("``edges`` must be a 1-dimensional array of at "
+                             "least two edges.")
+        if not numpy.all(numpy.diff(self.edges) > 0):
+            raise ValueError("``edges`` must be monotonically increasing.")
+        self.counts = numpy.zeros(self.edges.size - 1, dtype=numpy.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.invalid = 0
+
+    @property
+    def total(self):
+        """Returns the number of filled values, including those outside."""
+        return (int(numpy.sum(self.counts)) + self.underflow + self.overflow
+                + self.invalid)
+
+    def fill(self, values):
+        """Adds ``values`` to the histogram."""
+        values, invalid = _finite(values)
+        self.invalid += int(invalid)
+        index = numpy.searchsorted(self.edges, values, side='right') - 1
+        # The last edge belongs to the last bin
+        index[values == self.edges[-1]] = self.counts.size - 1
+        inside = (index >= 0) & (index < self.counts.size)
+        self.underflow += int(numpy.sum(index < 0))
+        self.overflow += int(numpy.sum(index >= self.counts.size))
+        self.counts += numpy.bincount(index[inside],
+                                      minlength=self.counts.size)
+        return self
+
+    def _check(self, other):
+        """Checks that ``other`` has the same type and binning."""
+        if type(other) is not type(self):
+            raise ValueError("Cannot merge a {} into a {}.".format(
+                type(other).__name__, type(self).__name__))
+        if not numpy.array_equal(self.edges, other.edges):
+            raise ValueError("Cannot merge histograms of different edges.")
+
+    def merge(self, other):
+        """Adds the counts of ``other``, a histogram of the same edges."""
+        self._check(other)
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.invalid += other.invalid
+        return self
+
+    def empty(self):
+        """Returns an empty histogram of the same edges."""
+        return type(self)(self.edges)
+
+    def to_dict(self):
+        """Returns the histogram as a JSON serializable dict."""
+        return {'edges': self.edges.tolist(), 'counts': self.counts.tolist(),
+                'underflow': self.underflow, 'overflow': self.overflow,
+                'invalid': self.invalid}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns a histogram from the output of :py:meth:`to_dict`."""
+        out = cls(data['edges'])
+        out.counts[...] = data['counts']
+        for p in ('underflow', 'overflow', 'invalid'):
+            setattr(out, p, data[p])
+        return out
+
+
+class Histogram2D:
+    r"""
+    A fixed-binning 2-dimensional histogram that is filled incrementally.
+    Pairs outside the edges are counted as ``overflow`` and pairs with a
+    non-finite value as ``invalid``.
+
+    Parameters
+    ----------
+    xedges, yedges : numpy.ndarray
+        Monotonically increasing bin edges along each axis.
+    """
+
+    def __init__(self, xedges, yedges):
+        self.x = Histogram(xedges)
+        self.y = Histogram(yedges)
+        self.edges = (self.x.edges, self.y.edges)
+        self.counts = numpy.zeros((self.x.counts.size, self.y.counts.size),
+                                  dtype=numpy.int64)
+        self.overflow = 0
+        self.invalid = 0
+
+    def _index(self, hist, values):
+        """Returns the bin indices along an axis, -1 outside the edges."""
+        index = numpy.searchsorted(hist.edges, values, side='right') - 1
+        index[values == hist.edges[-1]] = hist.counts.size - 1
+        index[index >= hist.counts.size] = -1
+        return index
+
+    def fill(self, x, y):
+        """Adds the pairs ``(x, y)`` to the histogram."""
+        x = numpy.asarray(x, dtype=float).ravel()
+        y = numpy.asarray(y, dtype=float).ravel()
+        valid = numpy.isfinite(x) & numpy.isfinite(y)
+        self.invalid += int(x.size - numpy.sum(valid))
+        i, j = self._index(self.x, x[valid]), self._index(self.y, y[valid])
+        inside = (i >= 0) & (j >= 0)
+        self.overflow += int(inside.size - numpy.sum(inside))
+        flat = numpy.bincount(i[inside] * self.counts.shape[1] + j[inside],
+                              minlength=self.counts.size)
+        self.counts += flat.reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of ``other``, a histogram of the same edges."""
+        if type(other) is not type(self):
+            raise ValueError("Cannot merge a {} into a {}.".format(
+                type(other).__name__, type(self).__name__))
+        if not all(numpy.array_equal(a, b)
+                   for a, b in zip(self.edges, other.edges)):
+            raise ValueError("Cannot merge histograms of different edges.")
+        self.counts += other.counts
+        self.overflow += other.overflow
+        self.invalid += other.invalid
+        return self
+
+    def empty(self):
+        """Returns an empty histogram of the same edges."""
+        return type(self)(*self.edges)
+
+    def to_dict(self):
+        """Returns the histogram as a JSON serializable dict."""
+        return {'xedges': self.edges[0].tolist(),
+                'yedges': self.edges[1].tolist(),
+                'counts': self.counts.tolist(), 'overflow': self.overflow,
+                'invalid': self.invalid}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns a histogram from the output of :py:meth:`to_dict`."""
+        out = cls(data['xedges'], data['yedges'])
+        out.counts[...] = data['counts']
+        out.overflow = data['overflow']
+        out.invalid = data['invalid']
+        return out
+
+
+class Moments:
+    r"""
+    Running count, mean, variance, minimum and maximum of a stream of
+    values. Each chunk's moments are computed with numpy and combined with
+    the accumulated ones by the pairwise form of Welford's algorithm (Chan
+    et al.), which is also used to merge accumulators of different workers.
+    Non-finite values are counted as ``invalid``.
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self.M2 = 0.
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self.invalid = 0
+
+    @property
+    def variance(self):
+        """Returns the sample variance, ``NaN`` for fewer than two values."""
+        return self.M2 / (self.n - 1) if self.n > 1 else numpy.nan
+
+    @property
+    def std(self):
+        """Returns the sample standard deviation."""
+        return numpy.sqrt(self.variance)
+
+    def _combine(self, n, mean, M2):
+        """Combines the moments of another set of values into these."""
+        if n == 0:
+            return
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.M2 += M2 + delta**2 * self.n * n / total
+        self.n = total
+
+    def fill(self, values):
+        """Adds ``values`` to the moments."""
+        values, invalid = _finite(values)
+        self.invalid += int(invalid)
+        if values.size == 0:
+            return self
+        mean = numpy.mean(values)
+        self._combine(values.size, mean, float(numpy.sum((values - mean)**2)))
+        self.min = min(self.min, float(numpy.min(values)))
+        self.max = max(self.max, float(numpy.max(values)))
+        return self
+
+    def merge(self, other):
+        """Adds the moments of ``other``."""
+        if type(other) is not type(self):
+            raise ValueError("Cannot merge a {} into a {}.".format(
+                type(other).__name__, type(self).__name__))
+        self._combine(other.n, other.mean, other.M2)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.invalid += other.invalid
+        return self
+
+    def empty(self):
+        """Returns empty moments."""
+        return type(self)()
+
+    def to_dict(self):
+        """Returns the moments as a JSON serializable dict."""
+        # Infinite extrema of empty moments are stored as None
+        return {'n': self.n, 'mean': float(self.mean), 'M2': float(self.M2),
+                'min': self.min if self.n else None,
+                'max': self.max if self.n else None,
+                'invalid': self.invalid}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns moments from the output of :py:meth:`to_dict`."""
+        out = cls()
+        out.n, out.mean, out.M2 = data['n'], data['mean'], data['M2']
+        if data['n']:
+            out.min, out.max = data['min'], data['max']
+        out.invalid = data['invalid']
+        return out
+
+
+class TrackSummary:
+    r"""
+    Fixed-memory summary of reconstructed tracks: a histogram and the
+    running moments of the speed ``v``, the polar angle ``theta`` and the
+    azimuthal angle ``phi``, and a 2-dimensional ``theta``-``phi`` map. It
+    is updated chunk by chunk with :py:meth:`update`, or through the
+    ``summary`` argument of
+    :py:meth:`simulator.Reconstructor.reconstruct_batch`, and summaries of
+    different workers are combined with :py:meth:`merge`. Tracks with fewer
+    than two hits, whose quantities are ``NaN``, are counted as invalid.
+
+    Parameters
+    ----------
+    v_edges : numpy.ndarray (optional)
+        Speed bin edges. By default 100 bins between 0 and 5.
+    theta_edges : numpy.ndarray (optional)
+        Polar angle bin edges in radians. By default 90 bins between 0 and
+        ``pi / 2``.
+    phi_edges : numpy.ndarray (optional)
+        Azimuthal angle bin edges in radians. By default 180 bins between
+        ``-pi`` and ``pi``.
+    """
+
+    def __init__(self, v_edges=None, theta_edges=None, phi_edges=None):
+        if v_edges is None:
+            v_edges = numpy.linspace(0, 5, 101)
+        if theta_edges is None:
+            theta_edges = numpy.linspace(0, numpy.pi / 2, 91)
+        if phi_edges is None:
+            phi_edges = numpy.linspace(-numpy.pi, numpy.pi, 181)
+        edges = {'v': v_edges, 'theta': theta_edges, 'phi': phi_edges}
+        self.histograms = {p: Histogram(edges[p]) for p in SUMMARISED}
+        self.moments = {p: Moments() for p in SUMMARISED}
+        self.angular = Histogram2D(theta_edges, phi_edges)
+
+    @property
+    def n(self):
+        """Returns the number of summarised tracks, including invalid."""
+        return self.histograms['v'].total
+
+    def update(self, tracks):
+        """
+        Adds a :py:class:`simulator.batch.TrackBatch`, or a list of track
+        dicts as returned by :py:meth:`simulator.Reconstructor.reconstruct`.
+        """
+        if isinstance(tracks, list):
+            tracks = {p: numpy.array([track[p] for track in tracks],
+                                     dtype=float) for p in SUMMARISED}
+        for p in SUMMARISED:
+            self.histograms[p].fill(tracks[p])
+            self.moments[p].fill(tracks[p])
+        self.angular.fill(tracks['theta'], tracks['phi'])
+        return self
+
+    def merge(self, other):
+        """Adds ``other``, a summary of the same binning."""
+        if type(other) is not type(self):
+            raise ValueError("Cannot merge a {} into a {}.".format(
+                type(other).__name__, type(self).__name__))
+        for p in SUMMARISED:
+            self.histograms[p].merge(other.histograms[p])
+            self.moments[p].merge(other.moments[p])
+        self.angular.merge(other.angular)
+        return self
+
+    def empty(self):
+        """Returns an empty summary of the same binning."""
+        return type(self)(*(self.histograms[p].edges for p in SUMMARISED))
+
+    def to_dict(self):
+        """Returns the summary as a JSON serializable dict."""
+        return {'histograms': {p: h.to_dict()
+                               for p, h in self.histograms.items()},
+                'moments': {p: m.to_dict() for p, m in self.moments.items()},
+                'angular': self.angular.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Returns a summary from the output of :py:meth:`to_dict`."""
+        out = cls(*(data['histograms'][p]['edges'] for p in SUMMARISED))
+        out.histograms = {p: Histogram.from_dict(data['histograms'][p])
+                          for p in SUMMARISED}
+        out.moments = {p: Moments.from_dict(data['moments'][p])
+                       for p in SUMMARISED}
+        out.angular = Histogram2D.from_dict(data['angular'])
+        return out
+
+    def save(self, fname):
+        """Saves the summary to a JSON file."""
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(fname + '.tmp', fname)
+
+    @classmethod
+    def load(cls, fname):
+        """Loads a summary saved by :py:meth:`save`."""
+        with open(fname, 'r') as f:
+            return cls.from_dict(json.load(f))
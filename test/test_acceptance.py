@@ -0,0 +1,44 @@
+"""Unit tests for the acceptance map and the fast simulation."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.acceptance import AcceptanceMap
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 200,
+           'z': z, 'phi': 23} for z in (20, 30, 40)]
+THETA_MAX = 30
+RATE = 1000
+
+
+def test_fast_simulate(tmp_path):
+    """Tests the fast simulation against the full geometry."""
+    detector = Detector(PLATES)
+    acceptance = AcceptanceMap.build(detector, THETA_MAX, Ntheta=16, Nphi=16,
+                                     samples=64, cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = AcceptanceMap.build(detector, THETA_MAX, Ntheta=16, Nphi=16,
+                                 samples=64, cache_dir=str(tmp_path))
+    assert numpy.array_equal(acceptance.acceptance, cached.acceptance)
+    assert cached.plates == detector.config
+
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(10, as_batch=True)
+    full = detector.evaluate_batch(events)
+    fast = detector.fast_simulate(events, acceptance, seed=42)
+    # Acceptance per plate and of reconstructable tracks
+    assert numpy.allclose(fast['hit'].mean(axis=0), full['hit'].mean(axis=0),
+                          atol=3e-2)
+    tracks = Reconstructor().reconstruct_batch(full)
+    good = tracks['nhits'] >= 2
+    assert numpy.isclose(numpy.mean(fast['nhits'] >= 2), numpy.mean(good),
+                         atol=3e-2)
+    # Smeared speeds are as accurate as the full reconstruction
+    v = numpy.linalg.norm([events[p] for p in ('vx', 'vy', 'vz')], axis=0)
+    fgood = fast['nhits'] >= 2
+    error = numpy.std(tracks['v'][good] / v[good] - 1)
+    assert numpy.isclose(numpy.std(fast['v'][fgood] / v[fgood] - 1), error,
+                         rtol=0.5)
+
+    other = Detector([dict(PLATES[0], Npixs=100)] + PLATES[1:])
+    with pytest.raises(ValueError):
+        other.fast_simulate(events, acceptance)
@@ -0,0 +1,52 @@
+"""Unit tests for the columnar batches."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, EventBatch)
+
+THETA_MAX = 10
+T = 10
+RATE = 10
+
+
+def test_observe_batch():
+    """Tests that the batch output matches the list of dicts output."""
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(T)
+    batch = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+
+    assert isinstance(batch, EventBatch)
+    assert len(batch) == len(events)
+    for event, row in zip(events, batch):
+        for p, value in event.items():
+            assert row[p] == value
+
+
+@pytest.mark.parametrize('key', [slice(2, 7), slice(None, None, 3)])
+def test_slicing(key):
+    """Tests that slices are batches whose columns are views."""
+    batch = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+    sliced = batch[key]
+
+    assert isinstance(sliced, EventBatch)
+    assert len(sliced) == len(batch['t'][key])
+    for p in batch.columns:
+        assert numpy.shares_memory(sliced[p], batch[p])
+
+
+def test_concatenate():
+    """Tests concatenation of batches."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    batches = [source.observe(T, as_batch=True) for __ in range(3)]
+    batch = EventBatch.concatenate(batches)
+
+    assert len(batch) == sum(len(b) for b in batches)
+    assert numpy.all(numpy.diff(batch['t']) > 0)
+
+
+def test_missing_columns():
+    """Tests that incomplete events are rejected."""
+    with pytest.raises(ValueError):
+        EventBatch({'vx': numpy.zeros(3)})
+    with pytest.raises(ValueError):
+        EventBatch({p: numpy.zeros(3 if p != 't' else 4)
+                    for p in EventBatch._required})
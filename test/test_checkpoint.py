@@ -0,0 +1,100 @@
+"""Unit tests for checkpointing and resuming runs."""
+import os
+
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor,
+                       TruncatedGaussian, TabulatedDistribution)
+from simulator.checkpoint import (Checkpointer, load_checkpoint, restore_run,
+                                  run_state)
+from simulator.parallel import ParallelRunner
+from simulator.store import (StoreReader, StoreWriter)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 100
+T = 3
+
+
+def test_source_state():
+    """Tests that a restored source continues its random stream."""
+    source = PoissonSource(THETA_MAX, rate=RATE, cov=[[1, 0.5], [0.5, 2]])
+    source.observe(1)
+    state = source.get_state()
+    expected = source.observe(1, as_batch=True)
+
+    restored = PoissonSource(THETA_MAX, rate=RATE, cov=[[1, 0.5], [0.5, 2]])
+    restored.set_state(state)
+    events = restored.observe(1, as_batch=True)
+    for p in events.columns:
+        assert numpy.array_equal(events[p], expected[p])
+    with pytest.raises(ValueError):
+        PoissonSource(THETA_MAX, rate=2 * RATE).set_state(state)
+    # A different momentum distribution
+    for dist in (TruncatedGaussian(mu=2, std=0.5),
+                 TabulatedDistribution.from_distribution(
+                     TruncatedGaussian(mu=1, std=0.5), cache_dir=False)):
+        other = PoissonSource(THETA_MAX, momentum_distribution=dist,
+                              rate=RATE, cov=[[1, 0.5], [0.5, 2]])
+        with pytest.raises(ValueError):
+            other.set_state(state)
+
+
+def run(path, runner, start=0, stop=None, checkpointer=None, nrows=0):
+    """
+    Writes the shards ``start`` to ``stop`` of ``runner``, appending after
+    the first ``nrows`` rows of the store if resuming.
+    """
+    if start == 0:
+        writer = StoreWriter(path)
+    else:
+        writer = StoreWriter.resume(path, nrows)
+    for index, (events, hits, tracks) in runner.iter_run(T, start=start):
+        if index == stop:
+            break
+        writer.append(events=events, hits=hits, tracks=tracks)
+        if checkpointer is not None:
+            checkpointer.save(run_state(runner.source, runner.detector,
+                                        writer, index + 1))
+    return writer
+
+
+def test_resume(tmp_path):
+    """Tests that a run resumed after a crash matches an uninterrupted run."""
+    def make_runner():
+        return ParallelRunner(PoissonSource(THETA_MAX, rate=RATE),
+                              Detector(PLATES), Reconstructor(), period=0.5)
+
+    run(str(tmp_path / 'full'), make_runner())
+    path = str(tmp_path / 'resumed')
+    fname = str(tmp_path / 'checkpoint.json')
+    checkpointer = Checkpointer(fname)
+    run(path, make_runner(), stop=3, checkpointer=checkpointer)
+    # A crash after writing a chunk but before checkpointing it
+    state = load_checkpoint(fname)
+    runner = make_runner()
+    events, hits, tracks = next(runner.iter_run(T, start=3))[1]
+    StoreWriter.resume(path, state['nrows']).append(
+        events=events, hits=hits, tracks=tracks)
+
+    runner = make_runner()
+    nrows, next_shard = restore_run(state, runner.source, runner.detector)
+    assert next_shard == 3
+    run(path, runner, start=next_shard, checkpointer=checkpointer,
+        nrows=nrows)
+
+    full, resumed = StoreReader(str(tmp_path / 'full')), StoreReader(path)
+    assert resumed.nrows == full.nrows
+    assert resumed.chunks == full.chunks
+    for table, batch in full.read().items():
+        for p in batch.columns:
+            assert numpy.array_equal(resumed.read()[table][p], batch[p],
+                                     equal_nan=True)
+    assert not os.path.exists(fname + '.tmp')
+
+    with pytest.raises(ValueError):
+        restore_run(state, runner.source, Detector(PLATES[:2]))
+    with pytest.raises(ValueError):
+        StoreWriter.resume(path, nrows + 1)
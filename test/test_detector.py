@@ -1,7 +1,9 @@
 """Unit tests for the detector."""
+import numpy
 import pytest
 
-from simulator import (PoissonSource, Detector)
+from simulator import (PoissonSource, Detector, EventBatch, HitStream)
+from simulator.detector import DetectorPlate
 
 PLATE = {'bounds': {'x': (-10, 10), 'y': (-10, 10)},
          'Npixs': 2000,
@@ -33,3 +35,179 @@ def test_plates_positions(zs):
             # Check the correct thigns are stored
             for key in ('x', 'y', 'z', 't'):
                 assert key in out[i][j].keys()
+
+
+@pytest.mark.parametrize('zs', [[10], [12, 23], [23, 25, 30]])
+@pytest.mark.parametrize('phi', [0, 23, 90])
+def test_batch_matches_events(zs, phi):
+    """Tests that the batched engine reproduces the per-event hits."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    events = source.observe(T, as_batch=True)
+    plates = [PLATE.copy() for i in range(len(zs))]
+    for i, z in enumerate(zs):
+        plates[i].update({'z': z, 'phi': phi})
+    detector = Detector(plates)
+    out = detector.evaluate_events(events.to_dicts())
+    hits = detector.evaluate_batch(events)
+
+    assert hits['t'].shape == (len(events), len(zs))
+    for i in range(len(events)):
+        for j in range(len(zs)):
+            for key in ('x', 'y', 'z', 't'):
+                assert numpy.isclose(hits[key][i, j], out[i][j][key])
+
+
+def test_changed_plates():
+    """Tests that the batched engine follows changes of the plates."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    events = source.observe(T, as_batch=True)
+    detector = Detector([dict(PLATE, z=z) for z in (10, 20)])
+    detector.plates[0].z = 30
+    detector.plates[1].Npixs = 100
+    for plates in (detector.plates, detector.plates[:1]):
+        detector.plates = plates
+        out = detector.evaluate_events(events.to_dicts())
+        hits = detector.evaluate_batch(events)
+        assert hits['t'].shape == (len(events), len(plates))
+        for i in range(len(events)):
+            for j in range(len(plates)):
+                for key in ('x', 'y', 'z', 't'):
+                    assert numpy.isclose(hits[key][i, j], out[i][j][key])
+    with pytest.raises(ValueError):
+        detector.plates = [PLATE]
+
+
+def test_batch_miss():
+    """Tests that a track missing a plate raises."""
+    source = PoissonSource(45, rate=RATE)
+    plate = PLATE.copy()
+    plate['z'] = 100
+    with pytest.raises(ValueError):
+        Detector([plate]).evaluate_batch(source.observe(T, as_batch=True),
+                                         strict=True)
+
+
+@pytest.mark.parametrize('Npixs', [1, 7, 2000])
+def test_pixel_lookup(Npixs):
+    """Tests the flat pixel ID lookup against the per-point methods."""
+    plate = DetectorPlate(bounds={'x': (-10, 10), 'y': (-2.0, 7.5)},
+                          Npixs=Npixs, z=30)
+    gen = numpy.random.default_rng(42)
+    x = gen.uniform(-10, 10, 100)
+    y = gen.uniform(-2.0, 7.5, 100)
+    pixel = plate.coordinates2pixel(x, y)
+    xc, yc = plate.pixel2coordinates(pixel)
+    for k in range(x.size):
+        IDs = plate.coordinates2pixelID({'x': x[k], 'y': y[k]})
+        assert pixel[k] == IDs['ypixel'] * Npixs + IDs['xpixel']
+        coords = plate.pixelID2coordinates(IDs)
+        assert numpy.isclose(coords['x'], xc[k])
+        assert numpy.isclose(coords['y'], yc[k])
+    # Snapped centres are within half a pixel of the points
+    assert numpy.all(numpy.abs(xc - x) <= plate.pitch[0] / 2 + 1e-12)
+    assert numpy.all(numpy.abs(yc - y) <= plate.pitch[1] / 2 + 1e-12)
+
+    with pytest.raises(ValueError):
+        plate.coordinates2pixel([11.], [0.])
+    with pytest.raises(ValueError):
+        plate.pixel2coordinates([Npixs**2])
+
+
+def test_plate_setters():
+    """Tests that the pixel geometry follows the plate's setters."""
+    plate = DetectorPlate(bounds={'x': (-10, 10), 'y': (-10, 10)}, Npixs=20,
+                          z=30)
+    plate.Npixs = 200
+    assert plate.coordinates2pixelID({'x': 5., 'y': 5.}) == {'xpixel': 150,
+                                                             'ypixel': 150}
+    assert numpy.allclose(plate.pitch, 0.1)
+    plate.bnds = {'x': (0, 20), 'y': (0, 20)}
+    assert plate.coordinates2pixelID({'x': 5., 'y': 5.}) == {'xpixel': 50,
+                                                             'ypixel': 50}
+    coords = plate.pixelID2coordinates({'xpixel': 0, 'ypixel': 199})
+    assert numpy.isclose(coords['x'], 0.05)
+    assert numpy.isclose(coords['y'], 19.95)
+
+
+def test_batch_mask():
+    """Tests the hit mask of a wide source on plates of different sizes."""
+    source = PoissonSource(60, rate=100)
+    events = source.observe(T, as_batch=True)
+    # Flip some tracks backwards
+    events['vz'][::5] *= -1
+    plates = [dict(PLATE, z=z) for z in (10, 20, 50)]
+    hits = Detector(plates).evaluate_batch(events)
+
+    hit = hits['hit']
+    assert not numpy.any(hit[::5])
+    assert 0 < numpy.sum(hit[:, 2]) < numpy.sum(hit[:, 1]) < numpy.sum(
+        hit[:, 0]) < len(events)
+    assert numpy.all(numpy.isnan(hits['t'][~hit]))
+    assert numpy.all(hits['pixel'][~hit] == -1)
+    assert numpy.all(hits['pixel'][hit] >= 0)
+    for j, plate in enumerate(plates):
+        assert numpy.all(hits['z'][hit[:, j], j] == plate['z'])
+
+
+@pytest.mark.parametrize('block_size', [1, 3, 16])
+def test_plate_geometry(block_size):
+    """
+    Tests a large unsorted layout, whose outer plates most tracks miss,
+    against the per-plate evaluation.
+    """
+    source = PoissonSource(30, rate=100, timing='continuous')
+    events = source.observe(2, as_batch=True)
+    gen = numpy.random.default_rng(42)
+    zs = gen.permutation(numpy.linspace(5, 200, 30))
+    plates = [dict(PLATE, z=z, phi=float(gen.uniform(0, 90)))
+              for z in zs]
+    hits = Detector(plates, block_size=block_size).evaluate_batch(events)
+    hit = hits['hit']
+    assert 0 < numpy.sum(hit) < hit.size
+
+    for j, plate in enumerate(Detector(plates).plates):
+        for i in range(len(events)):
+            try:
+                out = plate.evaluate_collision(events[i])
+            except ValueError:
+                assert not hit[i, j]
+                continue
+            assert hit[i, j]
+            for key in ('x', 'y', 'z', 't'):
+                assert numpy.isclose(hits[key][i, j], out[key])
+
+
+def test_hit_stream():
+    """Tests that the hit stream holds every hit in time order."""
+    source = PoissonSource(THETA_MAX, rate=100, timing='continuous')
+    events = source.observe(T, as_batch=True)
+    detector = Detector([dict(PLATE, z=z) for z in (30, 20, 40)])
+    hits = detector.evaluate_batch(events)
+    stream = detector.evaluate_stream(events)
+
+    assert isinstance(stream, HitStream)
+    assert len(stream) == numpy.sum(hits['hit'])
+    assert numpy.all(numpy.diff(stream['t']) >= 0)
+    rows, plates = stream['event'], stream['plate']
+    for p in ('x', 'y', 'z', 't', 'pixel'):
+        assert numpy.array_equal(stream[p], hits[p][rows, plates])
+
+
+@pytest.mark.parametrize('block_size', [4, 16, 32])
+def test_strict_early_exit(block_size):
+    """
+    Tests that a track dropped early, as it cannot reach the small outer
+    plates, is still a miss in strict mode for any block size.
+    """
+    large = {'bounds': {'x': (-100, 100), 'y': (-100, 100)}, 'Npixs': 100}
+    small = {'bounds': {'x': (-1, 1), 'y': (-1, 1)}, 'Npixs': 10}
+    plates = ([dict(large, z=z) for z in range(1, 17)]
+              + [dict(small, z=z) for z in range(17, 21)])
+    events = EventBatch({p: numpy.zeros(1) for p in EventBatch._required})
+    events['vx'][:] = 1.
+    events['vz'][:] = 1.
+    detector = Detector(plates, block_size=block_size)
+    hits = detector.evaluate_batch(events)
+    assert numpy.array_equal(hits['hit'][0], [True] * 16 + [False] * 4)
+    with pytest.raises(ValueError):
+        detector.evaluate_batch(events, strict=True)
@@ -2,7 +2,8 @@
 import numpy
 
 import pytest
-from simulator import (PoissonSource, TruncatedGaussian)
+from simulator import (PoissonSource, TruncatedGaussian,
+                       TabulatedDistribution)
 
 THETA_MAX = 10
 T = 10
@@ -56,3 +57,126 @@ def test_momentum_mean(mu, std):
         x[i] = sum([event[p]**2 for p in ['vx', 'vy', 'vz']])**0.5
     # Let's go for a absolute relatively low tolerance..
     assert numpy.isclose(numpy.mean(x), dist.dist.stats('m'), atol=1e-1)
+
+
+@pytest.mark.parametrize('mu, std', [(0.5, 1), (1, 0.5), (30, 1)])
+def test_truncated_gaussian_rvs(mu, std):
+    """Tests the NumPy rejection sampler against the scipy distribution."""
+    dist = TruncatedGaussian(mu, std)
+    x = dist.rvs(100000, random_state=42)
+    assert x.size == 100000 and numpy.all(x > 0)
+    assert numpy.array_equal(x, dist.rvs(100000, random_state=42))
+    assert numpy.array_equal(x, dist.rvs(100000,
+                                         random_state=numpy.int64(42)))
+    legacy = dist.rvs(100000, random_state=numpy.random.RandomState(42))
+    assert numpy.array_equal(legacy, dist.rvs(
+        100000, random_state=numpy.random.RandomState(42)))
+    assert numpy.isclose(numpy.mean(legacy), numpy.mean(x), rtol=2e-2)
+    assert numpy.isclose(numpy.mean(x), dist.dist.mean(), rtol=1e-2)
+    assert numpy.isclose(numpy.std(x), dist.dist.std(), rtol=1e-2)
+    q = numpy.linspace(0.05, 0.95, 19)
+    assert numpy.allclose(numpy.quantile(x, q), dist.dist.ppf(q),
+                          atol=2e-2 * std)
+
+
+@pytest.mark.parametrize('rate', [1, 10, 1000])
+def test_continuous_times(rate):
+    """Tests the continuous emission times across consecutive calls."""
+    source = PoissonSource(THETA_MAX, rate=rate, timing='continuous')
+    t = numpy.concatenate([source.observe(T, as_batch=True)['t']
+                           for __ in range(5)])
+    assert numpy.all(numpy.diff(t) >= 0)
+    assert numpy.all((0 <= t) & (t < 5 * T))
+    # Poisson count with a 5 sigma tolerance
+    N = rate * 5 * T
+    assert abs(t.size - N) < 5 * N**0.5
+    with pytest.raises(ValueError):
+        PoissonSource(THETA_MAX, timing='exponential')
+
+
+@pytest.mark.parametrize('cov', [[[1, 0], [0, 1]], [[1, 0.5], [0.5, 2]]])
+def test_anisotropic_flux(cov):
+    """Tests the anisotropic flux covariance and magnitudes."""
+    source = PoissonSource(THETA_MAX, rate=RATE, cov=cov)
+    N = 100000
+    magnitude = numpy.linspace(1, 2, N)
+    out = numpy.empty((N, 3))
+    samples = source._sample_anisotropic_flux(N, magnitude, out=out)
+    assert samples is out
+    assert numpy.allclose(numpy.linalg.norm(samples, axis=1), magnitude)
+    # Project back onto the z=10 plane
+    points = samples[:, :2] * 10 / samples[:, 2:]
+    assert numpy.allclose(numpy.cov(points.T), cov, atol=5e-2)
+
+    with pytest.raises(ValueError):
+        source._sample_anisotropic_flux(N, magnitude, out=out[:10])
+    with pytest.raises(ValueError):
+        PoissonSource(THETA_MAX, cov=[[1, 2], [2, 1]])
+
+
+@pytest.mark.parametrize('cov', [None, [[1, 0.5], [0.5, 2]]])
+def test_observe_out(cov):
+    """Tests sampling the velocities into a caller buffer."""
+    source = PoissonSource(THETA_MAX, rate=RATE, cov=cov)
+    other = PoissonSource(THETA_MAX, rate=RATE, cov=cov)
+    out = numpy.empty((5 * RATE * T, 3))
+    batch = source.observe(T, as_batch=True, out=out)
+    expected = other.observe(T, as_batch=True)
+    assert len(batch) <= out.shape[0]
+    for p in batch.columns:
+        assert numpy.array_equal(batch[p], expected[p])
+    assert numpy.shares_memory(batch['vx'], out)
+    # A buffer too small for the period is replaced
+    batch = source.observe(T, as_batch=True, out=out[:1])
+    expected = other.observe(T, as_batch=True)
+    assert numpy.array_equal(batch['vz'], expected['vz'])
+
+    with pytest.raises(ValueError):
+        source.observe(T, out=numpy.empty((10, 2)))
+    with pytest.raises(ValueError):
+        source.observe(T, out=numpy.empty((10, 3), dtype=numpy.float32))
+
+
+@pytest.mark.parametrize('mu,std', [(1, 0.5), (0.5, 1), (30, 1)])
+def test_tabulated_distribution(tmp_path, mu, std):
+    """Tests the tabulated quantiles and their disk cache."""
+    dist = TruncatedGaussian(mu, std)
+    tol = 1e-3
+    tab = TabulatedDistribution.from_distribution(dist, tol=tol,
+                                                  cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    cached = TabulatedDistribution.from_distribution(dist, tol=tol,
+                                                     cache_dir=str(tmp_path))
+    assert numpy.array_equal(tab.dist.quantiles, cached.dist.quantiles)
+    # The tabulated CDF is within ``tol`` of the exact one
+    x = tab.dist.ppf(numpy.linspace(0, 1, 100001))
+    q = numpy.linspace(0, 1, 100001)
+    assert numpy.max(numpy.abs(dist.dist.cdf(x) - q)) <= tol
+    # Plugs into the source
+    source = PoissonSource(THETA_MAX, momentum_distribution=tab, rate=100)
+    events = source.observe(100, as_batch=True)
+    v = numpy.linalg.norm([events[p] for p in ('vx', 'vy', 'vz')], axis=0)
+    assert numpy.isclose(numpy.mean(v), dist.dist.stats('m'), atol=1e-1)
+    assert numpy.isclose(tab.dist.stats('m'), dist.dist.stats('m'),
+                         atol=1e-2)
+
+
+def test_histogram_distribution():
+    """Tests sampling a histogram with empty bins."""
+    edges = numpy.arange(7.)
+    counts = numpy.array([0, 1, 0, 3, 0, 0])
+    tol = 1e-3
+    tab = TabulatedDistribution.from_histogram(edges, counts, tol=tol,
+                                               cache_dir=False)
+    x = tab.dist.rvs(100000, random_state=42)
+    assert numpy.all((1 <= x) & (x <= 4))
+    # Only the node interval straddling the empty bin leaks into it
+    assert numpy.mean((2 < x) & (x < 3)) < 2 * tol
+    assert numpy.isclose(numpy.mean(x < 2), 0.25, atol=1e-2)
+    # NumPy integer seeds and legacy random states
+    assert numpy.array_equal(x, tab.dist.rvs(100000,
+                                             random_state=numpy.int64(42)))
+    legacy = numpy.random.RandomState(42)
+    assert tab.dist.rvs(10, random_state=legacy).shape == (10, )
+    with pytest.raises(ValueError):
+        TabulatedDistribution.from_histogram(edges, counts[1:])
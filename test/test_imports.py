@@ -0,0 +1,28 @@
+"""Unit tests for the package's import cost."""
+import subprocess
+import sys
+
+SCRIPT = """
+import sys
+import simulator
+assert 'scipy' not in sys.modules, 'import'
+source = simulator.PoissonSource(10, rate=1000, timing='continuous')
+detector = simulator.Detector([{'bounds': {'x': (-10, 10), 'y': (-10, 10)},
+                                'Npixs': 200, 'z': z} for z in (30, 40)])
+events = source.observe(1, as_batch=True)
+reconstructor = simulator.Reconstructor()
+reconstructor.reconstruct_batch(detector.evaluate_batch(events))
+reconstructor.reconstruct(detector.evaluate_events(events[:10].to_dicts()))
+assert 'scipy' not in sys.modules, 'simulation'
+"""
+
+
+def test_lazy_scipy():
+    """
+    Tests that importing the package and simulating with the default
+    source and the reconstructor do not load scipy.
+    """
+    res = subprocess.run([sys.executable, '-c', SCRIPT],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    assert res.returncode == 0, res.stderr
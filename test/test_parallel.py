@@ -0,0 +1,53 @@
+"""Unit tests for the parallel runner."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.parallel import ParallelRunner
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 100
+T = 2.5
+
+
+def run(workers, seed=2021):
+    """Runs a short simulation with ``workers`` workers."""
+    source = PoissonSource(THETA_MAX, rate=RATE, seed=seed)
+    runner = ParallelRunner(source, Detector(PLATES), Reconstructor(),
+                            period=0.5, workers=workers)
+    return runner.run(T)
+
+
+def test_global_state():
+    """Tests that sources do not touch the global random state."""
+    state = numpy.random.get_state()[1].copy()
+    PoissonSource(THETA_MAX, rate=RATE).observe(1)
+    assert numpy.all(numpy.random.get_state()[1] == state)
+
+
+def test_shards():
+    """Tests that shards are reproducible and start at their period."""
+    source = PoissonSource(THETA_MAX, rate=RATE, timing='continuous')
+    first = source.shard(3, 0.5).observe(0.5, as_batch=True)
+    second = source.shard(3, 0.5).observe(0.5, as_batch=True)
+    assert numpy.all(first['t'] == second['t'])
+    assert numpy.all((1.5 <= first['t']) & (first['t'] < 2))
+    other = source.shard(4, 0.5).observe(0.5, as_batch=True)
+    assert not numpy.array_equal(first['vx'][:5], other['vx'][:5])
+
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_workers(workers):
+    """Tests that the output does not depend on the number of workers."""
+    serial = run(1)
+    parallel = run(workers)
+    assert len(serial[0]) > 0
+    for batch, other in zip(serial, parallel):
+        for p in batch.columns:
+            assert numpy.array_equal(batch[p], other[p])
+    # The last shard is truncated at T
+    assert serial[0]['t'][-1] < T
+    # A different seed gives a different run
+    assert not numpy.array_equal(run(1, seed=1)[0]['t'], serial[0]['t'])
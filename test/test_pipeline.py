@@ -0,0 +1,96 @@
+"""Unit tests for the streaming pipeline."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.parallel import ParallelRunner
+from simulator.pipeline import (PipelinedRunner, Stage, pipelined_simulation,
+                                stream)
+from simulator.store import (StoreWriter, StoreReader)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 100
+
+
+@pytest.mark.parametrize('timing', ['discrete', 'continuous'])
+@pytest.mark.parametrize('chunk_size', [1, 64, 1000])
+def test_iter_observe(timing, chunk_size):
+    """Tests the chunk sizes and contiguity of the streamed events."""
+    T = 5
+    source = PoissonSource(THETA_MAX, rate=RATE, timing=timing)
+    chunks = list(source.iter_observe(T, chunk_size))
+    assert all(len(chunk) == chunk_size for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= chunk_size
+    t = numpy.concatenate([chunk['t'] for chunk in chunks])
+    assert numpy.all(numpy.diff(t) > 0)
+    assert t[-1] < T
+    assert numpy.isclose(source._clock, T)
+
+
+def test_iter_observe_out():
+    """Tests that streaming into a reusable buffer yields the same events."""
+    T = 5
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    other = PoissonSource(THETA_MAX, rate=RATE)
+    out = numpy.empty((200, 3))
+    expected = other.iter_observe(T, 64)
+    for chunk in source.iter_observe(T, 64, out=out):
+        _chunk = next(expected)
+        for p in chunk.columns:
+            assert numpy.array_equal(chunk[p], _chunk[p])
+    with pytest.raises(StopIteration):
+        next(expected)
+
+
+def test_stream():
+    """Tests that every stage processes the same number of events."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    detector = Detector(PLATES)
+    N = 0
+    for events, hits, tracks in stream(source, detector, Reconstructor(),
+                                       T=2, chunk_size=50):
+        assert len(events) == len(hits) == len(tracks)
+        N += len(events)
+    assert N > 0
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_pipelined_simulation(tmp_path, executor):
+    """Tests that the pipelined run matches the serial runner."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    detector = Detector(PLATES)
+    events, hits, tracks = ParallelRunner(
+        source, detector, Reconstructor(), period=0.25).run(2)
+
+    writer = StoreWriter(str(tmp_path / 'store'))
+    runner, out = pipelined_simulation(
+        source, detector, Reconstructor(), T=2, period=0.25, writer=writer,
+        maxsize=2, generation_workers=2, generation_executor=executor,
+        detection_workers=2)
+    assert out is None
+    stored = StoreReader(str(tmp_path / 'store')).read()
+    for batch, other in ((events, stored['events']), (hits, stored['hits']),
+                         (tracks, stored['tracks'])):
+        for p in batch.columns:
+            assert numpy.array_equal(batch[p], other[p], equal_nan=True)
+    for stage in ('generation', 'detection', 'reconstruction', 'writing'):
+        assert runner.stats[stage]['items'] == 8
+        assert 0 <= runner.stats[stage]['utilisation'] <= 1
+        assert runner.stats[stage]['max_depth'] <= 2
+    assert 'writing' in runner.report()
+
+
+def test_pipeline_error():
+    """Tests that a failing stage stops the pipeline and raises."""
+    def fail(item):
+        if item == 3:
+            raise RuntimeError("Failed.")
+        return item
+
+    runner = PipelinedRunner([Stage('a', fail), Stage('b', lambda x: x)],
+                             maxsize=1)
+    with pytest.raises(RuntimeError):
+        runner.run(range(100))
+    assert runner.run(range(3)) == [0, 1, 2]
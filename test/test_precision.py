@@ -0,0 +1,56 @@
+"""Unit tests for the precision policy."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.precision import (compare_precision, get_precision, precision)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 1000
+T = 5
+
+
+def test_policy_dtypes():
+    """Tests the types of a run under the compact policy."""
+    detector = Detector(PLATES)
+    reconstructor = Reconstructor()
+    events64 = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+    with precision('float32') as policy:
+        events = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+        hits = detector.evaluate_batch(events)
+        tracks = reconstructor.reconstruct_batch(hits)
+    assert get_precision().name == 'float64'
+    assert policy.float == numpy.float32
+
+    for p in ('vx', 'vy', 'vz', 'x0'):
+        assert events[p].dtype == numpy.float32
+        # The same random stream cast to single precision
+        assert numpy.array_equal(events[p], events64[p].astype(numpy.float32))
+    assert numpy.array_equal(events['t'], events64['t'])
+    for p in ('x', 'y', 'z'):
+        assert hits[p].dtype == numpy.float32
+    assert hits['t'].dtype == numpy.float64
+    assert hits['pixel'].dtype == numpy.int32
+    for p in ('v', 'vx', 'theta', 'phi'):
+        assert tracks[p].dtype == numpy.float32
+
+    with pytest.raises(ValueError):
+        with precision('float16'):
+            pass
+
+
+def test_compare_precision():
+    """Tests that the compact policy bounds the reconstruction differences."""
+    source = PoissonSource(THETA_MAX, rate=RATE, timing='continuous')
+    clock = source._clock
+    report = compare_precision(source, Detector(PLATES), Reconstructor(), T)
+    assert source._clock == clock
+    # Only rare pixel flips at the pixels' edges exceed round-off
+    assert report['v']['q99'] < 1e-5
+    assert report['theta']['q99'] < 1e-5
+    # A flip tilts the fit by about a pixel pitch over the plates' span
+    assert report['theta']['max'] < 2 * 0.01 / 10
+    assert report['changed_hits'] < 1e-3
+    assert report['nbytes_ratio'] < 0.65
@@ -0,0 +1,62 @@
+"""Unit tests for the instrumentation."""
+import json
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.profiling import (PROFILER, profile)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35)]
+THETA_MAX = 10
+RATE = 100
+
+
+def run(batch):
+    """Runs a short simulation."""
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(1, as_batch=batch)
+    detector = Detector(PLATES)
+    if batch:
+        Reconstructor().reconstruct_batch(detector.evaluate_batch(events))
+    else:
+        Reconstructor().reconstruct(detector.evaluate_events(events))
+    return len(events)
+
+
+def test_disabled():
+    """Tests that nothing is recorded by default."""
+    PROFILER.reset()
+    run(True)
+    assert not PROFILER.enabled
+    assert PROFILER.stats == {}
+
+
+@pytest.mark.parametrize('batch', [True, False])
+def test_stages(batch):
+    """Tests the recorded stages, calls and item counts."""
+    records = []
+
+    def callback(stage, record):
+        records.append(stage)
+
+    PROFILER.add_callback(callback)
+    try:
+        with profile() as profiler:
+            N = run(batch)
+    finally:
+        PROFILER.remove_callback(callback)
+    assert not PROFILER.enabled
+    stats = profiler.stats
+    for stage in ('generation.event_times', 'generation.momenta',
+                  'generation.directions', 'generation.observe'):
+        assert stats[stage]['calls'] == 1
+        assert stats[stage]['items'] == N
+    if batch:
+        assert stats['detection.evaluate_batch']['items'] == N
+        assert stats['detection.evaluate_batch']['nbytes'] > 0
+        assert stats['reconstruction.reconstruct_batch']['items'] == N
+    else:
+        assert stats['detection.evaluate_collision']['calls'] == 2 * N
+        assert stats['reconstruction.reconstruct']['items'] == N
+    assert len(records) == sum(s['calls'] for s in stats.values())
+    assert json.loads(profiler.to_json()) == stats
+    assert 'generation.observe' in profiler.summary()
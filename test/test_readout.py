@@ -0,0 +1,69 @@
+"""Unit tests for the sparse occupancy frames."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector)
+from simulator.readout import OccupancyFrames
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 20,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 1000
+T = 2
+WINDOW = 0.1
+
+
+def test_readout(tmp_path):
+    """Tests the frames against a dense histogram of the hits."""
+    events = PoissonSource(THETA_MAX, rate=RATE, timing='continuous').observe(
+        T, as_batch=True)
+    detector = Detector(PLATES)
+    hits = detector.evaluate_batch(events)
+    frames = detector.readout(events, WINDOW)
+
+    rows, plates = numpy.nonzero(hits['hit'])
+    index = numpy.floor(hits['t'][rows, plates] / WINDOW).astype(int)
+    pixel = hits['pixel'][rows, plates]
+    assert frames.Nhits == rows.size
+    for k in numpy.unique(index)[:5]:
+        for plate in range(len(PLATES)):
+            mask = (index == k) & (plates == plate)
+            dense = numpy.bincount(pixel[mask], minlength=20 * 20)
+            assert numpy.array_equal(frames.dense(k, plate).ravel(), dense)
+    __, __, fired, piled = frames.occupancy()
+    assert numpy.all((fired > 0) & (fired <= 1))
+    assert numpy.all((piled >= 0) & (piled <= 1))
+
+    # Accumulating chunks and merging gives the same frames
+    chunked = None
+    for start in range(0, len(events), 300):
+        chunked = detector.readout(events[start:start + 300], WINDOW,
+                                   frames=chunked)
+    merged = detector.readout(events[:500], WINDOW).merge(
+        detector.readout(events[500:], WINDOW))
+    for other in (chunked, merged):
+        for x, y in zip(frames.to_coo(), other.to_coo()):
+            assert numpy.array_equal(x, y)
+
+    fname = str(tmp_path / 'frames.npz')
+    frames.save(fname)
+    loaded = OccupancyFrames.load(fname)
+    for x, y in zip(frames.to_coo(), loaded.to_coo()):
+        assert numpy.array_equal(x, y)
+    assert loaded.select(0, 3).Nhits == numpy.sum(index < 3)
+
+    with pytest.raises(ValueError):
+        frames.merge(OccupancyFrames(2 * WINDOW, [20] * len(PLATES)))
+    with pytest.raises(ValueError):
+        detector.readout(events, WINDOW, t0=1, frames=frames)
+
+
+def test_sparse_memory():
+    """Tests that sparse frames of large plates are small."""
+    plates = [dict(PLATES[0], Npixs=2000, z=z) for z in (30, 35)]
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+    frames = Detector(plates).readout(events, WINDOW)
+    frame, __ = frames.rows
+    # A dense int32 image per plate and window
+    dense = (frame.max() + 1) * len(plates) * 2000**2 * 4
+    assert frames.nbytes < 1e-3 * dense
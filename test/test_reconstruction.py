@@ -0,0 +1,111 @@
+"""Unit tests for the reconstructor."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor, TrackBatch)
+
+PLATE = {'bounds': {'x': (-10, 10), 'y': (-10, 10)},
+         'Npixs': 2000,
+         'z': 30,
+         'phi': 23}
+T = 10
+THETA_MAX = 10
+RATE = 10
+
+
+@pytest.mark.parametrize('zs', [[10, 20], [23, 25, 30], [20, 30, 40, 50]])
+def test_batch_reconstruction(zs):
+    """Tests the batched fit against the truth and the pairwise average."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    events = source.observe(T, as_batch=True)
+    plates = [PLATE.copy() for i in range(len(zs))]
+    for i, z in enumerate(zs):
+        plates[i]['z'] = z
+    detector = Detector(plates)
+    hits = detector.evaluate_batch(events)
+    reconstructor = Reconstructor()
+    tracks = reconstructor.reconstruct_batch(hits)
+    out = reconstructor.reconstruct(detector.evaluate_events(
+        events.to_dicts()))
+
+    assert isinstance(tracks, TrackBatch)
+    assert len(tracks) == len(events)
+    # The vertical velocity is exact as positions are only snapped in x, y
+    assert numpy.allclose(tracks['vz'], events['vz'])
+    # Pixel snapping limits the transverse accuracy
+    for p in ('vx', 'vy'):
+        assert numpy.allclose(tracks[p], events[p], atol=1e-2)
+        assert numpy.allclose(tracks[p], [event[p] for event in out],
+                              atol=1e-2)
+    v = numpy.linalg.norm([events[p] for p in ('vx', 'vy', 'vz')], axis=0)
+    assert numpy.allclose(tracks['v'], v, rtol=1e-3)
+
+
+def test_single_plate():
+    """Tests that a single plate cannot be reconstructed."""
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+    hits = Detector([PLATE]).evaluate_batch(events)
+    with pytest.raises(ValueError):
+        Reconstructor().reconstruct_batch(hits)
+
+
+def test_partial_coverage():
+    """Tests reconstructing events that miss some of the plates."""
+    source = PoissonSource(40, rate=RATE)
+    events = source.observe(T, as_batch=True)
+    plates = [dict(PLATE, z=z) for z in (10, 15, 20, 30)]
+    hits = Detector(plates).evaluate_batch(events)
+    tracks = Reconstructor().reconstruct_batch(hits)
+
+    nhits = hits['hit'].sum(axis=1)
+    assert numpy.array_equal(tracks['nhits'], nhits)
+    good = nhits >= 2
+    assert 0 < numpy.sum(good) < len(events)
+    assert numpy.all(numpy.isnan(tracks['v'][~good]))
+    assert numpy.allclose(tracks['vz'][good], events['vz'][good])
+    for p in ('vx', 'vy'):
+        assert numpy.allclose(tracks[p][good], events[p][good], atol=1e-2)
+
+
+@pytest.mark.parametrize('rate', [10, 1000])
+def test_find_tracks(rate):
+    """Tests associating an unlabelled hit stream into tracks."""
+    source = PoissonSource(THETA_MAX, rate=rate, timing='continuous')
+    events = source.observe(1, as_batch=True)
+    plates = [dict(PLATE, z=z, phi=7 * i)
+              for i, z in enumerate((40, 30, 35, 45))]
+    detector = Detector(plates)
+    stream = detector.evaluate_stream(events)
+    reconstructor = Reconstructor()
+    tracks = reconstructor.find_tracks(stream, Nplates=len(plates))
+    report = reconstructor.track_report(stream, tracks)
+
+    assert tracks['index'].shape == (len(tracks), len(plates))
+    assert numpy.all(numpy.sum(tracks['hit'], axis=1) >= 2)
+    # Every hit belongs to at most one track
+    index = tracks['index'][tracks['hit']]
+    assert numpy.unique(index).size == index.size
+    assert numpy.array_equal(tracks['t'][tracks['hit']], stream['t'][index])
+    assert report['particles'] == len(events)
+    assert report['efficiency'] > 0.95
+    assert report['fake_rate'] < 0.05
+
+    # The found tracks reconstruct to their particles' velocities
+    fitted = reconstructor.reconstruct_batch(tracks)
+    first = stream['event'][tracks['index'][
+        numpy.arange(len(tracks)), numpy.argmax(tracks['hit'], axis=1)]]
+    pure = numpy.all(
+        (stream['event'][tracks['index']] == first[:, None])
+        | ~tracks['hit'], axis=1)
+    assert numpy.allclose(fitted['vz'][pure], events['vz'][first[pure]])
+
+
+def test_find_tracks_empty():
+    """Tests track finding without hits."""
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(0, as_batch=True)
+    detector = Detector([dict(PLATE, z=z) for z in (10, 20)])
+    tracks = Reconstructor().find_tracks(detector.evaluate_stream(events),
+                                         Nplates=2)
+    assert len(tracks) == 0
+    with pytest.raises(ValueError):
+        Reconstructor().find_tracks(detector.evaluate_stream(events))
@@ -0,0 +1,47 @@
+"""Unit tests for the shared-memory evaluator."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector)
+
+# Shared memory segments require Python 3.8
+pytest.importorskip('multiprocessing.shared_memory')
+from simulator.sharedmem import (SharedBatchBuffer, SharedEvaluator)  # noqa
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 30
+RATE = 1000
+
+
+def test_buffer():
+    """Tests attaching to a buffer's segments."""
+    buffer = SharedBatchBuffer({'a': (float, ()), 'b': (bool, (3, ))}, 10)
+    try:
+        other = SharedBatchBuffer.attach(buffer.describe())
+        buffer['a'][:] = numpy.arange(10)
+        buffer['b'][2, 1] = True
+        assert numpy.array_equal(other['a'], numpy.arange(10))
+        assert other['b'].sum() == 1 and other['b'][2, 1]
+        other.close()
+        with pytest.raises(ValueError):
+            buffer.write({'a': numpy.zeros(11), 'b': numpy.zeros((11, 3))})
+    finally:
+        buffer.close()
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_evaluator(workers):
+    """Tests the evaluator against the in-process evaluation."""
+    detector = Detector(PLATES)
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    with SharedEvaluator(detector, capacity=700, workers=workers) as pool:
+        # The pool and the buffers are reused across chunks
+        for __ in range(2):
+            events = source.observe(1, as_batch=True)
+            hits = pool.evaluate(events)
+            expected = detector.evaluate_batch(events)
+            for p in expected.columns:
+                assert numpy.array_equal(hits[p], expected[p],
+                                         equal_nan=hits[p].dtype.kind == 'f')
+        assert len(pool.evaluate(events[:0])) == 0
@@ -0,0 +1,97 @@
+"""Unit tests for the on-disk store."""
+import os
+
+import numpy
+import pytest
+from simulator import (PoissonSource, Detector, EventBatch, HitBatch)
+from simulator.store import (StoreWriter, StoreReader)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35)]
+THETA_MAX = 10
+RATE = 100
+
+
+def write(path, Nchunks=4):
+    """Writes ``Nchunks`` chunks of events and hits to ``path``."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    detector = Detector(PLATES)
+    writer = StoreWriter(path)
+    events = [source.observe(1, as_batch=True) for __ in range(Nchunks)]
+    hits = [detector.evaluate_batch(batch) for batch in events]
+    for _events, _hits in zip(events, hits):
+        writer.append(events=_events, hits=_hits)
+    return EventBatch.concatenate(events), HitBatch.concatenate(hits)
+
+
+def test_roundtrip(tmp_path):
+    """Tests that the stored batches are read back unchanged."""
+    path = str(tmp_path / 'store')
+    events, hits = write(path)
+    reader = StoreReader(path)
+
+    assert len(reader) == len(events)
+    assert len(reader.chunks) == 4
+    out = reader.read()
+    assert isinstance(out['events'], EventBatch)
+    assert isinstance(out['hits'], HitBatch)
+    for batch, other in ((events, out['events']), (hits, out['hits'])):
+        for p in batch.columns:
+            assert numpy.array_equal(batch[p], other[p])
+    assert isinstance(reader.column('events', 't'), numpy.memmap)
+    # Event ID range
+    sliced = reader.read(10, 20, tables=['hits'])['hits']
+    assert numpy.array_equal(sliced['t'], hits['t'][10:20])
+
+    with pytest.raises(ValueError):
+        StoreWriter(path)
+
+
+@pytest.mark.parametrize('tmin,tmax', [(0, 4), (0.5, 2.5), (1.2, 1.3),
+                                       (3.9, 10), (5, 6)])
+def test_read_time(tmp_path, tmin, tmax):
+    """Tests reading a time range."""
+    path = str(tmp_path / 'store')
+    events, __ = write(path)
+    out = StoreReader(path).read_time(tmin, tmax)['events']
+    mask = (tmin <= events['t']) & (events['t'] < tmax)
+    assert numpy.array_equal(out['t'], events['t'][mask])
+
+
+def test_partial_chunk(tmp_path):
+    """Tests that data written without an index update are ignored."""
+    path = str(tmp_path / 'store')
+    events, __ = write(path)
+    with open(os.path.join(path, 'events.t.bin'), 'ab') as f:
+        numpy.arange(3, dtype=float).tofile(f)
+    with open(os.path.join(path, 'chunks.bin'), 'ab') as f:
+        numpy.arange(4, dtype=float).tofile(f)
+    reader = StoreReader(path)
+    assert len(reader.chunks) == 4
+    assert numpy.array_equal(reader.read()['events']['t'], events['t'])
+
+
+def test_index_size(tmp_path):
+    """Tests that the index does not grow with the number of chunks."""
+    path = str(tmp_path / 'store')
+    write(path, Nchunks=2)
+    size = os.path.getsize(os.path.join(path, 'index.json'))
+    write(str(tmp_path / 'other'), Nchunks=20)
+    assert os.path.getsize(os.path.join(str(tmp_path / 'other'),
+                                        'index.json')) <= size + 2
+    assert len(StoreReader(str(tmp_path / 'other')).chunks) == 20
+
+
+def test_overwrite(tmp_path):
+    """Tests that only the files of an existing store are overwritten."""
+    path = str(tmp_path / 'store')
+    os.makedirs(path)
+    open(os.path.join(path, 'keep.bin'), 'wb').close()
+    write(path)
+    assert os.path.exists(os.path.join(path, 'keep.bin'))
+
+    writer = StoreWriter(path, overwrite=True)
+    assert writer.nrows == 0
+    assert os.path.exists(os.path.join(path, 'keep.bin'))
+    assert not os.path.exists(os.path.join(path, 'events.t.bin'))
+    assert len(StoreReader(path)) == 0
@@ -0,0 +1,103 @@
+"""Unit tests for the streaming track summaries."""
+import numpy
+
+import pytest
+from simulator import (PoissonSource, Detector, Reconstructor)
+from simulator.parallel import ParallelRunner
+from simulator.summary import (Histogram, Histogram2D, Moments, TrackSummary)
+
+PLATES = [{'bounds': {'x': (-10, 10), 'y': (-10, 10)}, 'Npixs': 2000,
+           'z': z, 'phi': 23} for z in (30, 35, 40)]
+THETA_MAX = 10
+RATE = 100
+T = 2.5
+
+
+def test_accumulators():
+    """Tests chunked and merged accumulators against numpy."""
+    gen = numpy.random.default_rng(42)
+    x = gen.normal(1, 2, 10000)
+    y = gen.uniform(-1, 1, x.size)
+    x[::100] = numpy.nan
+    edges = numpy.linspace(-3, 3, 25)
+    hist, hist2d, moments = Histogram(edges), Histogram2D(edges, edges), []
+    for chunk in numpy.array_split(numpy.arange(x.size), 7):
+        hist.fill(x[chunk])
+        hist2d.fill(x[chunk], y[chunk])
+        moments.append(Moments().fill(x[chunk]))
+    merged = Moments()
+    for m in moments:
+        merged.merge(m)
+
+    finite = x[numpy.isfinite(x)]
+    assert numpy.array_equal(hist.counts, numpy.histogram(finite, edges)[0])
+    assert hist.underflow == numpy.sum(finite < -3)
+    assert hist.overflow == numpy.sum(finite > 3)
+    assert hist.invalid == 100 and hist.total == x.size
+    mask = numpy.isfinite(x)
+    assert numpy.array_equal(
+        hist2d.counts, numpy.histogram2d(x[mask], y[mask], (edges, edges))[0])
+    assert merged.n == finite.size and merged.invalid == 100
+    assert numpy.isclose(merged.mean, numpy.mean(finite))
+    assert numpy.isclose(merged.variance, numpy.var(finite, ddof=1))
+    assert merged.min == numpy.min(finite) and merged.max == numpy.max(finite)
+
+    with pytest.raises(ValueError):
+        hist.merge(Histogram(edges[1:]))
+    with pytest.raises(ValueError):
+        Histogram([1, 0])
+
+
+def test_track_summary(tmp_path):
+    """Tests summarising tracks through the reconstructor."""
+    events = PoissonSource(40, rate=RATE).observe(T, as_batch=True)
+    hits = Detector(PLATES).evaluate_batch(events)
+    reconstructor = Reconstructor()
+    summary = TrackSummary()
+    for __ in reconstructor.iter_reconstruct(
+            (hits[i:i + 50] for i in range(0, len(hits), 50)),
+            summary=summary):
+        pass
+    tracks = reconstructor.reconstruct_batch(hits)
+
+    assert summary.n == len(tracks)
+    for p in ('v', 'theta', 'phi'):
+        finite = tracks[p][numpy.isfinite(tracks[p])]
+        assert summary.moments[p].n == finite.size
+        assert numpy.isclose(summary.moments[p].mean, numpy.mean(finite))
+        assert numpy.sum(summary.histograms[p].counts) == finite.size
+    # Partially covered events are invalid
+    assert summary.moments['v'].invalid == numpy.sum(tracks['nhits'] < 2)
+
+    fname = str(tmp_path / 'summary.json')
+    summary.save(fname)
+    loaded = TrackSummary.load(fname)
+    assert loaded.to_dict() == summary.to_dict()
+    # Merging doubles the counts
+    loaded.merge(summary)
+    assert numpy.array_equal(loaded.angular.counts, 2 * summary.angular.counts)
+
+    # The per event dicts are summarised alike
+    events = PoissonSource(THETA_MAX, rate=RATE).observe(T, as_batch=True)
+    other = TrackSummary()
+    reconstructor.reconstruct(Detector(PLATES).evaluate_events(
+        events[:20].to_dicts()), summary=other)
+    assert other.n == 20
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_parallel_summary(workers):
+    """Tests that per-shard summaries merge into that of the full run."""
+    source = PoissonSource(THETA_MAX, rate=RATE)
+    runner = ParallelRunner(source, Detector(PLATES), Reconstructor(),
+                            period=0.5, workers=workers)
+    __, __, tracks = runner.run(T)
+    summary = runner.summarise(T, TrackSummary())
+    expected = TrackSummary().update(tracks)
+
+    for p in ('v', 'theta', 'phi'):
+        assert numpy.array_equal(summary.histograms[p].counts,
+                                 expected.histograms[p].counts)
+        assert numpy.isclose(summary.moments[p].variance,
+                             expected.moments[p].variance)
+    assert numpy.array_equal(summary.angular.counts, expected.angular.counts)